@@ -8,9 +8,26 @@ import subprocess
 import shutil
 import re
 import platform
+import json
+import fnmatch
+import hashlib
+import heapq
+import shlex
+import sqlite3
+import statistics
+import resource
+import signal
+import glob
+import zipfile
+import threading
+import urllib.request
+import urllib.error
+import xml.etree.ElementTree as ET
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, List, Tuple, Optional
-from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Tuple, Optional, Set
+from dataclasses import dataclass, field
 from pathlib import Path
 import logging
 import colorama
@@ -34,8 +51,24 @@ class BuildOptions:
     variant: str = "vanilla"
     date_string: str = datetime.now().strftime("%Y%m%d")
     skip_sync: bool = False
-    clean_build: bool = True
+    full_sync: bool = False
+    mirror_dir: Optional[str] = None
+    sync_phase: str = "all"
+    sync_profile: Optional[str] = "default"
+    slim_rules: Optional[str] = "default"
+    # True forces a full clean, False never cleans, None lets CleanPolicy decide
+    clean_build: Optional[bool] = None
     build_fastboot: bool = False
+    # Build variants in parallel when the host has the memory and disk for it
+    concurrent: bool = True
+    # Compiler cache shared by all builds, None disables ccache
+    ccache_dir: Optional[str] = os.path.expanduser("~/.ccache")
+    ccache_size: str = "50G"
+    dry_run: bool = False
+    # Echo raw build output instead of the progress line
+    verbose: bool = False
+    plan_only: bool = False
+    estimate_only: bool = False
 
 # ROM configurations
 class RomInfo:
@@ -53,6 +86,146 @@ class Config:
         "lmodroid": RomInfo("LMODroid", "lmo", "https://git.libremobileos.com/LMODroid/manifest.git", "fifteen")
     }
 
+    # Paths synced with --skip-sync when there is no previous manifest snapshot to diff against
+    FALLBACK_SYNC_PATHS = ["device/", "vendor/", "kernel/", "hardware/xiaomi/", "hardware/google/"]
+
+    # Lines of command output kept in memory for error summaries
+    OUTPUT_TAIL_LINES = 200
+    ERROR_SUMMARY_LINES = 30
+
+    # Retries of failed projects after a partial sync failure, with exponential backoff
+    SYNC_RETRIES = 3
+    SYNC_RETRY_BACKOFF = 30
+
+    # Projects per repo sync invocation when retrying failed projects
+    SYNC_BATCH_SIZE = 150
+
+    # Default sync profile, first matching rule wins. Modes: "full" keeps the
+    # whole history, "shallow" clones with the given depth, "blobless" is a
+    # partial clone that fetches file contents on demand. Blobless is opt-in:
+    # its contents are downloaded during checkout, not by a fetch-only run.
+    DEFAULT_SYNC_PROFILE = [
+        {"pattern": "prebuilts/*", "mode": "shallow", "depth": 1},
+        {"pattern": "*", "mode": "full"}
+    ]
+
+    # Default manifest slimming rules. "remove" patterns are always dropped,
+    # "unused" patterns only when the last build of the device did not read
+    # from them, "keep" patterns never. {device} expands to the device codename.
+    DEFAULT_SLIM_RULES = {
+        "remove": ["prebuilts/*darwin*", "prebuilts/*windows*", "prebuilts/*/*darwin*", "prebuilts/*/*windows*"],
+        "unused": ["device/*", "hardware/*", "kernel/*", "vendor/*", "prebuilts/gcc/*", "prebuilts/qemu-kernel"],
+        "keep": ["*{device}*", "vendor/lineage", "vendor/axion", "vendor/lmodroid", "device/qcom/sepolicy*", "hardware/qcom*/*"]
+    }
+
+    # Rough step costs in minutes, used to estimate build plans
+    STEP_COSTS = {
+        "configure": 1,
+        "clean": 5,
+        "installclean": 1,
+        "build": 150,
+        "package": 3,
+        "updatepackage": 20,
+        "publish": 1
+    }
+
+    # Memory model of one build job in GiB. Soong/kati analysis peaks before
+    # ninja starts running actions, so it is only a minimum for starting a
+    # build. While actions run, ninja itself holds the build graph and every
+    # parallel action needs roughly another thread's worth (d8, metalava and
+    # linking peak well above a clang compile). The reserve stays free for
+    # the rest of the system, and only part of the free swap counts towards
+    # the budget since builds that page crawl.
+    BUILD_ANALYSIS_MEMORY_GB = 20
+    BUILD_NINJA_MEMORY_GB = 3
+    BUILD_THREAD_MEMORY_GB = 1.5
+    HOST_RESERVED_MEMORY_GB = 8
+    SWAP_USABLE_FRACTION = 0.25
+
+    # Fewest threads per job that make concurrent builds worth it
+    MIN_CONCURRENT_BUILD_THREADS = 8
+
+    # Disk space for a new output directory, and for rebuilding in an existing one, in GiB
+    OUT_DIR_DISK_GB = 250
+    OUT_DIR_GROWTH_GB = 30
+
+    # Memory watchdog: builds are throttled when available memory drops below
+    # WATCHDOG_LOW_MEMORY_GB or the share of time all tasks stall on memory
+    # (PSI "full" avg10, percent) exceeds WATCHDOG_PSI_FULL, and resumed once
+    # both are back past the resume thresholds. A paused process is resumed
+    # after WATCHDOG_MAX_PAUSE seconds regardless.
+    WATCHDOG_INTERVAL = 2
+    WATCHDOG_LOW_MEMORY_GB = 4
+    WATCHDOG_RESUME_MEMORY_GB = 10
+    WATCHDOG_PSI_FULL = 10.0
+    WATCHDOG_PSI_RESUME = 2.0
+    WATCHDOG_MAX_PAUSE = 600
+    # Build processes the watchdog may pause, by /proc comm name
+    WATCHDOG_PROCESSES = {"java", "javac", "clang", "clang++", "ld.lld", "lld", "rustc", "kotlinc", "d8", "r8", "metalava"}
+
+    # Recent successful runs of a phase that its estimate is the median of
+    HISTORY_SAMPLES = 10
+    # Phases whose duration scales with the CPU count when estimating from other hosts
+    CPU_BOUND_PHASES = {"clean", "build", "package"}
+
+    # Build progress: actions/s is measured over the last PROGRESS_RATE_WINDOW
+    # seconds, events are written at most every PROGRESS_EVENT_INTERVAL seconds
+    # and, without a progress bar, a progress line is logged every
+    # PROGRESS_LOG_INTERVAL seconds
+    PROGRESS_RATE_WINDOW = 60
+    PROGRESS_EVENT_INTERVAL = 5
+    PROGRESS_LOG_INTERVAL = 60
+    PROGRESS_BAR_WIDTH = 30
+
+    # Ninja log analysis: slowest actions and modules kept in the report, and
+    # the end-time bucket size used to approximate the critical path
+    NINJA_TOP_ACTIONS = 200
+    NINJA_TOP_MODULES = 1000
+    NINJA_PATH_BUCKET_MS = 1000
+    # Actions finishing together can be logged slightly out of order; only a
+    # larger step back in end time marks the start of a new ninja run
+    NINJA_RESTART_SLACK_MS = 100
+
+    # Run trace: resource counter interval, shortest ninja action shown as a
+    # span, and disks left out of the I/O counter (virtual or stacked devices
+    # whose I/O is already counted on the disks below them)
+    TRACE_SAMPLE_INTERVAL = 2
+    TRACE_MIN_ACTION_MS = 500
+    TRACE_IGNORED_DISKS = ("loop", "ram", "zram", "dm-", "md", "sr")
+
+    # Build comparison: a difference is reported when it is at least
+    # COMPARE_MIN_RATIO of the older value and the minimum delta (phases /
+    # ninja actions, seconds), and, with COMPARE_MIN_SAMPLES earlier runs,
+    # COMPARE_Z robust standard deviations (MAD) away from their median
+    COMPARE_MIN_RATIO = 0.1
+    COMPARE_MIN_PHASE_DELTA_S = 30
+    COMPARE_MIN_ACTION_DELTA_S = 5
+    COMPARE_MIN_SAMPLES = 3
+    COMPARE_Z = 3.0
+    COMPARE_TOP = 10
+    # Changes in these projects can slow down every module
+    COMPARE_GLOBAL_PROJECTS = ("build/", "prebuilts/clang", "prebuilts/jdk", "prebuilts/build-tools",
+                               "prebuilts/go", "prebuilts/rust", "external/rust", "toolchain/")
+
+    # Seconds between peak RSS samples of running phases
+    PHASE_SAMPLE_INTERVAL = 1
+
+    # Free disk space below which the compiler cache is trimmed before a build, in GiB
+    CCACHE_MIN_FREE_DISK_GB = 60
+
+    # Smallest size the compiler cache is trimmed to, in GiB; ccache reads a max size of 0 as unlimited
+    CCACHE_MIN_TRIM_SIZE_GB = 1
+
+    # Top-level make goal of each ROM's release build
+    BUILD_GOALS = {"axion": "bacon", "lmodroid": "lmodroid"}
+
+    # Device local manifests per (rom, device)
+    DEVICE_MANIFESTS = {
+        ("axion", "pipa"): "https://raw.githubusercontent.com/ai94iq/local_manifests/main/axion-pipa-qpr2.xml",
+        ("axion", "raven"): "https://raw.githubusercontent.com/ai94iq/local_manifests/main/axion-raven-qpr2.xml",
+        ("lmodroid", "pipa"): "https://raw.githubusercontent.com/ai94iq/local_manifests/main/lmov-pipa.xml"
+    }
+
 class Colors:
     RED = Fore.RED
     GREEN = Fore.GREEN
@@ -61,6 +234,2314 @@ class Colors:
     CYAN = Fore.CYAN
     NC = Style.RESET_ALL
 
+# Manifest snapshots
+@dataclass
+class ManifestDiff:
+    added: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    moved: List[str] = field(default_factory=list)
+
+    def changed_paths(self) -> List[str]:
+        """Paths that need to be fetched/checked out to catch up with the diff"""
+        return sorted(self.added + self.moved)
+
+    def is_empty(self) -> bool:
+        return not (self.added or self.removed or self.moved)
+
+    def to_dict(self) -> Dict[str, List[str]]:
+        return {"added": self.added, "removed": self.removed, "moved": self.moved}
+
+    def summary(self) -> str:
+        return f"{len(self.added)} added, {len(self.removed)} removed, {len(self.moved)} moved"
+
+class ManifestSnapshot:
+    """Project path -> {name, revision, remote, groups} for one state of a checkout"""
+
+    def __init__(self, projects: Optional[Dict[str, Dict[str, str]]] = None):
+        self.projects = projects or {}
+        # Parsed <project> elements, only available for snapshots read from XML
+        self.elements: Dict[str, ET.Element] = {}
+
+    @classmethod
+    def from_checkout(cls, rom_path: str) -> "ManifestSnapshot":
+        """Parse .repo/manifest.xml (with includes) plus .repo/local_manifests/*.xml"""
+        repo_dir = os.path.join(rom_path, ".repo")
+        snapshot = cls()
+        state = {"remotes": {}, "default": {}}
+        snapshot._parse_file(os.path.join(repo_dir, "manifest.xml"), os.path.join(repo_dir, "manifests"), state)
+        local_dir = os.path.join(repo_dir, "local_manifests")
+        if os.path.isdir(local_dir):
+            for name in sorted(os.listdir(local_dir)):
+                if name.endswith(".xml"):
+                    snapshot._parse_file(os.path.join(local_dir, name), os.path.join(repo_dir, "manifests"), state)
+        return snapshot
+
+    @classmethod
+    def from_file(cls, path: str) -> "ManifestSnapshot":
+        """Parse a standalone manifest, e.g. the output of 'repo manifest -r'"""
+        snapshot = cls()
+        snapshot._parse_file(path, os.path.dirname(path), {"remotes": {}, "default": {}})
+        return snapshot
+
+    @classmethod
+    def load(cls, path: str) -> Optional["ManifestSnapshot"]:
+        """Load a snapshot saved with save(), or None if there is none"""
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path) as f:
+                return cls(json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.projects, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def _parse_file(self, path: str, include_dir: str, state: Dict) -> None:
+        try:
+            root = ET.parse(path).getroot()
+        except (OSError, ET.ParseError) as e:
+            logger.warning(f"{Colors.YELLOW}Warning: could not parse manifest {path}: {e}{Colors.NC}")
+            return
+
+        for node in root:
+            if node.tag == "include":
+                self._parse_file(os.path.join(include_dir, node.get("name", "")), include_dir, state)
+            elif node.tag == "remote":
+                state["remotes"][node.get("name")] = dict(node.attrib)
+            elif node.tag == "default":
+                state["default"] = dict(node.attrib)
+            elif node.tag == "project":
+                name = node.get("name")
+                path_attr = node.get("path") or name
+                remote = node.get("remote") or state["default"].get("remote", "")
+                revision = (node.get("revision")
+                            or state["remotes"].get(remote, {}).get("revision")
+                            or state["default"].get("revision", ""))
+                self.projects[path_attr] = {
+                    "name": name,
+                    "revision": revision,
+                    "remote": remote,
+                    "groups": node.get("groups", "")
+                }
+                self.elements[path_attr] = node
+            elif node.tag == "remove-project":
+                for project_path in self._match(node.get("name"), node.get("path")):
+                    self.projects.pop(project_path, None)
+                    self.elements.pop(project_path, None)
+            elif node.tag == "extend-project":
+                for project_path in self._match(node.get("name"), node.get("path")):
+                    if node.get("revision"):
+                        self.projects[project_path]["revision"] = node.get("revision")
+                    if node.get("remote"):
+                        self.projects[project_path]["remote"] = node.get("remote")
+                    if node.get("groups"):
+                        groups = self.projects[project_path]["groups"]
+                        self.projects[project_path]["groups"] = ",".join(filter(None, [groups, node.get("groups")]))
+
+    def _match(self, name: Optional[str], path: Optional[str]) -> List[str]:
+        """Project paths matching a remove-project/extend-project selector"""
+        return [
+            project_path for project_path, info in self.projects.items()
+            if (name is None or info["name"] == name) and (path is None or project_path == path)
+        ]
+
+    def diff(self, newer: "ManifestSnapshot") -> ManifestDiff:
+        """Compare this (older) snapshot against a newer one"""
+        old_paths = set(self.projects)
+        new_paths = set(newer.projects)
+        moved = [
+            path for path in sorted(old_paths & new_paths)
+            if self.projects[path]["revision"] != newer.projects[path]["revision"]
+            or self.projects[path]["name"] != newer.projects[path]["name"]
+        ]
+        return ManifestDiff(
+            added=sorted(new_paths - old_paths),
+            removed=sorted(old_paths - new_paths),
+            moved=moved
+        )
+
+# repo sync failure parsing
+FAILED_PROJECT_PATTERNS = [
+    re.compile(r"^error: Cannot (?:fetch|checkout) (\S+)"),
+    re.compile(r"^error: (\S+?)/?: "),
+    re.compile(r"^error\.GitError: (\S+?)/?[: ]"),
+]
+
+def parse_failed_projects(output: str) -> List[str]:
+    """Extract the projects reported as failed in repo sync output"""
+    failed = []
+    in_failing_list = False
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith("Failing repos"):
+            in_failing_list = True
+            continue
+        if in_failing_list:
+            if not line or line.startswith(("error", "Try re-running", "fatal")):
+                in_failing_list = False
+            else:
+                failed.append(line.rstrip("/"))
+                continue
+        for pattern in FAILED_PROJECT_PATTERNS:
+            match = pattern.match(line)
+            if match:
+                failed.append(match.group(1).rstrip("/"))
+                break
+    return list(dict.fromkeys(failed))
+
+# Adaptive sync parallelism
+class SyncTuner:
+    """Per-host tuning of repo sync parallelism.
+
+    Network and checkout jobs are tuned separately by hill climbing on the
+    throughput measured for each repo sync invocation. The best setting
+    found for each host is persisted and used as the starting point of the
+    next sync, so tuning carries on across runs.
+    """
+
+    # Batches that move less data than this say nothing about throughput
+    MIN_SAMPLE_BYTES = 64 * 1024 * 1024
+    MIN_JOBS = 2
+    MAX_JOBS = 64
+
+    def __init__(self, path: str, cores: int):
+        self.path = path
+        self.host = platform.node()
+        self.data: Dict[str, Dict] = {}
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.data = json.load(f)
+            except (OSError, ValueError):
+                self.data = {}
+        defaults = {"network": min(cores, 8), "checkout": cores}
+        host_data = self.data.setdefault(self.host, {})
+        self.state: Dict[str, Dict] = {}
+        for kind, default_jobs in defaults.items():
+            saved = host_data.get(kind, {})
+            best_jobs = saved.get("jobs", default_jobs)
+            self.state[kind] = {
+                "jobs": best_jobs,
+                "best_jobs": best_jobs,
+                # Conditions change between runs, so re-establish the baseline
+                "best_rate": 0.0,
+                "direction": 1,
+                "reversed": False,
+                "settled": False,
+                "bytes": 0,
+                "seconds": 0.0
+            }
+
+    def jobs(self, kind: str) -> int:
+        return self.state[kind]["jobs"]
+
+    def flags(self) -> str:
+        return f"--jobs-network={self.jobs('network')} --jobs-checkout={self.jobs('checkout')}"
+
+    def record(self, kind: str, jobs: int, nbytes: int, seconds: float) -> None:
+        """Feed one sync measurement and pick the jobs for the next one"""
+        state = self.state[kind]
+        state["bytes"] += max(nbytes, 0)
+        state["seconds"] += seconds
+        if nbytes < self.MIN_SAMPLE_BYTES or seconds <= 0 or state["settled"]:
+            return
+
+        rate = nbytes / seconds / (1024 * 1024)
+        logger.info(f"{Colors.CYAN}{kind.capitalize()} throughput with {jobs} jobs: {rate:.1f} MB/s{Colors.NC}")
+        if rate > state["best_rate"] * 1.05:
+            state["best_rate"] = rate
+            state["best_jobs"] = jobs
+            state["reversed"] = False
+        elif rate < state["best_rate"] * 0.95 and not state["reversed"]:
+            # Got worse, go back to the best known value and probe the other way
+            state["direction"] = -state["direction"]
+            state["reversed"] = True
+            jobs = state["best_jobs"]
+        else:
+            # Worse in both directions, or no significant change: stay at the best value
+            state["jobs"] = state["best_jobs"]
+            state["settled"] = True
+            return
+        step = max(1, jobs // 2)
+        state["jobs"] = min(self.MAX_JOBS, max(self.MIN_JOBS, jobs + state["direction"] * step))
+
+    def achieved(self, kind: str) -> float:
+        """Average MB/s over everything recorded for this kind so far"""
+        state = self.state[kind]
+        if state["seconds"] <= 0:
+            return 0.0
+        return state["bytes"] / state["seconds"] / (1024 * 1024)
+
+    def save(self) -> None:
+        host_data = self.data.setdefault(self.host, {})
+        for kind, state in self.state.items():
+            if state["best_rate"] > 0:
+                host_data[kind] = {"jobs": state["best_jobs"], "mb_per_s": round(state["best_rate"], 2)}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+
+# Manifest slimming
+def project_for_path(path: str, project_paths: Set[str], max_depth: int = 6) -> Optional[str]:
+    """Longest project path that contains the given source-relative path"""
+    parts = path.split("/")
+    for depth in range(min(len(parts), max_depth), 0, -1):
+        candidate = "/".join(parts[:depth])
+        if candidate in project_paths:
+            return candidate
+    return None
+
+def collect_used_projects(rom_path: str, goal: str, project_paths: Set[str], out_dir: str = "out") -> Optional[Set[str]]:
+    """Projects that provided inputs to the last build of the given goal.
+
+    Streams 'ninja -t inputs' (declared inputs) and 'ninja -t deps'
+    (depfile-discovered headers) of the combined ninja file, so memory only
+    grows with the number of projects.
+    """
+    out_path = os.path.join(rom_path, out_dir)
+    combined = sorted(Path(out_path).glob("combined-*.ninja"), key=lambda p: p.stat().st_mtime) if os.path.isdir(out_path) else []
+    ninja = os.path.join(rom_path, "prebuilts/build-tools/linux-x86/bin/ninja")
+    if not combined or not os.path.isfile(ninja):
+        return None
+
+    used: Set[str] = set()
+    for tool_args in (["-t", "inputs", goal], ["-t", "deps"]):
+        process = subprocess.Popen(
+            [ninja, "-f", str(combined[-1])] + tool_args,
+            cwd=rom_path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True
+        )
+        for line in process.stdout:
+            path = line.strip()
+            if not path or path.startswith((f"{out_dir}/", "/")) or path.endswith(")"):
+                continue
+            project = project_for_path(os.path.normpath(path), project_paths)
+            if project:
+                used.add(project)
+        if process.wait() != 0:
+            return None
+    return used
+
+class ManifestSlimmer:
+    """Generates remove-project entries for projects a device build does not need"""
+
+    def __init__(self, rules: Dict[str, List[str]], device: str):
+        self.remove = [p.format(device=device) for p in rules.get("remove", [])]
+        self.unused = [p.format(device=device) for p in rules.get("unused", [])]
+        self.keep = [p.format(device=device) for p in rules.get("keep", [])]
+
+    @classmethod
+    def load(cls, spec: Optional[str], rom: str, device: str) -> Optional["ManifestSlimmer"]:
+        """'default' for Config.DEFAULT_SLIM_RULES, 'none' to disable, else a JSON file.
+
+        A rules file is either one rule set or a mapping of '<rom>-<device>'
+        (or 'default') to rule sets.
+        """
+        if not spec or spec == "none":
+            return None
+        if spec == "default":
+            return cls(Config.DEFAULT_SLIM_RULES, device)
+        with open(spec) as f:
+            data = json.load(f)
+        if f"{rom}-{device}" in data:
+            data = data[f"{rom}-{device}"]
+        elif "default" in data:
+            data = data["default"]
+        return cls(data, device)
+
+    @staticmethod
+    def _matches(path: str, patterns: List[str]) -> bool:
+        return any(fnmatch.fnmatch(path, pattern) for pattern in patterns)
+
+    def removable(self, snapshot: ManifestSnapshot, used: Optional[Set[str]], protected: Set[str]) -> List[str]:
+        """Project paths to drop. Usage-based rules only apply once a build recorded its usage."""
+        paths = []
+        for path in snapshot.projects:
+            if path in protected or self._matches(path, self.keep):
+                continue
+            if self._matches(path, self.remove):
+                paths.append(path)
+            elif used is not None and path not in used and self._matches(path, self.unused):
+                paths.append(path)
+        return sorted(paths)
+
+    @staticmethod
+    def write_local_manifest(snapshot: ManifestSnapshot, paths: List[str], manifest_path: str) -> List[str]:
+        """Write remove-project entries; a name is only removed if all its paths are removable"""
+        removable = set(paths)
+        names = sorted({snapshot.projects[path]["name"] for path in paths})
+        names = [
+            name for name in names
+            if all(path in removable for path, info in snapshot.projects.items() if info["name"] == name)
+        ]
+        if names:
+            root = ET.Element("manifest")
+            for name in names:
+                ET.SubElement(root, "remove-project", {"name": name})
+            ET.ElementTree(root).write(manifest_path, encoding="UTF-8", xml_declaration=True)
+        return names
+
+# Partial-clone / shallow-depth profiles
+class SyncProfile:
+    """Clone depth and partial-clone settings per project path pattern"""
+
+    MODES = ("full", "shallow", "blobless")
+
+    def __init__(self, rules: List[Dict]):
+        for rule in rules:
+            if rule.get("mode") not in self.MODES:
+                raise ValueError(f"invalid sync profile mode '{rule.get('mode')}' for pattern '{rule.get('pattern')}'")
+        self.rules = rules
+
+    @classmethod
+    def load(cls, spec: Optional[str]) -> Optional["SyncProfile"]:
+        """'default' for Config.DEFAULT_SYNC_PROFILE, 'none' to disable, else a JSON file"""
+        if not spec or spec == "none":
+            return None
+        if spec == "default":
+            return cls(Config.DEFAULT_SYNC_PROFILE)
+        with open(spec) as f:
+            return cls(json.load(f))
+
+    def rule_for(self, path: str) -> Dict:
+        for rule in self.rules:
+            if fnmatch.fnmatch(path, rule["pattern"]):
+                return rule
+        return {"pattern": "*", "mode": "full"}
+
+    def uses_partial_clone(self) -> bool:
+        return any(rule["mode"] == "blobless" for rule in self.rules)
+
+    def init_flags(self) -> str:
+        if self.uses_partial_clone():
+            return "--partial-clone --clone-filter=blob:none"
+        return ""
+
+    def partial_clone_excludes(self, snapshot: ManifestSnapshot) -> List[str]:
+        """Project names that must not be partial clones"""
+        return sorted({
+            info["name"] for path, info in snapshot.projects.items()
+            if self.rule_for(path)["mode"] != "blobless"
+        })
+
+    def write_local_manifest(self, snapshot: ManifestSnapshot, path: str) -> int:
+        """Write a local manifest re-declaring shallow projects with clone-depth.
+
+        Projects are removed by name, so every project sharing a name is
+        re-added. Returns the number of projects written.
+        """
+        shallow_names = {
+            info["name"] for project_path, info in snapshot.projects.items()
+            if self.rule_for(project_path)["mode"] == "shallow"
+        }
+        root = ET.Element("manifest")
+        count = 0
+        for name in sorted(shallow_names):
+            ET.SubElement(root, "remove-project", {"name": name})
+            for project_path, info in snapshot.projects.items():
+                element = snapshot.elements.get(project_path)
+                if info["name"] != name or element is None:
+                    continue
+                project = ET.fromstring(ET.tostring(element))
+                project.set("path", project_path)
+                project.set("clone-depth", str(self.rule_for(project_path).get("depth", 1)))
+                # The snapshot has the remote and revision in effect, including
+                # extend-project overrides the original element lacks
+                if info["remote"]:
+                    project.set("remote", info["remote"])
+                if info["revision"]:
+                    project.set("revision", info["revision"])
+                project.tail = None
+                root.append(project)
+                count += 1
+        if count:
+            ET.ElementTree(root).write(path, encoding="UTF-8", xml_declaration=True)
+        return count
+
+# Device manifest fetching
+class ManifestFetcher:
+    """Downloads manifests with a per-URL cache and conditional requests.
+
+    The cache keeps the body, its SHA-256 and the ETag/Last-Modified
+    validators, so an unchanged manifest costs a single 304 round trip and
+    a network failure falls back to the cached copy.
+    """
+
+    def __init__(self, cache_dir: str, timeout: int = 30):
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+
+    def _paths(self, url: str) -> Tuple[str, str]:
+        key = hashlib.sha256(url.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{key}.xml"), os.path.join(self.cache_dir, f"{key}.json")
+
+    def fetch(self, url: str) -> Tuple[bytes, str]:
+        """Return the manifest bytes and their SHA-256"""
+        body_path, meta_path = self._paths(url)
+        meta = {}
+        if os.path.isfile(body_path) and os.path.isfile(meta_path):
+            # A damaged cache entry is refetched, not fatal
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                meta = {}
+            if not isinstance(meta, dict) or "sha256" not in meta:
+                meta = {}
+
+        request = urllib.request.Request(url)
+        if meta.get("etag"):
+            request.add_header("If-None-Match", meta["etag"])
+        if meta.get("last_modified"):
+            request.add_header("If-Modified-Since", meta["last_modified"])
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                content = response.read()
+                meta = {
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "sha256": hashlib.sha256(content).hexdigest()
+                }
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or not meta:
+                raise
+            logger.info(f"{Colors.CYAN}Manifest not modified: {url}{Colors.NC}")
+            with open(body_path, "rb") as f:
+                return f.read(), meta["sha256"]
+        except (urllib.error.URLError, OSError) as e:
+            if not meta:
+                raise
+            logger.warning(f"{Colors.YELLOW}Warning: could not fetch {url} ({e}), using cached copy{Colors.NC}")
+            with open(body_path, "rb") as f:
+                return f.read(), meta["sha256"]
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(body_path, "wb") as f:
+            f.write(content)
+        with open(meta_path, "w") as f:
+            json.dump(meta, f, indent=1)
+        return content, meta["sha256"]
+
+# Shared git object store
+class MirrorStore:
+    """Local repo mirror of the manifests in Config.ROM_INFO.
+
+    ROM trees are initialized with 'repo init --reference' pointing here, so
+    objects shared between the trees are downloaded and stored only once.
+    """
+
+    GC_INTERVAL_DAYS = 7
+
+    def __init__(self, path: str, run_command):
+        self.path = path
+        self.run_command = run_command
+        self.gc_stamp = os.path.join(self.path, ".rom-builder-gc")
+
+    def exists(self) -> bool:
+        return os.path.isdir(os.path.join(self.path, ".repo"))
+
+    def update(self, rom_info: RomInfo, jobs: int) -> bool:
+        """Create the mirror if needed and fetch one ROM manifest into it.
+
+        Re-initializing a mirror with another manifest keeps the projects
+        fetched for the previous one, so the store ends up with the union of
+        all ROM trees built here; each ROM's projects are refreshed when that
+        ROM is synced.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        logger.info(f"{Colors.GREEN}Updating shared mirror for {rom_info.name}...{Colors.NC}")
+        cmd = f"repo init --mirror -u {rom_info.manifest_url} -b {rom_info.branch}"
+        exit_code, _, _ = self.run_command(cmd, cwd=self.path)
+        if exit_code != 0:
+            logger.error(f"{Colors.RED}Failed to initialize mirror for {rom_info.name}{Colors.NC}")
+            return False
+        cmd = f"repo sync -j{jobs} --no-clone-bundle"
+        exit_code, _, _ = self.run_command(cmd, cwd=self.path)
+        if exit_code != 0:
+            logger.error(f"{Colors.RED}Failed to sync mirror for {rom_info.name}{Colors.NC}")
+            return False
+        return True
+
+    def link(self, rom_path: str) -> int:
+        """Point already cloned projects of a tree at the mirror's objects.
+
+        'repo init --reference' only sets up alternates for projects cloned
+        after it, so projects of an existing tree would keep fetching
+        everything themselves. Returns the number of projects linked.
+        """
+        objects_root = os.path.join(rom_path, ".repo", "project-objects")
+        linked = 0
+        for dirpath, dirnames, _ in os.walk(objects_root):
+            for dirname in [d for d in dirnames if d.endswith(".git")]:
+                dirnames.remove(dirname)
+                name = os.path.relpath(os.path.join(dirpath, dirname), objects_root)
+                mirror_objects = os.path.join(self.path, name, "objects")
+                info_dir = os.path.join(dirpath, dirname, "objects", "info")
+                if not os.path.isdir(mirror_objects) or not os.path.isdir(os.path.dirname(info_dir)):
+                    continue
+                alternates_path = os.path.join(info_dir, "alternates")
+                alternates = []
+                if os.path.isfile(alternates_path):
+                    with open(alternates_path) as f:
+                        alternates = f.read().split()
+                if mirror_objects in alternates:
+                    continue
+                os.makedirs(info_dir, exist_ok=True)
+                with open(alternates_path, "a") as f:
+                    f.write(mirror_objects + "\n")
+                linked += 1
+        return linked
+
+    def gc_due(self) -> bool:
+        if not os.path.isfile(self.gc_stamp):
+            return True
+        return time.time() - os.path.getmtime(self.gc_stamp) > self.GC_INTERVAL_DAYS * 86400
+
+    def gc(self) -> None:
+        """Repack the mirrored repositories.
+
+        Objects are never pruned: the ROM trees borrow them via alternates, so
+        an object that is unreachable in the mirror may still be needed there.
+        """
+        if not self.exists() or not self.gc_due():
+            return
+        logger.info(f"{Colors.GREEN}Running garbage collection on shared mirror...{Colors.NC}")
+        for dirpath, dirnames, _ in os.walk(self.path):
+            if ".repo" in dirnames:
+                dirnames.remove(".repo")
+            for dirname in [d for d in dirnames if d.endswith(".git")]:
+                self.run_command(f"git --git-dir={os.path.join(dirpath, dirname)} gc --quiet --prune=never")
+                dirnames.remove(dirname)
+        Path(self.gc_stamp).touch()
+
+# Captured lunch/axion environments
+class EnvCache:
+    """Environment produced by lunch/axion, cached per hash of its inputs.
+
+    The key covers build/envsetup.sh, the vendor envsetup scripts, the
+    device and vendor config makefiles, the ROM, device, variant, output
+    directory and the shell's PATH, so any change to those yields a new key
+    and the old entry is ignored. Only exported variables are captured.
+    """
+
+    # Variables that differ between shells, or that the builder sets itself
+    VOLATILE = {"PWD", "OLDPWD", "SHLVL", "_", "RANDOM", "LINENO", "SECONDS", "BUILD_FASTBOOT", "CCACHE_STATSLOG"}
+
+    # Snapshots store full values, so variables lunch derives from the shell's
+    # own environment are part of the key; a PATH captured under cron must not
+    # be restored in an interactive session or after tools were installed
+    KEY_ENV = ("PATH",)
+
+    KEY_FILES = [
+        "build/envsetup.sh",
+        "vendor/*/build/envsetup.sh",
+        "vendor/*/config/*.mk",
+        "device/*/{device}/*.mk",
+        "device/*/*common*/*.mk"
+    ]
+
+    def __init__(self, cache_dir: str, rom_path: str):
+        self.cache_dir = cache_dir
+        self.rom_path = rom_path
+
+    def key(self, rom: str, device: str, variant: str, out_dir: str = "out",
+            baseline: Optional[Dict[str, str]] = None) -> str:
+        digest = hashlib.sha256(f"{rom}\0{device}\0{variant}\0{out_dir}".encode())
+        for name in self.KEY_ENV:
+            digest.update(f"\0{name}={(baseline or {}).get(name, '')}".encode())
+        files = set()
+        for pattern in self.KEY_FILES:
+            files.update(glob.glob(os.path.join(self.rom_path, pattern.format(device=device))))
+        for path in sorted(files):
+            digest.update(os.path.relpath(path, self.rom_path).encode())
+            with open(path, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        return digest.hexdigest()[:24]
+
+    def load(self, key: str) -> Optional[Dict]:
+        path = os.path.join(self.cache_dir, f"{key}.json")
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key: str, data: Dict) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, f"{key}.json"), "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+
+    @staticmethod
+    def read_env(path: str) -> Dict[str, str]:
+        """Parse the output of 'env -0'"""
+        with open(path, "rb") as f:
+            entries = f.read().decode(errors="replace").split("\0")
+        env = {}
+        for entry in entries:
+            name, sep, value = entry.partition("=")
+            if sep and name not in EnvCache.VOLATILE and not name.startswith("__rb"):
+                env[name] = value
+        return env
+
+    @staticmethod
+    def diff(baseline: Dict[str, str], current: Dict[str, str]) -> Dict:
+        return {
+            "set": {name: value for name, value in current.items() if baseline.get(name) != value},
+            "unset": sorted(name for name in baseline if name not in current)
+        }
+
+    @staticmethod
+    def script(data: Dict, previously_set: Set[str]) -> str:
+        """Shell code applying a snapshot on top of the post-envsetup environment"""
+        lines = [f"unset {name}" for name in sorted(previously_set - set(data["set"]))]
+        lines += [f"unset {name}" for name in data["unset"]]
+        lines += [f"export {name}={shlex.quote(value)}" for name, value in sorted(data["set"].items())]
+        return "\n".join(lines) + "\n"
+
+# Compiler cache
+def parse_size(size: str) -> int:
+    """Bytes in a ccache-style size such as 50G, 500M or 1.5T"""
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)i?B?\s*", size, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"invalid size '{size}'")
+    return int(float(match.group(1)) * 1024 ** "_KMGT".index(match.group(2).upper() or "_"))
+
+class CcacheManager:
+    """ccache shared by every build of every variant.
+
+    Each build writes its own stats log (CCACHE_STATSLOG), so hit rates stay
+    per build even when variants compile concurrently; with a ccache that
+    has no stats log support, the global counters are diffed instead.
+    """
+
+    HIT_COUNTERS = ("direct_cache_hit", "preprocessed_cache_hit")
+    MISS_COUNTERS = ("cache_miss",)
+
+    def __init__(self, directory: str, size: str, rom_path: str):
+        self.directory = directory
+        self.size = size
+        self.rom_path = rom_path
+        self.executable = self._find_executable()
+        self.lock = threading.Lock()
+
+    def _find_executable(self) -> Optional[str]:
+        bundled = os.path.join(self.rom_path, "prebuilts/build-tools/linux-x86/bin/ccache")
+        if os.path.isfile(bundled) and os.access(bundled, os.X_OK):
+            return bundled
+        return shutil.which("ccache")
+
+    def env(self) -> Dict[str, str]:
+        return {"USE_CCACHE": "1", "CCACHE_EXEC": self.executable, "CCACHE_DIR": self.directory}
+
+    def _run(self, args: List[str], extra_env: Optional[Dict[str, str]] = None) -> Optional[str]:
+        result = subprocess.run(
+            [self.executable] + args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=dict(os.environ, **self.env(), **(extra_env or {})),
+            universal_newlines=True
+        )
+        return result.stdout if result.returncode == 0 else None
+
+    def setup(self) -> bool:
+        os.makedirs(self.directory, exist_ok=True)
+        return self._run(["--max-size", self.size]) is not None
+
+    def stats(self) -> Dict[str, int]:
+        """Global counters from 'ccache --print-stats'"""
+        output = self._run(["--print-stats"]) or ""
+        counters = {}
+        for line in output.splitlines():
+            name, _, value = line.partition("\t")
+            if value.strip().isdigit():
+                counters[name] = int(value)
+        return counters
+
+    @staticmethod
+    def read_stats_log(path: str) -> Dict[str, int]:
+        """Counters recorded in a stats log: '# <source>' lines followed by counter names"""
+        counters: Dict[str, int] = {}
+        if os.path.isfile(path):
+            with open(path, errors="replace") as f:
+                for line in f:
+                    name = line.strip()
+                    if name and not name.startswith("#"):
+                        counters[name] = counters.get(name, 0) + 1
+        return counters
+
+    def report(self, counters: Dict[str, int]) -> Dict[str, Any]:
+        """Hit rate of a build, and the compiler output it did not have to produce"""
+        hits = sum(counters.get(name, 0) for name in self.HIT_COUNTERS)
+        misses = sum(counters.get(name, 0) for name in self.MISS_COUNTERS)
+        cache = self.stats()
+        files = cache.get("files_in_cache", 0)
+        average = cache.get("cache_size_kibibyte", 0) * 1024 / files if files else 0
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "bytes_saved": int(hits * average)
+        }
+
+    def trim(self, min_free_gb: float) -> Optional[int]:
+        """Shrink the cache when the disk holding it runs low. Returns bytes freed."""
+        with self.lock:
+            free = shutil.disk_usage(self.directory).free
+            deficit = min_free_gb * 1024 ** 3 - free
+            if deficit <= 0:
+                return None
+            size = self.stats().get("cache_size_kibibyte", 0) * 1024
+            if size == 0:
+                return None
+            # A one-off lower limit; the configured max size stays as it is
+            target = max(Config.CCACHE_MIN_TRIM_SIZE_GB * 1024 ** 3, int(size - deficit))
+            self._run(["--cleanup"], {"CCACHE_MAXSIZE": f"{target // 1024}K"})
+            return max(0, shutil.disk_usage(self.directory).free - free)
+
+# Build matrix planning
+def format_duration(minutes: float) -> str:
+    minutes = max(0, int(round(minutes)))
+    return f"{minutes // 60}h {minutes % 60}m" if minutes >= 60 else f"{minutes}m"
+
+@dataclass
+class PlanStep:
+    key: str
+    kind: str
+    variant: str
+    fastboot: bool = False
+    command: str = ""
+    deps: List[str] = field(default_factory=list)
+    cost: float = 0.0
+    # Past runs the cost is the median of, 0 for the default cost
+    samples: int = 0
+    # How many more passes asked for this same step
+    merged: int = 0
+
+    def describe(self) -> str:
+        labels = {
+            "configure": "Configuring",
+            "clean": "Cleaning",
+            "build": "Building",
+            "package": "Packaging fastboot zip for",
+            "publish": "Publishing"
+        }
+        suffix = " (fastboot)" if self.fastboot and self.kind == "publish" else ""
+        return f"{labels[self.kind]} {self.variant} variant{suffix}"
+
+class BuildPlanner:
+    """Turns the rom x device x variant x fastboot matrix into a step DAG.
+
+    Each pass asks for configure, clean, build and publish steps. Steps that
+    are identical across passes are merged: a fastboot pass reuses the
+    configure, clean and build of the regular pass of the same variant and
+    only adds the package and publish steps on top of it. The package step
+    turns the regular build's target-files into the fastboot zip without
+    another build pass. Steps are grouped per variant so the build shell is
+    reconfigured as rarely as possible.
+    """
+
+    def __init__(self, rom: str, device: str, variants: List[str], fastboot: bool, clean_build: Optional[bool],
+                 jobs: Optional[Dict[str, Optional[int]]] = None,
+                 estimator: Optional[Callable[["PlanStep"], Optional[Tuple[float, int]]]] = None):
+        self.rom = rom
+        self.device = device
+        self.variants = variants
+        self.fastboot = fastboot
+        self.clean_build = clean_build
+        # Build parallelism per variant, None leaves it to soong
+        self.jobs = jobs or {}
+        # Cost in minutes and sample count from past runs, None falls back to Config.STEP_COSTS
+        self.estimator = estimator
+
+    @staticmethod
+    def configure_command(rom: str, device: str, variant: str) -> str:
+        if rom == "axion":
+            return f"axion {device} {'gms' if variant == 'gms' else 'va'}"
+        return f"lunch lmodroid_{device}-userdebug || breakfast {device}"
+
+    @staticmethod
+    def make_command(goal: str, jobs: Optional[int] = None) -> str:
+        return f"m {goal}" + (f" -j{jobs}" if jobs else "")
+
+    @staticmethod
+    def build_command(rom: str, is_fastboot: bool, jobs: Optional[int] = None) -> str:
+        if is_fastboot:
+            return BuildPlanner.make_command("updatepackage", jobs)
+        # The shell is already configured, so brunch's breakfast would only repeat the lunch
+        return BuildPlanner.make_command(Config.BUILD_GOALS[rom], jobs)
+
+    def passes(self) -> List[Tuple[str, bool]]:
+        passes = []
+        for variant in self.variants:
+            passes.append((variant, False))
+            if self.fastboot:
+                passes.append((variant, True))
+        return passes
+
+    def _cost(self, kind: str) -> float:
+        if kind == "clean":
+            if self.clean_build is None:
+                return Config.STEP_COSTS["installclean"]
+            return Config.STEP_COSTS["clean"] if self.clean_build else 0
+        return Config.STEP_COSTS[kind]
+
+    def clean_command(self, variant: str) -> str:
+        if self.clean_build is None:
+            return "clean policy"
+        return self.make_command("clean", self.jobs.get(variant)) if self.clean_build else "no clean"
+
+    def _naive_cost(self, kind: str) -> float:
+        # rom-builder.sh cleans every pass, fully by default
+        if kind == "clean":
+            return Config.STEP_COSTS["clean"] if self.clean_build is not False else 0
+        return Config.STEP_COSTS[kind]
+
+    def naive_cost(self) -> float:
+        """Cost of running every pass independently, as rom-builder.sh does"""
+        total = 0.0
+        for _, is_fastboot in self.passes():
+            total += sum(self._naive_cost(kind) for kind in ("configure", "clean", "build", "publish"))
+            if is_fastboot:
+                total += self._naive_cost("updatepackage")
+        return total
+
+    @staticmethod
+    def package_command() -> str:
+        return "img_from_target_files <target-files> <img.zip>"
+
+    def plan(self) -> List[PlanStep]:
+        """Deduplicated steps in execution order; dependencies always come first"""
+        steps: Dict[str, PlanStep] = {}
+
+        def add(step: PlanStep) -> str:
+            if step.key in steps:
+                steps[step.key].merged += 1
+            else:
+                estimate = self.estimator(step) if self.estimator else None
+                if estimate is not None:
+                    step.cost, step.samples = estimate
+                else:
+                    step.cost = self._cost(step.kind)
+                steps[step.key] = step
+            return step.key
+
+        for variant, is_fastboot in self.passes():
+            configure = add(PlanStep(f"configure:{variant}", "configure", variant,
+                                     command=self.configure_command(self.rom, self.device, variant)))
+            clean = add(PlanStep(f"clean:{variant}", "clean", variant,
+                                 command=self.clean_command(variant), deps=[configure]))
+            build = add(PlanStep(f"build:{variant}", "build", variant,
+                                 command=self.build_command(self.rom, False, self.jobs.get(variant)), deps=[clean]))
+            if is_fastboot:
+                package = add(PlanStep(f"package:{variant}", "package", variant, fastboot=True,
+                                       command=self.package_command(), deps=[build]))
+                add(PlanStep(f"publish:{variant}:fastboot", "publish", variant, fastboot=True, deps=[package]))
+            else:
+                add(PlanStep(f"publish:{variant}", "publish", variant, deps=[build]))
+        return list(steps.values())
+
+# Clean decisions
+@dataclass
+class CleanDecision:
+    mode: str
+    reason: str
+    # Directories to remove for a targeted clean, relative to the source root
+    paths: List[str] = field(default_factory=list)
+
+    SEVERITY = {"none": 0, "targeted": 1, "installclean": 2, "full": 3}
+
+    def merge(self, other: "CleanDecision") -> "CleanDecision":
+        """Combine two decisions, keeping the more thorough clean"""
+        if self.SEVERITY[other.mode] > self.SEVERITY[self.mode]:
+            return other
+        if other.mode == self.mode == "targeted":
+            return CleanDecision("targeted", f"{self.reason}; {other.reason}", sorted(set(self.paths + other.paths)))
+        return self
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"mode": self.mode, "reason": self.reason, "paths": self.paths}
+
+class CleanPolicy:
+    """Picks no clean, targeted removal, installclean or a full clean.
+
+    The decision is based on what changed since the last build in the same
+    output directory: the manifest diff between the pinned snapshots of the
+    two builds, and whether the device or variant switched.
+    """
+
+    # Changes here invalidate most of out/, so they need a full clean
+    FULL_CLEAN_PATTERNS = [
+        "build/make", "build/soong", "build/blueprint", "build/bazel*", "build/release",
+        "prebuilts/clang/*", "prebuilts/build-tools", "prebuilts/jdk/*", "prebuilts/go/*",
+        "prebuilts/rust", "prebuilts/gcc/*", "prebuilts/r8", "toolchain/*"
+    ]
+
+    # Changes here only need the listed product out/ subtrees removed
+    TARGETED_PATTERNS = [
+        ("kernel/*", ["obj/KERNEL_OBJ"]),
+        ("device/*/*-kernel", ["obj/KERNEL_OBJ"])
+    ]
+
+    # Changes here can alter what gets installed, so stale files must go
+    INSTALLCLEAN_PATTERNS = ["device/*", "vendor/*"]
+
+    def __init__(self, rom_path: str, device: str):
+        self.rom_path = rom_path
+        self.device = device
+
+    def decide(self, variant: str, out_dir: str, last_build: Optional[Dict],
+               current: Optional[ManifestSnapshot]) -> CleanDecision:
+        if not os.path.isdir(os.path.join(self.rom_path, out_dir)):
+            return CleanDecision("none", "no previous build output")
+        if last_build is None:
+            return CleanDecision("full", "no record of the previous build")
+        if last_build.get("device") != self.device:
+            return CleanDecision("installclean", f"device switch {last_build.get('device')} -> {self.device}")
+
+        decision = CleanDecision("none", "no relevant changes since the last build")
+        if last_build.get("variant") != variant:
+            decision = decision.merge(CleanDecision("installclean", f"variant switch {last_build.get('variant')} -> {variant}"))
+
+        if current is None or last_build.get("snapshot") is None:
+            return decision.merge(CleanDecision("installclean", "source changes since the last build are unknown"))
+
+        diff = ManifestSnapshot(last_build["snapshot"]).diff(current)
+        changed = diff.added + diff.removed + diff.moved
+        product_out = os.path.join(out_dir, "target/product", self.device)
+
+        toolchain = [path for path in changed if any(fnmatch.fnmatch(path, p) for p in self.FULL_CLEAN_PATTERNS)]
+        if toolchain:
+            return CleanDecision("full", f"toolchain/build system changed: {', '.join(toolchain[:5])}")
+
+        for pattern, subtrees in self.TARGETED_PATTERNS:
+            hits = [path for path in changed if fnmatch.fnmatch(path, pattern)]
+            if hits:
+                decision = decision.merge(CleanDecision(
+                    "targeted",
+                    f"{', '.join(hits[:5])} changed",
+                    [os.path.join(product_out, subtree) for subtree in subtrees]
+                ))
+
+        config = [path for path in changed if any(fnmatch.fnmatch(path, p) for p in self.INSTALLCLEAN_PATTERNS)
+                  and not any(fnmatch.fnmatch(path, p) for p, _ in self.TARGETED_PATTERNS)]
+        if config:
+            decision = decision.merge(CleanDecision("installclean", f"device/vendor trees changed: {', '.join(config[:5])}"))
+        return decision
+
+# Persistent build shell
+class BuildShell:
+    """Long-lived bash session with build/envsetup.sh sourced once.
+
+    Commands are written to the shell's stdin and followed by a unique
+    marker line carrying their exit code, so axion, lunch and m all run in
+    the same warm environment.
+    """
+
+    def __init__(self, rom_path: str, env: Optional[Dict[str, str]] = None):
+        self.rom_path = rom_path
+        self.env = env or {}
+        self.marker = f"__ROM_BUILDER_DONE_{os.getpid()}_{int(time.time())}__"
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self, consume: Callable[[Iterable[str]], Deque[str]]) -> Tuple[int, Deque[str]]:
+        """Start bash and source build/envsetup.sh"""
+        self.process = subprocess.Popen(
+            ["bash", "--noprofile", "--norc"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=self.rom_path,
+            env=dict(os.environ, **self.env),
+            universal_newlines=True,
+            errors="replace",
+            bufsize=1
+        )
+        return self.run("source build/envsetup.sh", consume)
+
+    def _read_until_marker(self, result: Dict[str, int]) -> Iterable[str]:
+        for line in self.process.stdout:
+            index = line.find(self.marker)
+            if index < 0:
+                yield line
+                continue
+            # Output without a trailing newline ends up in front of the marker
+            if index > 0:
+                yield line[:index] + "\n"
+            result["returncode"] = int(line[index + len(self.marker):].split()[0])
+            return
+
+    def run(self, cmd: str, consume: Callable[[Iterable[str]], Deque[str]]) -> Tuple[int, Deque[str]]:
+        """Run a command in the shell; consume() receives its output lines"""
+        if self.process is None or self.process.poll() is not None:
+            return 255, deque(["build shell is not running"])
+        # stdin is the command channel, so keep commands from reading it
+        self.process.stdin.write(f"{{ {cmd}\n}} < /dev/null\necho \"{self.marker} $?\"\n")
+        self.process.stdin.flush()
+        result = {"returncode": 255}
+        tail = consume(self._read_until_marker(result))
+        return result["returncode"], tail
+
+    def close(self) -> None:
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.write("exit\n")
+                self.process.stdin.flush()
+                self.process.wait(timeout=30)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+        self.process = None
+
+# Memory pressure watchdog
+@dataclass
+class ProcessInfo:
+    pid: int
+    ppid: int
+    name: str
+    state: str
+    rss: int
+
+def read_processes() -> Dict[int, ProcessInfo]:
+    """All processes from /proc/<pid>/stat"""
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    processes = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                data = f.read()
+        except OSError:
+            continue
+        # The name may contain spaces and parentheses, the fields after it do not
+        name = data[data.index("(") + 1:data.rindex(")")]
+        fields = data[data.rindex(")") + 2:].split()
+        processes[int(entry)] = ProcessInfo(int(entry), int(fields[1]), name, fields[0], int(fields[21]) * page_size)
+    return processes
+
+def process_tree(roots: Iterable[int], processes: Optional[Dict[int, ProcessInfo]] = None) -> List[ProcessInfo]:
+    """The given processes and all of their descendants"""
+    processes = processes if processes is not None else read_processes()
+    children: Dict[int, List[int]] = {}
+    for info in processes.values():
+        children.setdefault(info.ppid, []).append(info.pid)
+    tree = []
+    pending = [pid for pid in roots if pid in processes]
+    while pending:
+        pid = pending.pop()
+        tree.append(processes[pid])
+        pending.extend(children.get(pid, []))
+    return tree
+
+def read_memory_pressure() -> Tuple[float, Optional[float]]:
+    """Available memory in GiB and PSI 'full' avg10, None without PSI support"""
+    available = 0.0
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                available = int(line.split()[1]) / (1024 * 1024)
+                break
+    try:
+        with open("/proc/pressure/memory") as f:
+            for line in f:
+                if line.startswith("full"):
+                    return available, float(line.split()[1].partition("=")[2])
+    except (OSError, ValueError, IndexError):
+        pass
+    return available, None
+
+class MemoryWatchdog(threading.Thread):
+    """Pauses the largest compiler/Java processes of running builds under memory pressure.
+
+    While memory is short, the largest running candidate from
+    Config.WATCHDOG_PROCESSES is stopped with SIGSTOP each interval, so its
+    siblings can finish and free memory before the OOM killer picks ninja.
+    The last running candidate is never paused. Once memory recovers, or
+    after WATCHDOG_MAX_PAUSE, paused processes get SIGCONT in the order they
+    were paused. Every pause and resume is recorded in interventions.
+    """
+
+    def __init__(self, roots: Callable[[], List[int]]):
+        super().__init__(name="memory-watchdog", daemon=True)
+        self.roots = roots
+        self.paused: Dict[int, Tuple[ProcessInfo, float]] = {}
+        self.interventions: List[Dict[str, Any]] = []
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(Config.WATCHDOG_INTERVAL):
+            try:
+                self.check()
+            except OSError as e:
+                logger.warning(f"{Colors.YELLOW}Warning: memory watchdog: {e}{Colors.NC}")
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        for pid in list(self.paused):
+            self._resume(pid, "build finished")
+
+    def _record(self, action: str, info: ProcessInfo, reason: str) -> None:
+        available, psi = read_memory_pressure()
+        self.interventions.append({
+            "time": time.time(),
+            "action": action,
+            "pid": info.pid,
+            "process": info.name,
+            "rss_gb": round(info.rss / 1024 ** 3, 2),
+            "available_gb": round(available, 2),
+            "psi_full_avg10": psi,
+            "reason": reason
+        })
+        color = Colors.YELLOW if action == "pause" else Colors.GREEN
+        logger.info(f"{color}Memory watchdog: {action} {info.name} ({info.pid}, {info.rss / 1024 ** 3:.1f} GiB) - {reason}{Colors.NC}")
+
+    def _resume(self, pid: int, reason: str) -> None:
+        info, _ = self.paused.pop(pid)
+        try:
+            os.kill(pid, signal.SIGCONT)
+        except ProcessLookupError:
+            return
+        self._record("resume", info, reason)
+
+    def check(self) -> None:
+        available, psi = read_memory_pressure()
+        tree = process_tree(self.roots())
+        alive = {info.pid for info in tree}
+        for pid in [pid for pid in self.paused if pid not in alive]:
+            del self.paused[pid]
+
+        # Longest paused first
+        for pid, (_, paused_at) in sorted(self.paused.items(), key=lambda item: item[1][1]):
+            if time.time() - paused_at >= Config.WATCHDOG_MAX_PAUSE:
+                self._resume(pid, f"paused for {Config.WATCHDOG_MAX_PAUSE}s")
+                return
+
+        pressure = []
+        if available < Config.WATCHDOG_LOW_MEMORY_GB:
+            pressure.append(f"{available:.1f} GiB available")
+        if psi is not None and psi > Config.WATCHDOG_PSI_FULL:
+            pressure.append(f"PSI full avg10 {psi:.1f}%")
+        if pressure:
+            running = [info for info in tree if info.name in Config.WATCHDOG_PROCESSES
+                       and info.pid not in self.paused and info.state not in ("T", "Z")]
+            if len(running) < 2:
+                return
+            largest = max(running, key=lambda info: info.rss)
+            os.kill(largest.pid, signal.SIGSTOP)
+            self.paused[largest.pid] = (largest, time.time())
+            self._record("pause", largest, ", ".join(pressure))
+            return
+
+        recovered = available >= Config.WATCHDOG_RESUME_MEMORY_GB and (psi is None or psi < Config.WATCHDOG_PSI_RESUME)
+        if recovered and self.paused:
+            pid = min(self.paused, key=lambda pid: self.paused[pid][1])
+            self._resume(pid, f"{available:.1f} GiB available")
+
+# Build progress
+def format_seconds(seconds: float) -> str:
+    return f"{int(seconds)}s" if seconds < 60 else format_duration(seconds / 60)
+
+class NinjaProgress:
+    """Follows ninja status lines such as '[ 45% 61234/136000] ...' in build output.
+
+    A build runs several ninja invocations (soong bootstrap, kati, the main
+    graph); a new one starts whenever the count goes backwards, and progress
+    restarts with it. Ninja lowers the total of a running invocation as it
+    prunes actions whose inputs did not change, so that only updates it. Throughput is measured over
+    a sliding window. Progress is shown as a single redrawn line, or logged
+    periodically when that is not possible, and written as JSON lines to
+    events_path. Compiler errors and FAILED lines are always printed.
+    """
+
+    STATUS = re.compile(r"^\[\s*(\d+)% (\d+)/(\d+)[^\]]*\]\s?(.*)$")
+    ERROR = re.compile(r"^FAILED: |\berror:|^ninja: build stopped")
+
+    def __init__(self, step: str, events_path: str, bar: bool, prefix: str = ""):
+        self.step = step
+        self.events_path = events_path
+        self.bar = bar
+        self.prefix = prefix
+        self.stage = 0
+        self.done = 0
+        self.total = 0
+        self.actions = 0
+        self.started = time.time()
+        self.samples: Deque[Tuple[float, int]] = deque()
+        self.last_event = 0.0
+        self.last_log = time.time()
+        self.bar_shown = False
+
+    def rate(self) -> float:
+        if len(self.samples) < 2:
+            return 0.0
+        (t0, done0), (t1, done1) = self.samples[0], self.samples[-1]
+        return (done1 - done0) / (t1 - t0) if t1 > t0 else 0.0
+
+    def eta(self) -> Optional[float]:
+        rate = self.rate()
+        return (self.total - self.done) / rate if rate > 0 else None
+
+    def feed(self, line: str) -> None:
+        match = self.STATUS.match(line)
+        if not match:
+            if self.ERROR.search(line):
+                self._clear_bar()
+                sys.stdout.write(f"{self.prefix}{line}\n")
+                sys.stdout.flush()
+            return
+
+        now = time.time()
+        done, total = int(match.group(2)), int(match.group(3))
+        new_stage = self.stage == 0 or done < self.done
+        if new_stage:
+            self.stage += 1
+            self.samples.clear()
+            self.actions += done
+        else:
+            self.actions += done - self.done
+        self.done, self.total = done, total
+        self.samples.append((now, done))
+        while len(self.samples) > 2 and now - self.samples[0][0] > Config.PROGRESS_RATE_WINDOW:
+            self.samples.popleft()
+        self._event(now, force=new_stage)
+        self._show(now, match.group(4))
+
+    def _status(self) -> str:
+        percent = self.done / self.total if self.total else 0.0
+        eta = self.eta()
+        return (f"{self.prefix}stage {self.stage} {percent:6.1%} {self.done}/{self.total} "
+                f"{self.rate():.0f} actions/s ETA {format_seconds(eta) if eta is not None else '?'}")
+
+    def _show(self, now: float, action: str) -> None:
+        if self.bar:
+            filled = int(Config.PROGRESS_BAR_WIDTH * self.done / self.total) if self.total else 0
+            bar = "#" * filled + "-" * (Config.PROGRESS_BAR_WIDTH - filled)
+            width = shutil.get_terminal_size().columns
+            sys.stdout.write(f"\r[{bar}] {self._status()} {action}"[:width - 1].ljust(width - 1))
+            sys.stdout.flush()
+            self.bar_shown = True
+        elif now - self.last_log >= Config.PROGRESS_LOG_INTERVAL:
+            self.last_log = now
+            logger.info(f"{Colors.CYAN}{self._status()}{Colors.NC}")
+
+    def _clear_bar(self) -> None:
+        if self.bar_shown:
+            sys.stdout.write("\r" + " " * (shutil.get_terminal_size().columns - 1) + "\r")
+            self.bar_shown = False
+
+    def _event(self, now: float, force: bool = False) -> None:
+        if not force and now - self.last_event < Config.PROGRESS_EVENT_INTERVAL:
+            return
+        self.last_event = now
+        eta = self.eta()
+        event = {
+            "time": round(now, 3), "step": self.step, "stage": self.stage,
+            "done": self.done, "total": self.total, "rate": round(self.rate(), 2),
+            "eta_s": round(eta) if eta is not None else None
+        }
+        with open(self.events_path, "a") as f:
+            f.write(json.dumps(event) + "\n")
+
+    def finish(self) -> Dict[str, Any]:
+        """End the progress line and return totals for the run summary"""
+        self._clear_bar()
+        self._event(time.time(), force=True)
+        elapsed = time.time() - self.started
+        return {
+            "stages": self.stage,
+            "actions": self.actions,
+            "actions_per_s": round(self.actions / elapsed, 2) if elapsed > 0 else 0.0,
+            "events": self.events_path
+        }
+
+# Ninja log analysis
+# Soong variant directory names under .intermediates, e.g. android_arm64_armv8-a_shared
+SOONG_VARIANT_PREFIXES = ("android_", "linux_", "linux-", "windows_", "darwin_", "common")
+
+def module_for_directory(directory: str) -> Tuple[str, Optional[str]]:
+    """Module name and source directory for the directory of a build output"""
+    parts = directory.split("/")
+    if ".intermediates" in parts:
+        rest = parts[parts.index(".intermediates") + 1:]
+        for index in range(1, len(rest)):
+            if rest[index].startswith(SOONG_VARIANT_PREFIXES):
+                return rest[index - 1], "/".join(rest[:index - 1])
+        return "/".join(rest) or "(soong)", None
+    if "obj" in parts:
+        # Make modules: obj/<CLASS>/<module>_intermediates/...
+        rest = parts[parts.index("obj") + 1:]
+        if len(rest) >= 2 and rest[1].endswith("_intermediates"):
+            return rest[1][:-len("_intermediates")], None
+    if len(parts) > 4 and parts[1:3] == ["target", "product"]:
+        return f"(install {parts[4]})", None
+    return f"({parts[1] if len(parts) > 1 else directory})", None
+
+def read_ninja_log(path: str) -> Iterator[Optional[Tuple[int, int, str]]]:
+    """Stream (start_ms, end_ms, output) per action of a .ninja_log.
+
+    Yields None where a new ninja run starts. Actions with several outputs
+    are logged once per output with the same times and command hash; only
+    the first output is yielded.
+    """
+    last_end = -1
+    previous: Optional[Tuple[int, int, str]] = None
+    with open(path, errors="replace") as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t", 4)
+            if len(fields) < 5:
+                continue
+            try:
+                start, end = int(fields[0]), int(fields[1])
+            except ValueError:
+                continue
+            if end < last_end - Config.NINJA_RESTART_SLACK_MS:
+                yield None
+                previous = None
+                last_end = end
+            last_end = max(last_end, end)
+            key = (start, end, fields[4])
+            if key == previous:
+                continue
+            previous = key
+            yield start, end, fields[3]
+
+class NinjaLogAnalyzer:
+    """Streams a .ninja_log and summarizes the last build recorded in it.
+
+    Ninja appends one line per output as actions finish, so end times only
+    go backwards where a new ninja run starts; everything before the last
+    such point is discarded. Lines of the same action (several outputs)
+    are merged. Memory stays bounded by the number of modules and the
+    build's duration: the slowest actions are kept in a heap, and for the
+    critical path only the longest action ending in each time bucket is
+    remembered. The path is then walked backwards from the last action to
+    the one ending closest before its start, which approximates the chain
+    of dependent actions without the dependency graph.
+    """
+
+    def __init__(self, project_paths: Optional[Set[str]] = None, top: int = Config.NINJA_TOP_ACTIONS,
+                 min_span_ms: Optional[int] = None):
+        self.project_paths = project_paths or set()
+        self.top = top
+        # Actions of at least this duration are kept in spans, for the run trace
+        self.min_span_ms = min_span_ms
+
+    def _reset(self) -> None:
+        self.actions = 0
+        self.first_start: Optional[int] = None
+        self.last_end = 0
+        self.total_ms = 0
+        self.slowest: List[Tuple[int, int, int, str]] = []
+        self.modules: Dict[str, List] = {}
+        self._directories: Dict[str, str] = {}
+        self.spans: List[Tuple[int, int, str]] = []
+        self.buckets: Dict[int, Tuple[int, int, str]] = {}
+
+    def _add(self, start: int, end: int, output: str) -> None:
+        duration = end - start
+        self.actions += 1
+        self.total_ms += duration
+        self.first_start = start if self.first_start is None else min(self.first_start, start)
+        self.last_end = max(self.last_end, end)
+
+        entry = (duration, start, end, output)
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+        directory = output.rpartition("/")[0]
+        module = self._directories.get(directory)
+        if module is None:
+            if len(self._directories) >= 1 << 16:
+                # Keep the lookup cache bounded on huge trees
+                self._directories.clear()
+            module, source = module_for_directory(directory)
+            self._directories[directory] = module
+            if module not in self.modules:
+                project = source and (project_for_path(source, self.project_paths) or source)
+                self.modules[module] = [0, 0, source, project]
+        stats = self.modules[module]
+        stats[0] += duration
+        stats[1] += 1
+
+        if self.min_span_ms is not None and duration >= self.min_span_ms:
+            self.spans.append((start, end, output))
+
+        bucket = end // Config.NINJA_PATH_BUCKET_MS
+        kept = self.buckets.get(bucket)
+        if kept is None or duration > kept[1] - kept[0]:
+            self.buckets[bucket] = (start, end, output)
+
+    def _critical_path(self) -> List[Tuple[int, int, str]]:
+        if not self.buckets:
+            return []
+        last = max(self.buckets)
+        path = [self.buckets[last]]
+        while True:
+            start = path[-1][0]
+            previous = None
+            for bucket in range(start // Config.NINJA_PATH_BUCKET_MS, -1, -1):
+                kept = self.buckets.get(bucket)
+                # Zero-length actions end where they start; only earlier
+                # starts move the walk back
+                if kept is not None and kept[1] <= start and kept[0] < start:
+                    previous = kept
+                    break
+            if previous is None:
+                break
+            path.append(previous)
+        return path[::-1]
+
+    def analyze(self, path: str) -> Optional[Dict[str, Any]]:
+        if not os.path.isfile(path):
+            return None
+        self._reset()
+        runs = 1
+        for action in read_ninja_log(path):
+            if action is None:
+                # Only the last ninja run counts
+                self._reset()
+                runs += 1
+            else:
+                self._add(*action)
+        if not self.actions:
+            return None
+
+        wall_ms = self.last_end - (self.first_start or 0)
+        critical = self._critical_path()
+        modules = sorted(self.modules.items(), key=lambda item: item[1][0], reverse=True)
+        projects: Dict[str, List[int]] = {}
+        for stats in self.modules.values():
+            if stats[3] is not None:
+                totals = projects.setdefault(stats[3], [0, 0])
+                totals[0] += stats[0]
+                totals[1] += stats[1]
+        return {
+            "log": path,
+            "ninja_runs": runs,
+            "actions": self.actions,
+            "wall_ms": wall_ms,
+            "action_ms": self.total_ms,
+            "parallelism": round(self.total_ms / wall_ms, 2) if wall_ms else 0.0,
+            "slowest": [{"output": output, "start_ms": start, "duration_ms": duration}
+                        for duration, start, _, output in sorted(self.slowest, reverse=True)],
+            "modules": [{"module": name, "dir": stats[2], "project": stats[3], "ms": stats[0], "actions": stats[1]}
+                        for name, stats in modules[:Config.NINJA_TOP_MODULES]],
+            "projects": [{"project": name, "ms": stats[0], "actions": stats[1]}
+                         for name, stats in sorted(projects.items(), key=lambda item: item[1][0], reverse=True)],
+            "critical_path": {
+                "actions_ms": sum(end - start for start, end, _ in critical),
+                "steps": [{"output": output, "start_ms": start, "duration_ms": end - start}
+                          for start, end, output in critical]
+            }
+        }
+
+# Phase timing
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    """CPU time of a process and of the children it has waited for"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            data = f.read()
+    except OSError:
+        return None
+    fields = data[data.rindex(")") + 2:].split()
+    return sum(int(value) for value in fields[11:15]) / os.sysconf("SC_CLK_TCK")
+
+class PhaseTimer:
+    """Wall time, CPU time and peak RSS of each phase of a run.
+
+    Phases that run in a build shell are measured through the shell's
+    /proc entry: commands are its children, so their CPU time ends up in
+    its cutime/cstime once they exit. Other phases use getrusage for this
+    thread and for reaped children. Peak RSS is the largest sampled sum of
+    RSS over the phase's process tree.
+    """
+
+    def __init__(self):
+        self.phases: List[Dict[str, Any]] = []
+        self.active: List[Tuple[Dict[str, Any], Callable[[], Optional[int]], bool]] = []
+        self.lock = threading.Lock()
+        self.sampler: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    @staticmethod
+    def _own_cpu() -> float:
+        thread = resource.getrusage(resource.RUSAGE_THREAD)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return thread.ru_utime + thread.ru_stime + children.ru_utime + children.ru_stime
+
+    @staticmethod
+    def _tree_rss(pid: Optional[int], children: bool) -> int:
+        if pid is None:
+            return 0
+        tree = process_tree([pid])
+        if not children:
+            tree = tree[:1]
+        return sum(info.rss for info in tree)
+
+    def _sample(self) -> None:
+        with self.lock:
+            active = list(self.active)
+        for record, root, children in active:
+            rss = self._tree_rss(root(), children)
+            record["peak_rss_mb"] = max(record["peak_rss_mb"], rss // (1024 * 1024))
+
+    def _run_sampler(self) -> None:
+        while not self.stopped.wait(Config.PHASE_SAMPLE_INTERVAL):
+            self._sample()
+
+    @contextmanager
+    def measure(self, name: str, variant: Optional[str] = None, fastboot: bool = False,
+                shell: Optional[Callable[[], Optional[int]]] = None, children: bool = True,
+                **details: Any) -> Iterator[Dict[str, Any]]:
+        """Time a phase. shell returns the pid of the build shell the phase runs in."""
+        record: Dict[str, Any] = {
+            "name": name, "variant": variant, "fastboot": fastboot, "ok": True,
+            "start": time.time(), "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": 0
+        }
+        record.update(details)
+        root = shell or os.getpid
+        start_pid = root() if shell else None
+        start_cpu = (process_cpu_seconds(start_pid) or 0.0) if shell else self._own_cpu()
+        entry = (record, root, children)
+        with self.lock:
+            self.phases.append(record)
+            self.active.append(entry)
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self._run_sampler, name="phase-sampler", daemon=True)
+                self.sampler.start()
+        self._sample()
+        try:
+            yield record
+        except BaseException:
+            record["ok"] = False
+            raise
+        finally:
+            self._sample()
+            with self.lock:
+                self.active.remove(entry)
+            record["wall_s"] = round(time.time() - record["start"], 3)
+            if shell:
+                end_pid = root()
+                # A shell started during the phase counts from zero
+                start = start_cpu if start_pid == end_pid else 0.0
+                end = process_cpu_seconds(end_pid) if end_pid else None
+                record["cpu_s"] = round(end - start, 3) if end is not None else None
+            else:
+                record["cpu_s"] = round(self._own_cpu() - start_cpu, 3)
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+# Run trace
+class ResourceSampler(threading.Thread):
+    """Samples host CPU, memory and disk I/O from /proc for the run trace"""
+
+    def __init__(self):
+        super().__init__(name="resource-sampler", daemon=True)
+        self.samples: List[Tuple[float, Dict[str, float], Dict[str, float], Dict[str, float]]] = []
+        self.stopped = threading.Event()
+        self._last: Optional[Tuple[float, List[int], Tuple[int, int]]] = None
+
+    @staticmethod
+    def _cpu_times() -> List[int]:
+        with open("/proc/stat") as f:
+            return [int(value) for value in f.readline().split()[1:]]
+
+    @staticmethod
+    def _disk_sectors() -> Tuple[int, int]:
+        """Sectors read and written by the host's physical disks"""
+        disks = {name for name in os.listdir("/sys/block") if not name.startswith(Config.TRACE_IGNORED_DISKS)}
+        read = written = 0
+        with open("/proc/diskstats") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 9 and fields[2] in disks:
+                    read += int(fields[5])
+                    written += int(fields[9])
+        return read, written
+
+    @staticmethod
+    def _memory() -> Dict[str, float]:
+        values = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, _, rest = line.partition(":")
+                if name in ("MemTotal", "MemAvailable", "SwapTotal", "SwapFree"):
+                    values[name] = int(rest.split()[0]) / (1024 * 1024)
+        return {
+            "used_gb": round(values.get("MemTotal", 0.0) - values.get("MemAvailable", 0.0), 2),
+            "available_gb": round(values.get("MemAvailable", 0.0), 2),
+            "swap_used_gb": round(values.get("SwapTotal", 0.0) - values.get("SwapFree", 0.0), 2)
+        }
+
+    def sample(self) -> None:
+        now = time.time()
+        cpu = self._cpu_times()
+        disk = self._disk_sectors()
+        last, self._last = self._last, (now, cpu, disk)
+        if last is None:
+            return
+        ticks = [current - previous for current, previous in zip(cpu, last[1])]
+        total = sum(ticks[:8]) or 1
+        # user+nice, system+irq+softirq, iowait
+        cpu_percent = {
+            "user": round(100 * (ticks[0] + ticks[1]) / total, 1),
+            "system": round(100 * (ticks[2] + ticks[5] + ticks[6]) / total, 1),
+            "iowait": round(100 * ticks[4] / total, 1)
+        }
+        seconds = (now - last[0]) or 1
+        disk_rate = {
+            "read_mb_s": round((disk[0] - last[2][0]) * 512 / 1024 ** 2 / seconds, 1),
+            "write_mb_s": round((disk[1] - last[2][1]) * 512 / 1024 ** 2 / seconds, 1)
+        }
+        self.samples.append((now, cpu_percent, self._memory(), disk_rate))
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.sample()
+            except (OSError, ValueError, IndexError) as e:
+                logger.warning(f"{Colors.YELLOW}Warning: resource sampler stopped: {e}{Colors.NC}")
+                return
+            if self.stopped.wait(Config.TRACE_SAMPLE_INTERVAL):
+                return
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+def read_repo_event_log(path: str) -> List[Tuple[float, float, str, str, Dict[str, Any]]]:
+    """(start, finish, project path, task, details) per entry of 'repo --event-log'"""
+    spans = []
+    if not os.path.isfile(path):
+        return spans
+    with open(path, errors="replace") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+                start, finish = float(event["start"]), float(event["finish"])
+            except (ValueError, KeyError, TypeError):
+                continue
+            details = {key: event[key] for key in ("project", "revision", "success", "try") if key in event}
+            spans.append((start, finish, event.get("name", "?"), event.get("task_name", "repo"), details))
+    return spans
+
+class RunTrace:
+    """Chrome trace event file of a run, viewable in Perfetto or chrome://tracing.
+
+    Each source becomes a process: the builder's phases with one thread per
+    build lane, repo sync and every ninja log with spans packed onto as few
+    threads as overlap allows, and the host resource counters. Timestamps
+    are microseconds since the start of the run.
+    """
+
+    def __init__(self, origin: float):
+        self.origin = origin
+        self.events: List[Dict[str, Any]] = []
+        self.processes = 0
+
+    def _ts(self, seconds: float) -> int:
+        return int((seconds - self.origin) * 1_000_000)
+
+    def _process(self, name: str) -> int:
+        self.processes += 1
+        self.events.append({"ph": "M", "name": "process_name", "pid": self.processes, "args": {"name": name}})
+        self.events.append({"ph": "M", "name": "process_sort_index", "pid": self.processes, "args": {"sort_index": self.processes}})
+        return self.processes
+
+    def _thread(self, pid: int, tid: int, name: str) -> None:
+        self.events.append({"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, "args": {"name": name}})
+
+    def add_phases(self, phases: List[Dict[str, Any]]) -> None:
+        pid = self._process("rom-builder")
+        threads: Dict[str, int] = {}
+        for phase in phases:
+            lane = phase.get("lane") or "main"
+            if lane not in threads:
+                threads[lane] = len(threads) + 1
+                self._thread(pid, threads[lane], lane)
+            label = phase["name"] + (f" ({phase['variant']}{', fastboot' if phase['fastboot'] else ''})" if phase["variant"] else "")
+            self.events.append({
+                "ph": "X", "name": label, "cat": "phase", "pid": pid, "tid": threads[lane],
+                "ts": self._ts(phase["start"]), "dur": int(phase["wall_s"] * 1_000_000),
+                "args": {key: value for key, value in phase.items() if key not in ("name", "start", "wall_s")}
+            })
+
+    def add_spans(self, process: str, spans: Iterable[Tuple[float, float, str, str, Dict[str, Any]]]) -> None:
+        """Add (start, end, name, category, args) spans, each thread holding non-overlapping ones"""
+        pid = self._process(process)
+        free: List[Tuple[float, int]] = []
+        threads = 0
+        for start, end, name, category, args in sorted(spans):
+            if free and free[0][0] <= start:
+                _, tid = heapq.heappop(free)
+            else:
+                threads += 1
+                tid = threads
+                self._thread(pid, tid, f"{process} {tid}")
+            heapq.heappush(free, (end, tid))
+            self.events.append({
+                "ph": "X", "name": name, "cat": category, "pid": pid, "tid": tid,
+                "ts": self._ts(start), "dur": int((end - start) * 1_000_000), "args": args
+            })
+
+    def add_counters(self, samples: List[Tuple[float, Dict[str, float], Dict[str, float], Dict[str, float]]]) -> None:
+        pid = self._process("host")
+        for sample_time, cpu, memory, disk in samples:
+            ts = self._ts(sample_time)
+            self.events.append({"ph": "C", "name": "CPU %", "pid": pid, "ts": ts, "args": cpu})
+            self.events.append({"ph": "C", "name": "Memory GiB", "pid": pid, "ts": ts, "args": memory})
+            self.events.append({"ph": "C", "name": "Disk MiB/s", "pid": pid, "ts": ts, "args": disk})
+
+    def write(self, path: str, metadata: Dict[str, Any]) -> None:
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms", "metadata": metadata}, f, separators=(",", ":"))
+
+# Concurrent build scheduling
+@dataclass
+class HostResources:
+    cpus: int
+    memory_total_gb: float
+    memory_available_gb: float
+    disk_free_gb: float
+    swap_free_gb: float = 0.0
+
+    @classmethod
+    def detect(cls, path: str) -> "HostResources":
+        meminfo = {}
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    name, _, value = line.partition(":")
+                    meminfo[name] = int(value.split()[0]) / (1024 * 1024)
+        except (OSError, ValueError, IndexError):
+            pass
+        total = meminfo.get("MemTotal", 0.0)
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        return cls(
+            cpus=os.cpu_count() or 4,
+            memory_total_gb=total,
+            memory_available_gb=meminfo.get("MemAvailable", total),
+            disk_free_gb=shutil.disk_usage(path).free / 1024 ** 3,
+            swap_free_gb=meminfo.get("SwapFree", 0.0)
+        )
+
+class JobCalculator:
+    """Picks -j for builds from the host's memory, swap and CPUs.
+
+    The memory budget is the available RAM, capped at the total minus
+    HOST_RESERVED_MEMORY_GB, plus SWAP_USABLE_FRACTION of the free swap.
+    It must hold BUILD_ANALYSIS_MEMORY_GB for every build running at the
+    same time, since their analysis runs together. Analysis is over before
+    actions run, so for -j each build only keeps BUILD_NINJA_MEMORY_GB and
+    the rest is split into BUILD_THREAD_MEMORY_GB per parallel action.
+    """
+
+    def __init__(self, resources: HostResources):
+        self.resources = resources
+
+    def budget_gb(self) -> float:
+        ram = min(self.resources.memory_available_gb,
+                  self.resources.memory_total_gb - Config.HOST_RESERVED_MEMORY_GB)
+        return max(0.0, ram) + self.resources.swap_free_gb * Config.SWAP_USABLE_FRACTION
+
+    def jobs(self, builds: int = 1) -> int:
+        """-j for each of the given number of simultaneous builds, 0 when they do not fit"""
+        if self.budget_gb() < builds * Config.BUILD_ANALYSIS_MEMORY_GB:
+            return 0
+        budget = self.budget_gb() - builds * Config.BUILD_NINJA_MEMORY_GB
+        threads = int(budget / Config.BUILD_THREAD_MEMORY_GB) // builds
+        return max(0, min(threads, self.resources.cpus // builds))
+
+    def describe(self, builds: int = 1) -> str:
+        r = self.resources
+        return (f"{r.memory_total_gb:.0f} GiB RAM, {r.memory_available_gb:.0f} GiB available, "
+                f"{r.swap_free_gb:.0f} GiB swap free, {r.cpus} CPUs: budget {self.budget_gb():.0f} GiB, "
+                f"{Config.BUILD_ANALYSIS_MEMORY_GB} GiB analysis, then {Config.BUILD_NINJA_MEMORY_GB} GiB per build "
+                f"+ {Config.BUILD_THREAD_MEMORY_GB} GiB per job"
+                f"{f' x {builds} builds' if builds > 1 else ''}")
+
+@dataclass
+class BuildLane:
+    """One build job: an output directory with its own build shell"""
+    name: str
+    out_dir: str
+    variants: List[str]
+    # -j for the lane's build commands, None leaves it to soong
+    jobs: Optional[int] = None
+    # Prepended to echoed output when several lanes build at once
+    prefix: str = ""
+    shell: Optional[BuildShell] = None
+    configured_variant: Optional[str] = None
+    baseline_env: Optional[Dict[str, str]] = None
+    applied_env: Set[str] = field(default_factory=set)
+
+class BuildScheduler:
+    """Decides whether variants build concurrently, and with how many threads.
+
+    Each concurrent job gets its own OUT_DIR. Variants build concurrently
+    when JobCalculator still gives every build MIN_CONCURRENT_BUILD_THREADS
+    and the new output directories fit on disk; the -j values then sum to
+    no more than the memory budget and the CPU count.
+    """
+
+    def __init__(self, resources: HostResources, rom_path: str):
+        self.resources = resources
+        self.rom_path = rom_path
+        self.calculator = JobCalculator(resources)
+        self.reason = ""
+
+    @staticmethod
+    def out_dir(index: int, variant: str) -> str:
+        # The first job keeps out/, so sequential and concurrent runs share its incremental state
+        return "out" if index == 0 else f"out-{variant}"
+
+    def disk_needed_gb(self, variants: List[str]) -> float:
+        needed = 0.0
+        for index, variant in enumerate(variants):
+            exists = os.path.isdir(os.path.join(self.rom_path, self.out_dir(index, variant)))
+            needed += Config.OUT_DIR_GROWTH_GB if exists else Config.OUT_DIR_DISK_GB
+        return needed
+
+    def schedule(self, variants: List[str], concurrent: bool) -> List[BuildLane]:
+        jobs = self.calculator.jobs(1)
+        if jobs == 0:
+            logger.warning(f"{Colors.YELLOW}Warning: {self.calculator.describe()} leaves no room for a build, "
+                           f"using -j1; expect the build to run out of memory{Colors.NC}")
+        sequential = [BuildLane("main", "out", list(variants), max(1, jobs))]
+        if len(variants) < 2:
+            self.reason = "single variant"
+            return sequential
+        if not concurrent:
+            self.reason = "concurrent builds disabled with --no-concurrent"
+            return sequential
+
+        threads = self.calculator.jobs(len(variants))
+        if threads < Config.MIN_CONCURRENT_BUILD_THREADS:
+            needed = len(variants) * max(Config.BUILD_ANALYSIS_MEMORY_GB, Config.BUILD_NINJA_MEMORY_GB
+                                         + Config.MIN_CONCURRENT_BUILD_THREADS * Config.BUILD_THREAD_MEMORY_GB)
+            self.reason = (f"{len(variants)} builds need {needed:.0f} GiB of memory and "
+                           f"{len(variants) * Config.MIN_CONCURRENT_BUILD_THREADS} CPUs, "
+                           f"budget {self.calculator.budget_gb():.0f} GiB and {self.resources.cpus} CPUs available")
+            return sequential
+        disk = self.disk_needed_gb(variants)
+        if disk > self.resources.disk_free_gb:
+            self.reason = f"{len(variants)} output directories need {disk:.0f} GiB of disk, {self.resources.disk_free_gb:.0f} GiB free"
+            return sequential
+
+        self.reason = f"budget {self.calculator.budget_gb():.0f} GiB, -j{threads} per build"
+        return [BuildLane(variant, self.out_dir(index, variant), [variant], threads, prefix=f"[{variant}] ")
+                for index, variant in enumerate(variants)]
+
+# Build history
+class BuildHistory:
+    """SQLite record of past runs and their phases, used for time estimates.
+
+    Estimates are the median duration of the last Config.HISTORY_SAMPLES
+    successful runs of a phase for the same ROM, device, variant and
+    fastboot pass, taken from this host when it has any. Samples from other
+    hosts are scaled by their CPU count for CPU-bound phases.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started REAL, finished REAL, wall_s REAL, result TEXT,
+            rom TEXT, device TEXT, variants TEXT, fastboot INTEGER,
+            host TEXT, cpus INTEGER, memory_gb REAL, report TEXT
+        );
+        CREATE TABLE IF NOT EXISTS phases (
+            run_id INTEGER REFERENCES runs(id),
+            name TEXT, variant TEXT, fastboot INTEGER, lane TEXT, jobs INTEGER,
+            clean_mode TEXT, ok INTEGER, start REAL, wall_s REAL, cpu_s REAL, peak_rss_mb INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS phases_lookup ON phases (name, variant, fastboot);
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.host = platform.node()
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.executescript(self.SCHEMA)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def record(self, report: Dict[str, Any], resources: HostResources, report_path: Optional[str]) -> int:
+        with self._connect() as conn:
+            run_id = conn.execute(
+                "INSERT INTO runs (started, finished, wall_s, result, rom, device, variants, fastboot, "
+                "host, cpus, memory_gb, report) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (report["started"], report["finished"], report["wall_s"], report["result"], report["rom"],
+                 report["device"], ",".join(report["variants"]), int(report["fastboot"]), self.host,
+                 resources.cpus, round(resources.memory_total_gb, 1), report_path)
+            ).lastrowid
+            archived = self._archive(run_id, report)
+            if archived is not None:
+                conn.execute("UPDATE runs SET report = ? WHERE id = ?", (archived, run_id))
+            conn.executemany(
+                "INSERT INTO phases (run_id, name, variant, fastboot, lane, jobs, clean_mode, ok, start, "
+                "wall_s, cpu_s, peak_rss_mb) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, phase["name"], phase["variant"], int(phase["fastboot"]), phase.get("lane"),
+                  phase.get("jobs"), phase.get("clean_mode"), int(phase["ok"]), phase["start"],
+                  phase["wall_s"], phase["cpu_s"], phase["peak_rss_mb"]) for phase in report["phases"]]
+            )
+        return run_id
+
+    def _archive(self, run_id: int, report: Dict[str, Any]) -> Optional[str]:
+        """Keep a copy of the run's reports and manifest snapshot.
+
+        The release directory names them by date, so a second run on the
+        same day overwrites them; the copies stay with the history row.
+        """
+        directory = os.path.join(os.path.dirname(self.path), "runs", str(run_id))
+        archived = dict(report)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            if report.get("manifest") and os.path.isfile(report["manifest"]):
+                archived["manifest"] = os.path.join(directory, "manifest.json")
+                shutil.copyfile(report["manifest"], archived["manifest"])
+            archived["ninja"] = {}
+            for step, path in report.get("ninja", {}).items():
+                if os.path.isfile(path):
+                    archived["ninja"][step] = os.path.join(directory, f"ninja-{step}.json")
+                    shutil.copyfile(path, archived["ninja"][step])
+            path = os.path.join(directory, "build.json")
+            with open(path, "w") as f:
+                json.dump(archived, f, indent=1)
+        except OSError as e:
+            logger.warning(f"{Colors.YELLOW}Warning: could not archive the reports of run {run_id}: {e}{Colors.NC}")
+            return None
+        return path
+
+    def runs(self, rom: str, device: str) -> int:
+        """Recorded successful runs of the ROM/device on this host"""
+        if not os.path.isfile(self.path):
+            return 0
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM runs WHERE rom = ? AND device = ? AND host = ? AND result = 'success'",
+                                (rom, device, self.host)).fetchone()[0]
+
+    def reports(self, rom: str, device: str, before: Optional[float] = None,
+                limit: int = Config.HISTORY_SAMPLES) -> List[Tuple[int, str]]:
+        """Run ids and build report paths of the latest successful runs, newest first"""
+        if not os.path.isfile(self.path):
+            return []
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT id, report FROM runs WHERE rom = ? AND device = ? AND result = 'success' "
+                "AND report IS NOT NULL AND started < ? ORDER BY started DESC LIMIT ?",
+                (rom, device, before if before is not None else float("inf"), limit)
+            ).fetchall()
+
+    def report_path(self, run_id: int) -> Optional[str]:
+        if not os.path.isfile(self.path):
+            return None
+        with self._connect() as conn:
+            row = conn.execute("SELECT report FROM runs WHERE id = ?", (run_id,)).fetchone()
+        return row[0] if row else None
+
+    def estimate(self, rom: str, device: str, name: str, variant: Optional[str] = None, fastboot: bool = False,
+                 clean_mode: Optional[str] = None, cpus: int = 1) -> Optional[Tuple[float, int]]:
+        """Median seconds of the phase and the number of samples, None without history"""
+        if not os.path.isfile(self.path):
+            return None
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT phases.wall_s, phases.clean_mode, runs.host, runs.cpus FROM phases "
+                "JOIN runs ON runs.id = phases.run_id "
+                "WHERE runs.rom = ? AND runs.device = ? AND phases.name = ? AND phases.variant IS ? "
+                "AND phases.fastboot = ? AND phases.ok = 1 ORDER BY phases.start DESC",
+                (rom, device, name, variant, int(fastboot))
+            ).fetchall()
+        if clean_mode is not None and any(row[1] == clean_mode for row in rows):
+            rows = [row for row in rows if row[1] == clean_mode]
+        local = [row for row in rows if row[2] == self.host]
+        if local:
+            durations = [row[0] for row in local]
+        elif name in Config.CPU_BOUND_PHASES:
+            durations = [row[0] * (row[3] or cpus) / cpus for row in rows]
+        else:
+            durations = [row[0] for row in rows]
+        durations = durations[:Config.HISTORY_SAMPLES]
+        if not durations:
+            return None
+        return statistics.median(durations), len(durations)
+
+# Build comparison
+@dataclass
+class TimingDelta:
+    """One phase, ninja action, module or project timed in both builds"""
+    kind: str
+    name: str
+    old_s: float
+    new_s: float
+    z: Optional[float] = None
+    project: Optional[str] = None
+    # The project's revision differs between the two builds
+    changed: bool = False
+
+    @property
+    def delta_s(self) -> float:
+        return self.new_s - self.old_s
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "kind": self.kind, "name": self.name, "old_s": round(self.old_s, 1), "new_s": round(self.new_s, 1),
+            "delta_s": round(self.delta_s, 1), "z": round(self.z, 1) if self.z is not None else None,
+            "project": self.project, "changed": self.changed
+        }
+
+class BuildComparison:
+    """Phase and ninja log differences between two recorded builds.
+
+    A difference counts when it clears both the relative and the absolute
+    minimum. With enough earlier runs (the baseline) the newer value must
+    also lie Config.COMPARE_Z robust standard deviations from their median,
+    so that normally noisy phases such as sync do not show up on every run.
+    Slowdowns are matched against the projects whose revisions changed
+    between the two builds' manifest snapshots.
+    """
+
+    def __init__(self, old: Dict[str, Any], new: Dict[str, Any], baseline: Iterable[Dict[str, Any]] = (),
+                 variant: Optional[str] = None):
+        self.old = old
+        self.new = new
+        self.baseline = list(baseline)
+        self.variant = variant
+        self._ninja_reports: Dict[str, Optional[Dict[str, Any]]] = {}
+
+    @staticmethod
+    def load_report(path: str) -> Dict[str, Any]:
+        with open(path) as f:
+            report = json.load(f)
+        report["path"] = path
+        return report
+
+    @staticmethod
+    def _significant(old: float, new: float, samples: List[float], min_delta: float) -> Tuple[bool, Optional[float]]:
+        delta = new - old
+        if abs(delta) < max(min_delta, Config.COMPARE_MIN_RATIO * old):
+            return False, None
+        if len(samples) < Config.COMPARE_MIN_SAMPLES:
+            return True, None
+        median = statistics.median(samples)
+        # 1.4826 * MAD estimates the standard deviation of normal noise; the
+        # floor keeps a perfectly stable history from flagging tiny changes
+        spread = max(1.4826 * statistics.median(abs(sample - median) for sample in samples),
+                     Config.COMPARE_MIN_RATIO * median / Config.COMPARE_Z, min_delta / Config.COMPARE_Z)
+        z = (new - median) / spread
+        return abs(z) >= Config.COMPARE_Z, z
+
+    def _wanted(self, variant: Optional[str]) -> bool:
+        return self.variant is None or variant is None or variant == self.variant
+
+    @staticmethod
+    def _phase_times(report: Dict[str, Any]) -> Dict[Tuple[str, Optional[str], bool], float]:
+        times: Dict[Tuple[str, Optional[str], bool], float] = {}
+        for phase in report.get("phases", []):
+            if phase["ok"]:
+                key = (phase["name"], phase["variant"], phase["fastboot"])
+                times[key] = times.get(key, 0.0) + phase["wall_s"]
+        return times
+
+    @staticmethod
+    def _clean_modes(report: Dict[str, Any]) -> Dict[str, str]:
+        return {variant: decision["mode"] for variant, decision in report.get("clean", {}).items()}
+
+    def _ninja(self, report: Dict[str, Any], step: str) -> Optional[Dict[str, Any]]:
+        """Analysis of the main ninja log of a build step, if it was kept"""
+        path = report.get("ninja", {}).get(step)
+        if path is None:
+            return None
+        if path not in self._ninja_reports:
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                logs = data["logs"]
+                self._ninja_reports[path] = logs.get(os.path.join(data["out_dir"], ".ninja_log")) or next(iter(logs.values()))
+            except (OSError, ValueError, KeyError, StopIteration):
+                self._ninja_reports[path] = None
+        return self._ninja_reports[path]
+
+    def changed_projects(self) -> Optional[ManifestDiff]:
+        old = ManifestSnapshot.load(self.old["manifest"]) if self.old.get("manifest") else None
+        new = ManifestSnapshot.load(self.new["manifest"]) if self.new.get("manifest") else None
+        if old is None or new is None:
+            return None
+        return old.diff(new)
+
+    def _phases(self) -> List[TimingDelta]:
+        old = self._phase_times(self.old)
+        new = self._phase_times(self.new)
+        history = [self._phase_times(report) for report in self.baseline]
+        deltas = []
+        for key in old.keys() & new.keys():
+            name, variant, fastboot = key
+            if not self._wanted(variant):
+                continue
+            samples = [times[key] for times in history if key in times]
+            significant, z = self._significant(old[key], new[key], samples, Config.COMPARE_MIN_PHASE_DELTA_S)
+            if significant:
+                label = name + (f" ({variant}{', fastboot' if fastboot else ''})" if variant else "")
+                deltas.append(TimingDelta("phase", label, old[key], new[key], z))
+        return deltas
+
+    def _ninja_entries(self, analysis: Dict[str, Any], kind: str) -> Tuple[Dict[str, Tuple[float, Optional[str]]], bool]:
+        """name -> (seconds, project) of one ninja list, and whether the list is complete"""
+        if kind == "action":
+            projects = {item["module"]: item.get("project") for item in analysis["modules"]}
+            entries = {item["output"]: (item["duration_ms"] / 1000,
+                                        projects.get(module_for_directory(item["output"].rpartition("/")[0])[0]))
+                       for item in analysis["slowest"]}
+            return entries, len(entries) < Config.NINJA_TOP_ACTIONS
+        if kind == "module":
+            entries = {item["module"]: (item["ms"] / 1000, item.get("project")) for item in analysis["modules"]}
+            return entries, len(entries) < Config.NINJA_TOP_MODULES
+        return {item["project"]: (item["ms"] / 1000, item["project"]) for item in analysis["projects"]}, True
+
+    def _ninja_deltas(self, step: str, changed: Set[str]) -> Dict[str, Any]:
+        old = self._ninja(self.old, step)
+        new = self._ninja(self.new, step)
+        if old is None or new is None:
+            return {}
+        history = [analysis for analysis in (self._ninja(report, step) for report in self.baseline) if analysis]
+        result: Dict[str, Any] = {
+            "wall": TimingDelta("ninja", "ninja wall time", old["wall_ms"] / 1000, new["wall_ms"] / 1000).to_dict(),
+            "critical_path": TimingDelta("ninja", "critical path", old["critical_path"]["actions_ms"] / 1000,
+                                         new["critical_path"]["actions_ms"] / 1000).to_dict(),
+            "action_count": {"old": old["actions"], "new": new["actions"]}
+        }
+        for kind in ("action", "module", "project"):
+            old_entries, old_complete = self._ninja_entries(old, kind)
+            new_entries, new_complete = self._ninja_entries(new, kind)
+            history_entries = [self._ninja_entries(analysis, kind)[0] for analysis in history]
+            deltas = []
+            for name in old_entries.keys() | new_entries.keys():
+                # Entries missing from a truncated list are unknown, not zero
+                if name not in old_entries and not old_complete or name not in new_entries and not new_complete:
+                    continue
+                old_s, project = old_entries.get(name, (0.0, None))
+                new_s, new_project = new_entries.get(name, (0.0, None))
+                project = project or new_project
+                samples = [entries[name][0] for entries in history_entries if name in entries]
+                significant, z = self._significant(old_s, new_s, samples, Config.COMPARE_MIN_ACTION_DELTA_S)
+                if significant:
+                    deltas.append(TimingDelta(kind, name, old_s, new_s, z, project, project in changed))
+            deltas.sort(key=lambda delta: abs(delta.delta_s), reverse=True)
+            result[f"{kind}s"] = [delta.to_dict() for delta in deltas]
+        return result
+
+    def compare(self) -> Dict[str, Any]:
+        warnings = []
+        for key in ("rom", "device"):
+            if self.old.get(key) != self.new.get(key):
+                warnings.append(f"different {key}: {self.old.get(key)} vs {self.new.get(key)}")
+        old_modes = self._clean_modes(self.old)
+        new_modes = self._clean_modes(self.new)
+        for variant in old_modes.keys() & new_modes.keys():
+            if self._wanted(variant) and old_modes[variant] != new_modes[variant]:
+                warnings.append(f"{variant}: {old_modes[variant]} build vs {new_modes[variant]} build")
+
+        diff = self.changed_projects()
+        changed = set(diff.added + diff.moved) if diff else set()
+        steps = {}
+        for step in sorted(self.old.get("ninja", {}).keys() & self.new.get("ninja", {}).keys()):
+            if self.variant is None or step.startswith(f"build-{self.variant}"):
+                steps[step] = self._ninja_deltas(step, changed)
+
+        # Changed projects ranked by how much build time their code gained
+        slower: Dict[str, float] = {}
+        for step in steps.values():
+            for delta in step.get("projects", []):
+                if delta["changed"] and delta["delta_s"] > 0:
+                    slower[delta["project"]] = slower.get(delta["project"], 0.0) + delta["delta_s"]
+        phases = sorted(self._phases(), key=lambda delta: abs(delta.delta_s), reverse=True)
+        return {
+            "old": {key: self.old.get(key) for key in ("path", "date", "started", "wall_s", "result")},
+            "new": {key: self.new.get(key) for key in ("path", "date", "started", "wall_s", "result")},
+            "baseline_runs": len(self.baseline),
+            "warnings": warnings,
+            "wall": TimingDelta("run", "wall", self.old.get("wall_s", 0.0), self.new.get("wall_s", 0.0)).to_dict(),
+            "phases": [delta.to_dict() for delta in phases],
+            "steps": steps,
+            "manifest": diff.to_dict() if diff else None,
+            "causes": [{"project": project, "delta_s": round(seconds, 1)}
+                       for project, seconds in sorted(slower.items(), key=lambda item: item[1], reverse=True)],
+            "global_changes": sorted(path for path in changed if path.startswith(Config.COMPARE_GLOBAL_PROJECTS))
+        }
+
+    @staticmethod
+    def log(result: Dict[str, Any]) -> None:
+        def line(delta: Dict[str, Any]) -> str:
+            color = Colors.RED if delta["delta_s"] > 0 else Colors.GREEN
+            z = f", z={delta['z']:+.1f}" if delta.get("z") is not None else ""
+            mark = " [changed]" if delta.get("changed") else ""
+            return (f"{color}{delta['delta_s']:+9.1f}s{Colors.NC}  {delta['name']} "
+                    f"({format_seconds(delta['old_s'])} -> {format_seconds(delta['new_s'])}{z}){mark}")
+
+        logger.info(f"{Colors.BLUE}=== Build comparison ==={Colors.NC}")
+        logger.info(f"{Colors.CYAN}Older:{Colors.NC} {result['old']['path']} ({result['old']['result']})")
+        logger.info(f"{Colors.CYAN}Newer:{Colors.NC} {result['new']['path']} ({result['new']['result']})")
+        logger.info(f"{Colors.CYAN}Run:{Colors.NC} {line(result['wall'])}, {result['baseline_runs']} earlier runs as baseline")
+        for warning in result["warnings"]:
+            logger.warning(f"{Colors.YELLOW}Warning: {warning}{Colors.NC}")
+        if result["manifest"] is not None:
+            manifest = result["manifest"]
+            logger.info(f"{Colors.CYAN}Manifest:{Colors.NC} {len(manifest['added'])} added, "
+                        f"{len(manifest['removed'])} removed, {len(manifest['moved'])} changed projects")
+        else:
+            logger.info(f"{Colors.CYAN}Manifest:{Colors.NC} no snapshot for one of the builds")
+
+        logger.info(f"{Colors.CYAN}Phases:{Colors.NC}" + ("" if result["phases"] else " no significant changes"))
+        for delta in result["phases"][:Config.COMPARE_TOP]:
+            logger.info(f"  {line(delta)}")
+        for step, data in result["steps"].items():
+            if not data:
+                logger.info(f"{Colors.CYAN}{step}:{Colors.NC} ninja log analysis missing in one of the builds")
+                continue
+            logger.info(f"{Colors.CYAN}{step}:{Colors.NC} {data['action_count']['old']} -> {data['action_count']['new']} actions")
+            logger.info(f"  {line(data['wall'])}")
+            logger.info(f"  {line(data['critical_path'])}")
+            for kind in ("projects", "modules", "actions"):
+                if data[kind]:
+                    logger.info(f"  {kind.capitalize()}:")
+                for delta in data[kind][:Config.COMPARE_TOP]:
+                    logger.info(f"    {line(delta)}")
+
+        if result["global_changes"]:
+            logger.info(f"{Colors.YELLOW}Changed build system/toolchain projects: {', '.join(result['global_changes'])}{Colors.NC}")
+        if result["causes"]:
+            logger.info(f"{Colors.YELLOW}Changed projects with slower builds:{Colors.NC}")
+            for cause in result["causes"][:Config.COMPARE_TOP]:
+                logger.info(f"  {Colors.RED}{cause['delta_s']:+9.1f}s{Colors.NC}  {cause['project']}")
+
 class RomBuilder:
     def __init__(self, options: BuildOptions):
         self.options = options
@@ -82,31 +2563,529 @@ class RomBuilder:
         self.home_dir = os.path.expanduser("~")
         self.rom_path = os.path.join(self.home_dir, self.rom_info.directory)
         self.release_dir = os.path.join(self.home_dir, f"{self.options.rom}-{self.options.device}-releases")
-        
+        self.log_dir = os.path.join(self.home_dir, "rom_build_logs", f"build_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+        self.step_counter = 0
+        self.state_dir = os.path.join(self.rom_path, ".repo", "rom-builder")
+        self.cache_dir = os.path.join(self.home_dir, ".cache", "rom-builder")
+        self.manifest_fetcher = ManifestFetcher(os.path.join(self.cache_dir, "manifests"))
+        self.sync_tuner = SyncTuner(os.path.join(self.cache_dir, "sync-tuning.json"), os.cpu_count() or 4)
+
+        # Shared object store used as 'repo init --reference'
+        self.mirror = MirrorStore(self.options.mirror_dir, self.run_command) if self.options.mirror_dir else None
+
+        # Clone depth / partial clone settings per project group
+        try:
+            self.sync_profile = SyncProfile.load(self.options.sync_profile)
+        except (OSError, ValueError) as e:
+            logger.error(f"{Colors.RED}Error: invalid sync profile '{self.options.sync_profile}': {e}{Colors.NC}")
+            sys.exit(1)
+
+        # Manifest slimming rules for this ROM/device
+        try:
+            self.slimmer = ManifestSlimmer.load(self.options.slim_rules, self.options.rom, self.options.device)
+        except (OSError, ValueError) as e:
+            logger.error(f"{Colors.RED}Error: invalid slim rules '{self.options.slim_rules}': {e}{Colors.NC}")
+            sys.exit(1)
+
+        # Build jobs, each with a persistent shell started on first use
+        self.lanes: List[BuildLane] = []
+        self.env_cache = EnvCache(os.path.join(self.state_dir, "env"), self.rom_path)
+        # Guards the step counter and files shared by concurrent lanes
+        self.state_lock = threading.Lock()
+        self.ccache: Optional[CcacheManager] = None
+        # Decisions and measurements reported at the end of the run
+        self.summary: Dict[str, Any] = {"clean": {}, "ccache": {}}
+        self.clean_policy = CleanPolicy(self.rom_path, self.options.device)
+
+        self.timer = PhaseTimer()
+        # Sources of the run trace besides the phases
+        self.sampler = ResourceSampler()
+        self.repo_event_logs: List[str] = []
+        self.trace_spans: List[Tuple[str, List[Tuple[float, float, str, str, Dict[str, Any]]]]] = []
+        self.history = BuildHistory(os.path.join(self.cache_dir, "history.db"))
+        self.resources: Optional[HostResources] = None
+        # Estimated minutes of the plan steps that have not finished yet
+        self.pending: Dict[str, Tuple[str, float]] = {}
+
+        # Start time of the regular build of each variant in this run
+        self.build_started: Dict[str, float] = {}
+
+        # Projects that changed in the last sync, if known
+        self.manifest_diff: Optional[ManifestDiff] = None
+
+        # --plan and --estimate only read; they leave no directories or logs behind
+        if self.options.plan_only or self.options.estimate_only:
+            return
+
         # Ensure release directory exists
         os.makedirs(self.release_dir, exist_ok=True)
 
-    def run_command(self, cmd: str, cwd: Optional[str] = None) -> Tuple[int, str, str]:
-        """Run a shell command and return its exit code, stdout and stderr"""
+        # Keep a copy of the builder's own messages next to the step logs
+        os.makedirs(self.log_dir, exist_ok=True)
+        file_handler = logging.FileHandler(f"{self.log_dir}.log")
+        file_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        logger.addHandler(file_handler)
+
+    def _repo_event_log(self) -> str:
+        """Event log for the next repo invocation; repo overwrites the file it is given"""
+        with self.state_lock:
+            path = os.path.join(self.log_dir, f"repo-events-{len(self.repo_event_logs) + 1:03d}.jsonl")
+            self.repo_event_logs.append(path)
+        return path
+
+    def _step_log_path(self, step: str) -> str:
+        """Path of the log file for the next command step"""
+        with self.state_lock:
+            self.step_counter += 1
+            counter = self.step_counter
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "-", step).strip("-")[:60] or "step"
+        os.makedirs(self.log_dir, exist_ok=True)
+        return os.path.join(self.log_dir, f"{counter:03d}-{name}.log")
+
+    def _stream_output(self, lines: Iterable[str], log_path: str,
+                       on_line: Optional[Callable[[str], None]] = None, echo: bool = True,
+                       prefix: str = "") -> Deque[str]:
+        """Tee output lines to a log file and the console, keeping only the tail in memory"""
+        tail: Deque[str] = deque(maxlen=Config.OUTPUT_TAIL_LINES)
+        with open(log_path, "a", errors="replace") as log_file:
+            for line in lines:
+                log_file.write(line)
+                if echo:
+                    sys.stdout.write(prefix + line)
+                    sys.stdout.flush()
+                line = line.rstrip("\n")
+                tail.append(line)
+                if on_line:
+                    on_line(line)
+        return tail
+
+    def _log_failure(self, returncode: int, tail: Deque[str], log_path: str) -> None:
+        logger.info(f"{Colors.RED}Command failed with exit code {returncode}{Colors.NC}")
+        summary = list(tail)[-Config.ERROR_SUMMARY_LINES:]
+        if summary:
+            logger.info(f"{Colors.RED}Last {len(summary)} lines of output:{Colors.NC}")
+            for line in summary:
+                logger.info(f"{Colors.RED}  {line}{Colors.NC}")
+        logger.info(f"{Colors.RED}Full log: {log_path}{Colors.NC}")
+
+    def run_command(self, cmd: str, cwd: Optional[str] = None, step: Optional[str] = None,
+                    on_line: Optional[Callable[[str], None]] = None, echo: bool = True) -> Tuple[int, str, str]:
+        """Run a shell command and return its exit code, output tail and stderr.
+
+        Output is streamed line by line to a per-step log file and the
+        console. stderr is merged into stdout, and only the last
+        Config.OUTPUT_TAIL_LINES lines are returned, so memory stays flat
+        regardless of how much the command prints.
+        """
         logger.info(f"{Colors.YELLOW}Running: {cmd}{Colors.NC}")
+        log_path = self._step_log_path(step or " ".join(cmd.split()[:2]))
         
         process = subprocess.Popen(
             cmd, 
             shell=True, 
             stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
             cwd=cwd,
-            universal_newlines=True
+            universal_newlines=True,
+            errors="replace"
         )
         
-        stdout, stderr = process.communicate()
+        tail = self._stream_output(process.stdout, log_path, on_line, echo)
+        returncode = process.wait()
+        
+        if returncode != 0:
+            self._log_failure(returncode, tail, log_path)
+        
+        return returncode, "\n".join(tail), ""
+
+    def _device_manifest_url(self) -> Optional[str]:
+        """Return the local manifest URL for the selected ROM/device combination"""
+        return Config.DEVICE_MANIFESTS.get((self.options.rom, self.options.device))
+
+    def _reset_local_manifests(self) -> str:
+        """Create an empty .repo/local_manifests directory and return its path"""
+        local_manifests_dir = os.path.join(self.rom_path, ".repo/local_manifests")
+        if os.path.isdir(local_manifests_dir):
+            for item in os.listdir(local_manifests_dir):
+                item_path = os.path.join(local_manifests_dir, item)
+                if os.path.isfile(item_path):
+                    os.remove(item_path)
+        else:
+            os.makedirs(local_manifests_dir, exist_ok=True)
+        return local_manifests_dir
+
+    def _read_manifest_config(self, key: str) -> Optional[str]:
+        """Read a git config value from the checkout's manifest repository"""
+        config_path = os.path.join(self.rom_path, ".repo/manifests.git/config")
+        if not os.path.isfile(config_path):
+            return None
+        result = subprocess.run(
+            ["git", "config", "--file", config_path, "--get", key],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True
+        )
+        if result.returncode != 0:
+            return None
+        return result.stdout.strip()
+
+    def _manifest_matches(self) -> bool:
+        """Check whether the existing checkout was initialized from our manifest URL and branch"""
+        url = self._read_manifest_config("remote.origin.url")
+        merge = self._read_manifest_config("branch.default.merge")
+        if url is None or merge is None:
+            return False
+        branch = merge[len("refs/heads/"):] if merge.startswith("refs/heads/") else merge
+        reference = self._read_manifest_config("repo.reference") or None
+        expected_reference = self.mirror.path if self.mirror else None
+        partial_clone = self._read_manifest_config("repo.partialclone") == "true"
+        expected_partial_clone = bool(self.sync_profile and self.sync_profile.uses_partial_clone())
+        return (url.rstrip("/") == self.rom_info.manifest_url.rstrip("/")
+                and branch == self.rom_info.branch
+                and reference == expected_reference
+                and partial_clone == expected_partial_clone)
+
+    def _prepare_checkout(self) -> bool:
+        """Prepare the source directory for a sync, keeping .repo/ whenever possible"""
+        repo_dir = os.path.join(self.rom_path, ".repo")
+        if self.options.full_sync and os.path.isdir(self.rom_path):
+            logger.info(f"{Colors.YELLOW}Removing existing directory: {self.rom_path}{Colors.NC}")
+            with self.timer.measure("rmtree"):
+                shutil.rmtree(self.rom_path)
+
+        if os.path.isdir(repo_dir) and self._manifest_matches():
+            logger.info(f"{Colors.GREEN}Refreshing existing checkout at {self.rom_path} (skipping repo init){Colors.NC}")
+            os.chdir(self.rom_path)
+            return True
+
+        # Create and set up new directory
+        logger.info(f"{Colors.GREEN}Creating source directory: {self.rom_path}{Colors.NC}")
+        os.makedirs(self.rom_path, exist_ok=True)
+        os.chdir(self.rom_path)
+
+        logger.info(f"{Colors.GREEN}Initializing repo from {self.rom_info.manifest_url} ({self.rom_info.branch})...{Colors.NC}")
+        cmd = f"repo init -u {self.rom_info.manifest_url} -b {self.rom_info.branch} --git-lfs"
+        if self.mirror:
+            cmd += f" --reference={self.mirror.path}"
+        if self.sync_profile and self.sync_profile.init_flags():
+            cmd += f" {self.sync_profile.init_flags()}"
+        with self.timer.measure("repo-init") as phase:
+            exit_code, _, _ = self.run_command(cmd)
+            phase["ok"] = exit_code == 0
+        if exit_code != 0:
+            logger.error(f"{Colors.RED}Failed to initialize repo{Colors.NC}")
+            return False
+        return True
+
+    def _record_sync_snapshot(self) -> None:
+        """Pin the synced revisions and diff them against the previous sync"""
+        os.makedirs(self.state_dir, exist_ok=True)
+        ManifestSnapshot.from_checkout(self.rom_path).save(os.path.join(self.state_dir, "declared.json"))
+        device_manifest = os.path.join(self.rom_path, ".repo/local_manifests/device.xml")
+        if os.path.isfile(device_manifest):
+            with open(device_manifest, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            with open(os.path.join(self.state_dir, "device-manifest.sha256"), "w") as f:
+                f.write(digest)
+
+        pinned_path = os.path.join(self.state_dir, "pinned.xml")
+        exit_code, _, _ = self.run_command(f"repo manifest -r -o {pinned_path}")
+        if exit_code != 0:
+            logger.warning(f"{Colors.YELLOW}Warning: could not pin synced revisions{Colors.NC}")
+            return
+
+        current = ManifestSnapshot.from_file(pinned_path)
+        last_path = os.path.join(self.state_dir, "last-sync.json")
+        previous = ManifestSnapshot.load(last_path)
+        if previous is not None:
+            previous.save(os.path.join(self.state_dir, "prev-sync.json"))
+        current.save(last_path)
+
+        if previous is None:
+            logger.info(f"{Colors.CYAN}Recorded first manifest snapshot ({len(current.projects)} projects){Colors.NC}")
+            return
+
+        self.manifest_diff = previous.diff(current)
+        with open(os.path.join(self.state_dir, "last-diff.json"), "w") as f:
+            json.dump(self.manifest_diff.to_dict(), f, indent=1)
+        logger.info(f"{Colors.CYAN}Changes since last sync:{Colors.NC} {self.manifest_diff.summary()}")
+
+    def _device_sync_paths(self) -> Optional[List[str]]:
+        """Paths affected by local manifest changes since the last sync, or None if unknown"""
+        previous = ManifestSnapshot.load(os.path.join(self.state_dir, "declared.json"))
+        if previous is None:
+            return None
+        diff = previous.diff(ManifestSnapshot.from_checkout(self.rom_path))
+        logger.info(f"{Colors.CYAN}Manifest changes:{Colors.NC} {diff.summary()}")
+        for path in diff.removed:
+            logger.info(f"{Colors.YELLOW}Project no longer in manifest: {path}{Colors.NC}")
+        return diff.changed_paths()
+
+    def _sync_with_retry(self, phase: str, flags: str) -> bool:
+        """Run 'repo sync' for one phase, retrying only the projects that failed.
+
+        The first attempt syncs the whole manifest, so projects added by the
+        manifest update are included. The state file lists the projects that
+        are already synced; if the previous run of this phase did not
+        complete, only the remaining projects are synced instead of starting
+        over. Retries go in batches of Config.SYNC_BATCH_SIZE projects
+        against the manifest as already updated.
+        """
+        os.makedirs(self.state_dir, exist_ok=True)
+        state_path = os.path.join(self.state_dir, f"sync-state-{phase}.json")
+        snapshot = ManifestSnapshot.from_checkout(self.rom_path)
+        all_paths = set(snapshot.projects)
+
+        state = {}
+        if os.path.isfile(state_path):
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {}
+
+        projects: List[str] = []
+        if state and not state.get("complete", True):
+            synced = set(state.get("synced", []))
+            projects = sorted(all_paths - synced)
+            if projects and len(projects) < len(all_paths):
+                logger.info(f"{Colors.YELLOW}Resuming {phase}: {len(projects)} of {len(all_paths)} projects left from the previous run{Colors.NC}")
+            else:
+                projects = []
+            state["synced"] = sorted(synced & all_paths)
+        else:
+            state = {"complete": False, "synced": []}
+
+        kind = "network" if phase == "fetch" else "checkout"
+        for attempt in range(Config.SYNC_RETRIES + 1):
+            state["complete"] = False
+            with open(state_path, "w") as f:
+                json.dump(state, f)
+
+            # An empty batch is a sync of the whole manifest
+            batches = [projects[start:start + Config.SYNC_BATCH_SIZE]
+                       for start in range(0, len(projects), Config.SYNC_BATCH_SIZE)] or [[]]
+            failed: Set[str] = set()
+            for index, batch in enumerate(batches):
+                failed.update(self._repo_sync(phase, kind, flags, batch, update_manifest=attempt == 0 and index == 0))
+
+            # The first fetch may have moved the manifest; map everything
+            # against the projects it declares now
+            snapshot = ManifestSnapshot.from_checkout(self.rom_path)
+            all_paths = set(snapshot.projects)
+            failed_paths = set()
+            for project in failed:
+                if project in snapshot.projects:
+                    failed_paths.add(project)
+                else:
+                    failed_paths.update(path for path, info in snapshot.projects.items() if info["name"] == project)
+            attempted = set(projects) if projects else all_paths
+            if failed and not failed_paths:
+                # Without a parsable error the whole attempt has to be retried
+                failed_paths = attempted
+            state["synced"] = sorted((set(state["synced"]) | (attempted - failed_paths)) & all_paths)
+
+            self.sync_tuner.save()
+            remaining = all_paths - set(state["synced"])
+            if not remaining:
+                logger.info(f"{Colors.CYAN}Achieved {kind} throughput: {self.sync_tuner.achieved(kind):.1f} MB/s{Colors.NC}")
+                state = {"complete": True, "synced": sorted(all_paths)}
+                with open(state_path, "w") as f:
+                    json.dump(state, f)
+                return True
+
+            projects = [] if remaining == all_paths else sorted(remaining)
+            with open(state_path, "w") as f:
+                json.dump(state, f)
+
+            if attempt == Config.SYNC_RETRIES:
+                break
+            if not failed_paths:
+                # Only projects the manifest update added are left
+                logger.info(f"{Colors.YELLOW}{len(remaining)} projects added by the manifest update, syncing them{Colors.NC}")
+                continue
+            delay = Config.SYNC_RETRY_BACKOFF * (2 ** attempt)
+            logger.warning(f"{Colors.YELLOW}{len(failed_paths)} projects failed to {phase}, retrying them in {delay}s: {' '.join(sorted(failed_paths)[:10])}{Colors.NC}")
+            time.sleep(delay)
+
+        logger.error(f"{Colors.RED}Projects still failing after {Config.SYNC_RETRIES} retries: {' '.join(sorted(remaining))}{Colors.NC}")
+        return False
+
+    def _repo_sync(self, phase: str, kind: str, flags: str, projects: List[str], update_manifest: bool) -> Set[str]:
+        """One 'repo sync' invocation; returns the failed projects, empty on success.
+
+        Throughput is the data repo and its git processes wrote to disk
+        (block I/O accounting of reaped children), so other writers on the
+        filesystem do not count.
+        """
+        jobs = self.sync_tuner.jobs(kind)
+        extra = "" if update_manifest else " --no-manifest-update"
+        cmd = (f"repo --event-log={self._repo_event_log()} sync {flags}{extra} {self.sync_tuner.flags()} "
+               f"{' '.join(projects)}").rstrip()
+        error_lines: List[str] = []
+        written_before = resource.getrusage(resource.RUSAGE_CHILDREN).ru_oublock
+        started = time.time()
+        exit_code, output, _ = self.run_command(
+            cmd,
+            step=f"repo-sync-{phase}",
+            on_line=lambda line: error_lines.append(line) if line.startswith("error") else None
+        )
+        written = (resource.getrusage(resource.RUSAGE_CHILDREN).ru_oublock - written_before) * 512
+        self.sync_tuner.record(kind, jobs, written, time.time() - started)
+        if exit_code == 0:
+            return set()
+        # An unparsable failure is reported as the sentinel "" project
+        return set(parse_failed_projects("\n".join(error_lines + [output]))) or {""}
+
+    def _install_local_manifests(self, device_manifest_url: str) -> Optional[bool]:
+        """Write device.xml plus the generated local manifests.
+
+        Returns whether the device manifest differs from the one used by the
+        last successful sync, or None if it could not be fetched.
+        """
+        # Fetch first: on failure the current local manifests stay in place,
+        # so a later sync does not drop the device trees
+        try:
+            content, digest = self.manifest_fetcher.fetch(device_manifest_url)
+        except (urllib.error.URLError, OSError) as e:
+            logger.error(f"{Colors.RED}Failed to download device manifest: {e}{Colors.NC}")
+            return None
+        local_manifests_dir = self._reset_local_manifests()
+        with open(os.path.join(local_manifests_dir, "device.xml"), "wb") as f:
+            f.write(content)
+
+        self._slim_manifest(local_manifests_dir)
+        self._apply_sync_profile(local_manifests_dir)
+
+        digest_path = os.path.join(self.state_dir, "device-manifest.sha256")
+        if os.path.isfile(digest_path):
+            with open(digest_path) as f:
+                return f.read().strip() != digest
+        return True
+
+    def _used_projects_path(self, variant: str) -> str:
+        return os.path.join(self.state_dir, f"used-projects-{self.options.device}-{variant}.json")
+
+    def _slim_manifest(self, local_manifests_dir: str) -> None:
+        """Generate slim.xml with remove-project entries next to device.xml"""
+        if not self.slimmer:
+            return
+        # Each variant reads its own projects (GMS pulls in vendor/*); keep
+        # what any of them read
+        used = None
+        for path in sorted(glob.glob(self._used_projects_path("*"))):
+            try:
+                with open(path) as f:
+                    used = (used or set()) | set(json.load(f))
+            except (OSError, ValueError):
+                continue
+        protected = set(ManifestSnapshot.from_file(os.path.join(local_manifests_dir, "device.xml")).projects)
+        snapshot = ManifestSnapshot.from_checkout(self.rom_path)
+        paths = self.slimmer.removable(snapshot, used, protected)
+        names = self.slimmer.write_local_manifest(snapshot, paths, os.path.join(local_manifests_dir, "slim.xml"))
+        if names:
+            logger.info(f"{Colors.CYAN}Manifest slimming: removing {len(names)} of {len(snapshot.projects)} projects{Colors.NC}")
+        if used is None:
+            logger.info(f"{Colors.CYAN}Manifest slimming: no build usage recorded yet, only always-removed projects are dropped{Colors.NC}")
+
+    def _record_used_projects(self, variant: str, out_dir: str = "out") -> None:
+        """Remember which projects the last build of a variant read, for later slimming"""
+        if not self.slimmer or not list(Path(self.rom_path, out_dir).glob("combined-*.ninja")):
+            return
+        project_paths = set(ManifestSnapshot.from_checkout(self.rom_path).projects)
+        used = collect_used_projects(self.rom_path, Config.BUILD_GOALS[self.options.rom], project_paths, out_dir)
+        if used is None:
+            return
+        with self.state_lock:
+            os.makedirs(self.state_dir, exist_ok=True)
+            with open(self._used_projects_path(variant), "w") as f:
+                json.dump(sorted(used), f, indent=1)
+        logger.info(f"{Colors.CYAN}Build read from {len(used)} of {len(project_paths)} projects{Colors.NC}")
+
+    def _apply_sync_profile(self, local_manifests_dir: str) -> None:
+        """Apply clone depth and partial-clone exclusions from the sync profile"""
+        if not self.sync_profile:
+            return
+        snapshot = ManifestSnapshot.from_checkout(self.rom_path)
+        count = self.sync_profile.write_local_manifest(snapshot, os.path.join(local_manifests_dir, "sync-profile.xml"))
+        if count:
+            logger.info(f"{Colors.CYAN}Sync profile: {count} shallow projects{Colors.NC}")
+
+        if self.sync_profile.uses_partial_clone():
+            # repo keeps --partial-clone-exclude in the manifest repository's
+            # config; set it directly to avoid another 'repo init' round trip
+            excludes = self.sync_profile.partial_clone_excludes(snapshot)
+            config_path = os.path.join(self.rom_path, ".repo/manifests.git/config")
+            subprocess.run(["git", "config", "--file", config_path, "repo.partialcloneexclude", ",".join(excludes)])
+            logger.info(f"{Colors.CYAN}Sync profile: {len(snapshot.projects) - len(excludes)} blobless, {len(excludes)} with full blobs{Colors.NC}")
+
+    def _fetch_sources(self, device_manifest_url: str) -> bool:
+        """Network phase of the sync: init, device manifest and 'repo sync -n'"""
+        # Bring the shared mirror up to date first so the tree sync finds
+        # most objects locally
+        if self.mirror:
+            with self.timer.measure("mirror-update") as phase:
+                phase["ok"] = self.mirror.update(self.rom_info, self.sync_tuner.jobs("network"))
+            if not phase["ok"]:
+                logger.warning(f"{Colors.YELLOW}Warning: shared mirror update failed, syncing from network{Colors.NC}")
+
+        if not self._prepare_checkout():
+            return False
+        if self.mirror:
+            linked = self.mirror.link(self.rom_path)
+            if linked:
+                logger.info(f"{Colors.CYAN}Linked {linked} existing projects to the shared mirror{Colors.NC}")
         
-        if process.returncode != 0:
-            logger.info(f"{Colors.RED}Command failed with exit code {process.returncode}{Colors.NC}")
-            if stderr:
-                logger.info(f"{Colors.RED}Error: {stderr}{Colors.NC}")
+        # Set up clean local manifests with the device manifest
+        logger.info(f"{Colors.GREEN}Adding device manifest for {self.options.device}...{Colors.NC}")
+        with self.timer.measure("manifest-fetch") as phase:
+            phase["ok"] = self._install_local_manifests(device_manifest_url) is not None
+        if not phase["ok"]:
+            return False
         
-        return process.returncode, stdout, stderr
+        # Fetch only. Projects pinned to a revision that is already present
+        # locally are not fetched again.
+        logger.info(f"{Colors.GREEN}Fetching source code (may take a while)...{Colors.NC}")
+        logger.info(f"{Colors.YELLOW}Starting with {self.sync_tuner.jobs('network')} parallel network jobs{Colors.NC}")
+        with self.timer.measure("sync-fetch") as phase:
+            phase["ok"] = self._sync_with_retry("fetch", "-n -c --force-sync --no-clone-bundle --no-tags --optimized-fetch --prune")
+        if not phase["ok"]:
+            logger.error(f"{Colors.RED}Failed to fetch repositories{Colors.NC}")
+            return False
+
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(os.path.join(self.state_dir, "fetch.json"), "w") as f:
+            json.dump({"fetched_at": time.time()}, f)
+        if self.mirror:
+            self.mirror.gc()
+        return True
+
+    def _checkout_sources(self) -> bool:
+        """Local phase of the sync: 'repo sync -l' from already fetched objects"""
+        if not os.path.isdir(os.path.join(self.rom_path, ".repo")):
+            logger.error(f"{Colors.RED}Error: {self.rom_path} has not been fetched yet{Colors.NC}")
+            logger.error(f"{Colors.RED}Run with --sync-phase fetch or all first{Colors.NC}")
+            return False
+        os.chdir(self.rom_path)
+
+        fetch_stamp = os.path.join(self.state_dir, "fetch.json")
+        if os.path.isfile(fetch_stamp):
+            with open(fetch_stamp) as f:
+                fetched_at = json.load(f).get("fetched_at", 0)
+            age_hours = (time.time() - fetched_at) / 3600
+            logger.info(f"{Colors.CYAN}Checking out sources fetched {age_hours:.1f}h ago{Colors.NC}")
+        else:
+            logger.warning(f"{Colors.YELLOW}Warning: no record of a previous fetch, checking out whatever is present{Colors.NC}")
+
+        # Only projects whose revision moved get a new checkout
+        logger.info(f"{Colors.GREEN}Checking out source code...{Colors.NC}")
+        with self.timer.measure("sync-checkout") as phase:
+            phase["ok"] = self._sync_with_retry("checkout", "-l -c")
+        if not phase["ok"]:
+            logger.error(f"{Colors.RED}Failed to check out repositories{Colors.NC}")
+            return False
+        self._record_sync_snapshot()
+        return True
 
     def setup_environment(self) -> bool:
         """Setup ROM environment"""
@@ -117,66 +3096,21 @@ class RomBuilder:
         logger.info(f"{Colors.CYAN}Source:{Colors.NC} {self.rom_info.manifest_url} (branch: {self.rom_info.branch})")
         logger.info(f"{Colors.CYAN}Release Directory:{Colors.NC} {self.release_dir}")
         
+        device_manifest_url = self._device_manifest_url()
+
         # Set up the environment
         if not self.options.skip_sync:
-            # Remove existing directory if it exists
-            if os.path.isdir(self.rom_path):
-                logger.info(f"{Colors.YELLOW}Removing existing directory: {self.rom_path}{Colors.NC}")
-                shutil.rmtree(self.rom_path)
-            
-            # Create and set up new directory
-            logger.info(f"{Colors.GREEN}Creating source directory: {self.rom_path}{Colors.NC}")
-            os.makedirs(self.rom_path, exist_ok=True)
-            os.chdir(self.rom_path)
-            
-            logger.info(f"{Colors.GREEN}Initializing repo from {self.rom_info.manifest_url} ({self.rom_info.branch})...{Colors.NC}")
-            cmd = f"repo init -u {self.rom_info.manifest_url} -b {self.rom_info.branch} --git-lfs"
-            exit_code, _, _ = self.run_command(cmd)
-            if exit_code != 0:
-                logger.error(f"{Colors.RED}Failed to initialize repo{Colors.NC}")
-                return False
-            
-            # Create local_manifests directory and ensure it's clean
-            logger.info(f"{Colors.GREEN}Setting up local manifests directory...{Colors.NC}")
-            local_manifests_dir = os.path.join(self.rom_path, ".repo/local_manifests")
-            if os.path.isdir(local_manifests_dir):
-                for item in os.listdir(local_manifests_dir):
-                    item_path = os.path.join(local_manifests_dir, item)
-                    if os.path.isfile(item_path):
-                        os.remove(item_path)
-            else:
-                os.makedirs(local_manifests_dir, exist_ok=True)
-            
-            # Download the device manifest
-            logger.info(f"{Colors.GREEN}Adding device manifest for {self.options.device}...{Colors.NC}")
-            device_manifest_url = ""
-            
-            if self.options.rom == "axion" and self.options.device == "pipa":
-                device_manifest_url = "https://raw.githubusercontent.com/ai94iq/local_manifests/main/axion-pipa-qpr2.xml"
-            elif self.options.rom == "axion" and self.options.device == "raven":
-                device_manifest_url = "https://raw.githubusercontent.com/ai94iq/local_manifests/main/axion-raven-qpr2.xml"
-            elif self.options.rom == "lmodroid" and self.options.device == "pipa":
-                device_manifest_url = "https://raw.githubusercontent.com/ai94iq/local_manifests/main/lmov-pipa.xml"
-            else:
+            if not device_manifest_url:
                 logger.error(f"{Colors.RED}No device manifest available for {self.options.rom} + {self.options.device} combination{Colors.NC}")
                 return False
-            
-            # Download the manifest file
-            manifest_path = os.path.join(local_manifests_dir, "device.xml")
-            cmd = f"wget -O {manifest_path} {device_manifest_url}"
-            exit_code, _, _ = self.run_command(cmd)
-            if exit_code != 0:
-                logger.error(f"{Colors.RED}Failed to download device manifest{Colors.NC}")
-                return False
-            
-            # Sync repositories
-            logger.info(f"{Colors.GREEN}Syncing source code (may take a while)...{Colors.NC}")
-            cores = os.cpu_count() or 4
-            logger.info(f"{Colors.YELLOW}Using {cores} parallel jobs for sync{Colors.NC}")
-            cmd = f"repo sync -c -j{cores} --force-sync --no-clone-bundle --no-tags"
-            exit_code, _, _ = self.run_command(cmd)
-            if exit_code != 0:
-                logger.error(f"{Colors.RED}Failed to sync repositories{Colors.NC}")
+
+            if self.options.sync_phase in ("all", "fetch"):
+                if not self._fetch_sources(device_manifest_url):
+                    return False
+                if self.options.sync_phase == "fetch":
+                    logger.info(f"{Colors.GREEN}Network fetch complete, run with --sync-phase checkout before building{Colors.NC}")
+                    return True
+            if not self._checkout_sources():
                 return False
         else:
             # Skip sync, but verify directory exists
@@ -190,35 +3124,28 @@ class RomBuilder:
             
             # Update local manifest even when skipping sync
             logger.info(f"{Colors.GREEN}Updating device manifest...{Colors.NC}")
-            local_manifests_dir = os.path.join(self.rom_path, ".repo/local_manifests")
-            if os.path.isdir(local_manifests_dir):
-                for item in os.listdir(local_manifests_dir):
-                    item_path = os.path.join(local_manifests_dir, item)
-                    if os.path.isfile(item_path):
-                        os.remove(item_path)
-            else:
-                os.makedirs(local_manifests_dir, exist_ok=True)
+            with self.timer.measure("manifest-fetch") as phase:
+                manifest_changed = self._install_local_manifests(device_manifest_url) if device_manifest_url else None
+                phase["ok"] = not device_manifest_url or manifest_changed is not None
             
-            # Download the device manifest
-            device_manifest_url = ""
-            
-            if self.options.rom == "axion" and self.options.device == "pipa":
-                device_manifest_url = "https://raw.githubusercontent.com/ai94iq/local_manifests/main/axion-pipa-qpr2.xml"
-            elif self.options.rom == "axion" and self.options.device == "raven":
-                device_manifest_url = "https://raw.githubusercontent.com/ai94iq/local_manifests/main/axion-raven-qpr2.xml"
-            elif self.options.rom == "lmodroid" and self.options.device == "pipa":
-                device_manifest_url = "https://raw.githubusercontent.com/ai94iq/local_manifests/main/lmov-pipa.xml"
-            
-            if device_manifest_url:
-                manifest_path = os.path.join(local_manifests_dir, "device.xml")
-                cmd = f"wget -O {manifest_path} {device_manifest_url}"
-                self.run_command(cmd)
-            
-            # Limited sync for device files
-            logger.info(f"{Colors.GREEN}Syncing device-specific repositories...{Colors.NC}")
-            cores = os.cpu_count() or 4
-            cmd = f"repo sync -c -j{cores} --force-sync --no-clone-bundle --no-tags -f device/ vendor/ kernel/ hardware/xiaomi/ hardware/google/"
-            self.run_command(cmd)
+            # Limited sync of the projects the manifest change affects
+            if manifest_changed is False:
+                logger.info(f"{Colors.GREEN}Device manifest unchanged since the last sync{Colors.NC}")
+                sync_paths = []
+            else:
+                sync_paths = self._device_sync_paths()
+                if sync_paths is None:
+                    sync_paths = Config.FALLBACK_SYNC_PATHS
+            if sync_paths:
+                logger.info(f"{Colors.GREEN}Syncing {len(sync_paths)} device-specific repositories...{Colors.NC}")
+                cmd = f"repo --event-log={self._repo_event_log()} sync -c {self.sync_tuner.flags()} --force-sync --no-clone-bundle --no-tags -f {' '.join(sync_paths)}"
+                with self.timer.measure("sync", paths=len(sync_paths)) as phase:
+                    exit_code, _, _ = self.run_command(cmd, step="repo-sync")
+                    phase["ok"] = exit_code == 0
+                if exit_code == 0:
+                    self._record_sync_snapshot()
+            else:
+                logger.info(f"{Colors.GREEN}Device repositories are up to date{Colors.NC}")
         
         # Verify we're in a valid ROM directory
         if not os.path.isfile(os.path.join(self.rom_path, "build/envsetup.sh")):
@@ -237,67 +3164,231 @@ class RomBuilder:
         seconds = elapsed % 60
         logger.info(f"{Colors.CYAN}Build time: {hours}h {minutes}m {seconds}s{Colors.NC}")
 
-    def build_rom(self, variant: str, is_fastboot: bool) -> bool:
-        """Simulate building the ROM"""
-        output_dir = os.path.join(self.rom_path, "out/target/product", self.options.device)
-        
-        # Setup device-specific build environment
+    def run_in_shell(self, lane: BuildLane, cmd: str, step: Optional[str] = None,
+                     on_line: Optional[Callable[[str], None]] = None, echo: bool = True) -> int:
+        """Run a command in the lane's persistent build shell and return its exit code"""
+        if self.options.dry_run:
+            logger.info(f"{Colors.YELLOW}Would run: {cmd}{Colors.NC}")
+            return 0
+
+        if lane.shell is None:
+            returncode = self._start_build_shell(lane)
+            if returncode != 0:
+                return returncode
+
+        logger.info(f"{Colors.YELLOW}{lane.prefix}Running: {cmd}{Colors.NC}")
+        log_path = self._step_log_path(step or " ".join(cmd.split()[:2]))
+        returncode, tail = lane.shell.run(cmd, lambda lines: self._stream_output(lines, log_path, on_line, echo, lane.prefix))
+        if returncode != 0:
+            self._log_failure(returncode, tail, log_path)
+        return returncode
+
+    def _start_build_shell(self, lane: BuildLane) -> int:
+        """Start the lane's build shell and source build/envsetup.sh"""
+        logger.info(f"{Colors.GREEN}Setting up build environment{f' for {lane.out_dir}/' if len(self.lanes) > 1 else ''}...{Colors.NC}")
+        env = dict(self.ccache.env()) if self.ccache else {}
+        if lane.out_dir != "out":
+            env["OUT_DIR"] = lane.out_dir
+        lane.shell = BuildShell(self.rom_path, env)
+        log_path = self._step_log_path(f"envsetup-{lane.name}" if len(self.lanes) > 1 else "envsetup")
+        with self.timer.measure("envsetup", lane=lane.name, shell=lambda: self._shell_pid(lane)) as phase:
+            returncode, tail = lane.shell.start(lambda lines: self._stream_output(lines, log_path, prefix=lane.prefix))
+            phase["ok"] = returncode == 0
+        if returncode != 0:
+            self._log_failure(returncode, tail, log_path)
+            logger.error(f"{Colors.RED}Failed to source build environment{Colors.NC}")
+            lane.shell.close()
+            lane.shell = None
+        return returncode
+
+    @staticmethod
+    def _shell_pid(lane: BuildLane) -> Optional[int]:
+        if lane.shell is None or lane.shell.process is None:
+            return None
+        return lane.shell.process.pid
+
+    def close_build_shell(self) -> None:
+        for lane in self.lanes:
+            if lane.shell is not None:
+                lane.shell.close()
+                lane.shell = None
+            lane.configured_variant = None
+            lane.baseline_env = None
+            lane.applied_env = set()
+
+    def _capture_shell_env(self, lane: BuildLane) -> Optional[Dict[str, str]]:
+        """Exported environment of the lane's build shell"""
+        os.makedirs(self.env_cache.cache_dir, exist_ok=True)
+        env_path = os.path.join(self.env_cache.cache_dir, f"capture-{os.getpid()}-{lane.name}.env")
+        try:
+            if self.run_in_shell(lane, f"env -0 > {shlex.quote(env_path)}", step="capture-env", echo=False) != 0:
+                return None
+            return EnvCache.read_env(env_path)
+        finally:
+            if os.path.exists(env_path):
+                os.remove(env_path)
+
+    def _configure_device(self, lane: BuildLane, variant: str) -> bool:
+        """Run axion/lunch for the variant unless the lane's warm shell is already configured for it"""
+        if lane.configured_variant == variant:
+            logger.info(f"{Colors.GREEN}Build environment already configured for {variant}{Colors.NC}")
+            return True
+
         logger.info(f"{Colors.GREEN}Setting up device: {self.options.device} with variant: {variant}{Colors.NC}")
         if self.options.rom == "axion":
-            if self.options.device == "pipa" or self.options.device == "raven":
-                # Set GMS build flag for Axion if needed
-                if variant == "gms":
-                    logger.info(f"{Colors.GREEN}Configuring build for GMS support{Colors.NC}")
-                    cmd = f"axion {self.options.device} gms"
-                    logger.info(f"{Colors.YELLOW}Would run: {cmd}{Colors.NC}")
-                else:
-                    logger.info(f"{Colors.GREEN}Configuring build for vanilla version (no GMS){Colors.NC}")
-                    cmd = f"axion {self.options.device} va"
-                    logger.info(f"{Colors.YELLOW}Would run: {cmd}{Colors.NC}")
-        elif self.options.rom == "lmodroid":
-            if self.options.device == "pipa":
-                cmd = f"lunch lmodroid_pipa-userdebug || breakfast pipa"
-                logger.info(f"{Colors.YELLOW}Would run: {cmd}{Colors.NC}")
-            elif self.options.device == "raven":
-                cmd = f"lunch lmodroid_raven-userdebug || breakfast raven"
-                logger.info(f"{Colors.YELLOW}Would run: {cmd}{Colors.NC}")
-
-        # Clean build if requested
-        if self.options.clean_build:
-            logger.info(f"{Colors.YELLOW}Running clean build...{Colors.NC}")
-            cmd = "m clean"
-            logger.info(f"{Colors.YELLOW}Would run: {cmd}{Colors.NC}")
-        else:
-            logger.info(f"{Colors.YELLOW}Running incremental build...{Colors.NC}")
-            cmd = "m installclean"
-            logger.info(f"{Colors.YELLOW}Would run: {cmd}{Colors.NC}")
+            # Set GMS build flag for Axion if needed
+            if variant == "gms":
+                logger.info(f"{Colors.GREEN}Configuring build for GMS support{Colors.NC}")
+            else:
+                logger.info(f"{Colors.GREEN}Configuring build for vanilla version (no GMS){Colors.NC}")
+        cmd = BuildPlanner.configure_command(self.options.rom, self.options.device, variant)
 
-        # Configure for fastboot build if requested
-        if is_fastboot:
-            logger.info(f"{Colors.YELLOW}Configuring for fastboot build...{Colors.NC}")
-            cmd = "export BUILD_FASTBOOT=true"
-            logger.info(f"{Colors.YELLOW}Would run: {cmd}{Colors.NC}")
-        else:
-            cmd = "export BUILD_FASTBOOT=false"
-            logger.info(f"{Colors.YELLOW}Would run: {cmd}{Colors.NC}")
+        if self.options.dry_run:
+            self.run_in_shell(lane, cmd, step=f"configure-{variant}")
+            lane.configured_variant = variant
+            return True
 
-        # Start the build
-        logger.info(f"{Colors.GREEN}Starting build process...{Colors.NC}")
+        # Make sure the shell exists and remember the environment envsetup left behind
+        if lane.baseline_env is None:
+            lane.baseline_env = self._capture_shell_env(lane)
+            if lane.baseline_env is None:
+                return False
+
+        key = self.env_cache.key(self.options.rom, self.options.device, variant, lane.out_dir, lane.baseline_env)
+        cached = self.env_cache.load(key)
+        if cached is not None:
+            logger.info(f"{Colors.GREEN}Restoring cached {variant} build environment ({key}){Colors.NC}")
+            script_path = os.path.join(self.env_cache.cache_dir, f"{key}.sh")
+            with open(script_path, "w") as f:
+                f.write(EnvCache.script(cached, lane.applied_env))
+            if self.run_in_shell(lane, f"source {shlex.quote(script_path)}", step=f"restore-env-{variant}", echo=False) == 0:
+                lane.applied_env = set(cached["set"])
+                lane.configured_variant = variant
+                return True
+            logger.warning(f"{Colors.YELLOW}Warning: could not restore cached environment, reconfiguring{Colors.NC}")
+
+        if self.run_in_shell(lane, cmd, step=f"configure-{variant}") != 0:
+            logger.error(f"{Colors.RED}Failed to configure {self.rom_info.name} ({variant}){Colors.NC}")
+            lane.configured_variant = None
+            return False
+
+        current = self._capture_shell_env(lane)
+        if current is not None:
+            snapshot = EnvCache.diff(lane.baseline_env, current)
+            self.env_cache.save(key, snapshot)
+            lane.applied_env = set(snapshot["set"])
+        lane.configured_variant = variant
+        return True
+
+    def setup_ccache(self) -> None:
+        """Size the shared compiler cache; builds run without it if ccache is missing"""
+        if not self.options.ccache_dir:
+            logger.info(f"{Colors.CYAN}ccache disabled{Colors.NC}")
+            return
+        ccache = CcacheManager(self.options.ccache_dir, self.options.ccache_size, self.rom_path)
+        if ccache.executable is None:
+            logger.warning(f"{Colors.YELLOW}Warning: ccache not found, building without a compiler cache{Colors.NC}")
+            return
+        if self.options.dry_run:
+            logger.info(f"{Colors.YELLOW}Would use ccache in {ccache.directory} ({ccache.size}){Colors.NC}")
+            return
+        if not ccache.setup():
+            logger.warning(f"{Colors.YELLOW}Warning: could not configure ccache in {ccache.directory}, building without it{Colors.NC}")
+            return
+        logger.info(f"{Colors.GREEN}Using ccache in {ccache.directory} (max {ccache.size}){Colors.NC}")
+        self.ccache = ccache
+
+    def _start_ccache_stats(self, lane: BuildLane, step: str) -> Optional[Tuple[str, Dict[str, int]]]:
+        """Trim the cache if disk is short and start recording this build's ccache stats"""
+        if self.ccache is None:
+            return None
+        freed = self.ccache.trim(Config.CCACHE_MIN_FREE_DISK_GB)
+        if freed is not None:
+            logger.info(f"{Colors.YELLOW}Low disk space: trimmed ccache by {freed / 1024 ** 3:.1f} GiB{Colors.NC}")
+        stats_log = os.path.join(self.log_dir, f"ccache-{step}.statslog")
+        if os.path.exists(stats_log):
+            os.remove(stats_log)
+        self.run_in_shell(lane, f"export CCACHE_STATSLOG={shlex.quote(stats_log)}", echo=False)
+        return stats_log, self.ccache.stats()
+
+    def _finish_ccache_stats(self, lane: BuildLane, step: str, started: Optional[Tuple[str, Dict[str, int]]]) -> None:
+        if started is None:
+            return
+        self.run_in_shell(lane, "unset CCACHE_STATSLOG", echo=False)
+        stats_log, before = started
+        counters = CcacheManager.read_stats_log(stats_log)
+        if not counters:
+            after = self.ccache.stats()
+            counters = {name: after.get(name, 0) - before.get(name, 0) for name in after}
+        report = self.ccache.report(counters)
+        self.summary["ccache"][step] = report
+        logger.info(f"{Colors.CYAN}ccache: {report['hit_rate']:.1%} hit rate ({report['hits']} hits, {report['misses']} misses), "
+                    f"~{report['bytes_saved'] / 1024 ** 3:.1f} GiB saved{Colors.NC}")
+
+    def _product_out(self, lane: BuildLane) -> str:
+        return os.path.join(self.rom_path, lane.out_dir, "target/product", self.options.device)
+
+    def _copy_file(self, src: str, dst: str) -> None:
+        shutil.copy2(src, dst)
+        logger.info(f"'{os.path.relpath(src, self.rom_path)}' -> '{dst}'")
+
+    def _fastboot_package_name(self, variant: str) -> str:
         if self.options.rom == "axion":
-            logger.info(f"{Colors.YELLOW}Building Axion for {self.options.device} with variant: {variant}{Colors.NC}")
-            
-            # Use brunch command for the actual build
-            cmd = f"brunch {self.options.device}"
-            logger.info(f"{Colors.YELLOW}Would run: {cmd}{Colors.NC}")
+            return f"axion-{self.options.date_string}-{variant.upper()}-{self.options.device}-FASTBOOT.zip"
+        return f"lmodroid-{self.options.date_string}-{self.options.device}-FASTBOOT.zip"
+
+    def _copy_artifacts(self, variant: str, is_fastboot: bool, output_dir: str) -> bool:
+        """Copy the build outputs to the release directory"""
+        logger.info(f"{Colors.GREEN}Copying build files to {self.release_dir}{Colors.NC}")
+
+        if not is_fastboot:
+            # Regular ROM zip files keep their original names. Zips of earlier
+            # builds stay in the product directory, so only this run's are published.
+            started = self.build_started.get(variant, 0.0)
+            for zip_file in sorted(Path(output_dir).glob(f"{self.options.rom}-*.zip")):
+                if zip_file.stat().st_mtime < started:
+                    logger.info(f"{Colors.YELLOW}Skipping {zip_file.name} from an earlier build{Colors.NC}")
+                    continue
+                self._copy_file(str(zip_file), os.path.join(self.release_dir, zip_file.name))
+
+            # OTA config json, suffixed with the variant
+            if self.options.rom == "axion":
+                json_src = os.path.join(output_dir, variant.upper(), f"{self.options.device}.json")
+                if os.path.isfile(json_src):
+                    self._copy_file(json_src, os.path.join(self.release_dir, f"{self.options.device}-{variant}.json"))
+                    logger.info(f"{Colors.GREEN}Copied {variant.upper()} OTA config json{Colors.NC}")
+
+            # Boot images
+            for image in ("boot.img", "dtbo.img", "vendor_boot.img"):
+                image_path = os.path.join(output_dir, image)
+                if os.path.isfile(image_path):
+                    self._copy_file(image_path, os.path.join(self.release_dir, image))
         else:
-            logger.info(f"{Colors.YELLOW}Building LMODroid for {self.options.device}{Colors.NC}")
-            cmd = "m lmodroid"
-            logger.info(f"{Colors.YELLOW}Would run: {cmd}{Colors.NC}")
+            fastboot_target = os.path.join(self.release_dir, self._fastboot_package_name(variant))
+            candidates = [
+                os.path.join(output_dir, name) for name in (
+                    f"{self.options.rom}_{self.options.device}-img.zip",
+                    "update.zip",
+                    "updatepackage.zip",
+                    f"{self.options.device}_update.zip",
+                    f"lineage_{self.options.device}-img.zip"
+                )
+            ]
+            candidates += [str(p) for p in sorted(Path(output_dir).rglob("*update*.zip"))]
+            candidates += [str(p) for p in sorted(Path(output_dir).rglob("*img*.zip"))]
+            started = self.build_started.get(variant, 0.0)
+            package = next((c for c in candidates if os.path.isfile(c) and os.path.getmtime(c) >= started), None)
+            if package is None:
+                logger.error(f"{Colors.RED}No fastboot package from this run found in {output_dir}{Colors.NC}")
+                return False
+            self._copy_file(package, fastboot_target)
+            logger.info(f"{Colors.GREEN}Copied fastboot package from {package}{Colors.NC}")
 
-        # Simulate successful build
-        logger.info(f"{Colors.GREEN}Build successful! (simulation){Colors.NC}")
-        
-        # Generate simulated output paths for files that would be copied
+        logger.info(f"{Colors.GREEN}Build files copied to: {self.release_dir}{Colors.NC}")
+        return True
+
+    def _simulate_artifacts(self, variant: str, is_fastboot: bool) -> None:
+        """Log the files a real build would copy"""
         logger.info(f"{Colors.GREEN}Copying build files to {self.release_dir}{Colors.NC}")
         
         # Simulate file operations for Axion ROM
@@ -308,7 +3399,7 @@ class RomBuilder:
             
             # Fastboot package if requested
             if is_fastboot:
-                fastboot_name = f"axion-{self.options.date_string}-{variant.upper()}-{self.options.device}-FASTBOOT.zip"
+                fastboot_name = self._fastboot_package_name(variant)
                 logger.info(f"'out/target/product/{self.options.device}/lineage_{self.options.device}-img.zip' -> '{self.release_dir}/{fastboot_name}'")
                 logger.info(f"{Colors.GREEN}Copied fastboot image package{Colors.NC}")
             
@@ -330,7 +3421,7 @@ class RomBuilder:
             
             # Fastboot package if requested
             if is_fastboot:
-                fastboot_name = f"lmodroid-{self.options.date_string}-{self.options.device}-FASTBOOT.zip"
+                fastboot_name = self._fastboot_package_name(variant)
                 logger.info(f"'out/target/product/{self.options.device}/lmodroid_{self.options.device}-img.zip' -> '{self.release_dir}/{fastboot_name}'")
                 logger.info(f"{Colors.GREEN}Copied fastboot image package{Colors.NC}")
         
@@ -341,70 +3432,690 @@ class RomBuilder:
             logger.info(f"'out/target/product/{self.options.device}/vendor_boot.img' -> '{self.release_dir}/vendor_boot.img'")
         
         logger.info(f"{Colors.GREEN}Build files copied to: {self.release_dir}{Colors.NC}")
+
+    def build_rom(self, lane: BuildLane, variant: str, is_fastboot: bool) -> bool:
+        """Run the regular build, or the fastboot package build on top of it"""
+        output_dir = self._product_out(lane)
+
+        # Configure for fastboot build if requested
+        if is_fastboot:
+            logger.info(f"{Colors.YELLOW}Configuring for fastboot build...{Colors.NC}")
+            self.run_in_shell(lane, "export BUILD_FASTBOOT=true")
+        else:
+            self.run_in_shell(lane, "export BUILD_FASTBOOT=false")
+
+        # Start the build
+        logger.info(f"{Colors.GREEN}Starting build process...{Colors.NC}")
+        if is_fastboot:
+            logger.info(f"{Colors.YELLOW}Building updatepackage (fastboot flashable package)...{Colors.NC}")
+        elif self.options.rom == "axion":
+            logger.info(f"{Colors.YELLOW}Building Axion for {self.options.device} with variant: {variant}{Colors.NC}")
+        else:
+            logger.info(f"{Colors.YELLOW}Building LMODroid for {self.options.device}{Colors.NC}")
+        cmd = BuildPlanner.build_command(self.options.rom, is_fastboot, lane.jobs)
+        step = f"build-{variant}{'-fastboot' if is_fastboot else ''}"
+        logger.info(f"{Colors.CYAN}Using -j{lane.jobs} ({self.summary['jobs']['model']}){Colors.NC}")
+        if not is_fastboot:
+            self.build_started[variant] = time.time()
+        ccache_stats = self._start_ccache_stats(lane, step)
+        progress = NinjaProgress(
+            step,
+            os.path.join(self.log_dir, f"progress-{step}.jsonl"),
+            bar=len(self.lanes) == 1 and sys.stdout.isatty() and not self.options.verbose,
+            prefix=lane.prefix
+        )
+        build_result = self.run_in_shell(lane, cmd, step=step, on_line=progress.feed, echo=self.options.verbose)
+        if not self.options.dry_run:
+            self.summary.setdefault("progress", {})[step] = progress.finish()
+        self._finish_ccache_stats(lane, step, ccache_stats)
+
+        if self.options.dry_run:
+            logger.info(f"{Colors.GREEN}Build successful! (simulation){Colors.NC}")
+            return True
+
+        if build_result != 0 or not os.path.isfile(os.path.join(output_dir, "boot.img")):
+            logger.error(f"{Colors.RED}Build failed - check the build logs in {self.log_dir}{Colors.NC}")
+            return False
+
+        logger.info(f"{Colors.GREEN}Build successful!{Colors.NC}")
+        self.analyze_ninja_logs(lane, step)
+        if not is_fastboot:
+            self._record_used_projects(variant, lane.out_dir)
+        return True
+
+    def analyze_ninja_logs(self, lane: BuildLane, step: str) -> Optional[str]:
+        """Summarize the build's ninja logs into a report next to the release files"""
+        out_path = os.path.join(self.rom_path, lane.out_dir)
+        logs = [os.path.join(out_path, ".ninja_log")]
+        logs += sorted(glob.glob(os.path.join(out_path, "soong", ".ninja_log")) +
+                       glob.glob(os.path.join(out_path, "soong", "*", ".ninja_log")))
+        project_paths = set(ManifestSnapshot.from_checkout(self.rom_path).projects)
+        analyzer = NinjaLogAnalyzer(project_paths, min_span_ms=Config.TRACE_MIN_ACTION_MS)
+        started = time.time()
+        reports = {}
+        for log in logs:
+            result = analyzer.analyze(log)
+            if result is None:
+                continue
+            name = os.path.relpath(log, self.rom_path)
+            reports[name] = result
+            # Ninja times are relative to its start; the log was last written
+            # when the last action finished. Logs not touched by this run
+            # (e.g. a Soong bootstrap that had nothing to do) stay out of the trace.
+            finished = os.path.getmtime(log)
+            if finished >= self.start_time:
+                origin = finished - analyzer.last_end / 1000
+                spans = [(origin + start / 1000, origin + end / 1000, output, "ninja", {})
+                         for start, end, output in analyzer.spans]
+                with self.state_lock:
+                    self.trace_spans.append((f"ninja {step} ({name})", spans))
+        if not reports:
+            return None
+
+        os.makedirs(self.release_dir, exist_ok=True)
+        path = os.path.join(self.release_dir, f"ninja-{step}-{self.options.date_string}.json")
+        with open(path, "w") as f:
+            json.dump({"step": step, "out_dir": lane.out_dir, "logs": reports}, f, indent=1)
+        self.summary.setdefault("ninja", {})[step] = path
+
+        main = reports.get(os.path.join(lane.out_dir, ".ninja_log")) or next(iter(reports.values()))
+        logger.info(f"{Colors.CYAN}Ninja log: {main['actions']} actions in {format_seconds(main['wall_ms'] / 1000)}, "
+                    f"parallelism {main['parallelism']:.1f}, critical path ~{format_seconds(main['critical_path']['actions_ms'] / 1000)} "
+                    f"(analyzed in {time.time() - started:.1f}s){Colors.NC}")
+        for action in main["slowest"][:5]:
+            logger.info(f"{Colors.CYAN}  {format_seconds(action['duration_ms'] / 1000):>8}  {action['output']}{Colors.NC}")
+        for project in main["projects"][:5]:
+            logger.info(f"{Colors.CYAN}  {format_seconds(project['ms'] / 1000):>8}  {project['project']} ({project['actions']} actions){Colors.NC}")
+        logger.info(f"{Colors.CYAN}Ninja report: {path}{Colors.NC}")
+        return path
+
+    def _target_files(self, lane: BuildLane, variant: str) -> Optional[str]:
+        """target-files zip written by this run's regular build of the variant"""
+        started = self.build_started.get(variant)
+        if started is None:
+            return None
+        pattern = os.path.join(self._product_out(lane), "obj/PACKAGING/target_files_intermediates", "*-target_files*.zip")
+        candidates = [path for path in glob.glob(pattern) if os.path.getmtime(path) >= started]
+        return max(candidates, key=os.path.getmtime) if candidates else None
+
+    def package_fastboot(self, lane: BuildLane, variant: str) -> bool:
+        """Produce the fastboot zip from the regular build's target-files.
+
+        Uses img_from_target_files when the host tool was built, otherwise
+        copies IMAGES/*.img and android-info.txt out of the target-files zip
+        directly. Falls back to a 'm updatepackage' build when there are no
+        target-files from this run.
+        """
+        output_dir = self._product_out(lane)
+        package_path = os.path.join(output_dir, f"{self.options.rom}_{self.options.device}-img.zip")
+        if self.options.dry_run:
+            logger.info(f"{Colors.YELLOW}Would run: img_from_target_files <target-files> {package_path}{Colors.NC}")
+            return True
+
+        # A package left by an earlier run must not be published as this one's
+        if os.path.exists(package_path):
+            os.remove(package_path)
+        target_files = self._target_files(lane, variant)
+        if target_files is None:
+            logger.warning(f"{Colors.YELLOW}No target-files from this run's {variant} build, building updatepackage instead{Colors.NC}")
+            return self.build_rom(lane, variant, True)
+
+        logger.info(f"{Colors.GREEN}Creating fastboot package from {os.path.relpath(target_files, self.rom_path)}{Colors.NC}")
+        tool = os.path.join(self.rom_path, lane.out_dir, "host/linux-x86/bin/img_from_target_files")
+        if os.path.isfile(tool):
+            cmd = f"{shlex.quote(tool)} {shlex.quote(target_files)} {shlex.quote(package_path)}"
+            if self.run_in_shell(lane, cmd, step=f"package-{variant}") == 0:
+                return True
+            logger.warning(f"{Colors.YELLOW}img_from_target_files failed, extracting images directly{Colors.NC}")
+
+        try:
+            with zipfile.ZipFile(target_files) as source, \
+                    zipfile.ZipFile(package_path, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as package:
+                for info in source.infolist():
+                    if info.filename.startswith("IMAGES/") and info.filename.endswith(".img"):
+                        name = info.filename[len("IMAGES/"):]
+                    elif info.filename == "OTA/android-info.txt":
+                        name = "android-info.txt"
+                    else:
+                        continue
+                    with source.open(info) as src, package.open(name, "w", force_zip64=True) as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+        except (OSError, zipfile.BadZipFile) as e:
+            logger.error(f"{Colors.RED}Failed to create fastboot package: {e}{Colors.NC}")
+            return False
+        return True
+
+    def _last_build_path(self, out_dir: str) -> str:
+        return os.path.join(self.state_dir, f"last-build-{out_dir}.json")
+
+    def _record_last_build(self, lane: BuildLane, variant: str) -> None:
+        """Remember what the output directory now contains, for the next clean decision"""
+        snapshot = ManifestSnapshot.load(os.path.join(self.state_dir, "last-sync.json"))
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self._last_build_path(lane.out_dir), "w") as f:
+            json.dump({
+                "device": self.options.device,
+                "variant": variant,
+                "built_at": time.time(),
+                "snapshot": snapshot.projects if snapshot else None
+            }, f)
+
+    def _decide_clean(self, lane: BuildLane, variant: str) -> CleanDecision:
+        if self.options.clean_build is True:
+            return CleanDecision("full", "clean build requested with --clean")
+        if self.options.clean_build is False:
+            return CleanDecision("none", "cleaning disabled with --no-clean")
+        last_build = None
+        if os.path.isfile(self._last_build_path(lane.out_dir)):
+            with open(self._last_build_path(lane.out_dir)) as f:
+                last_build = json.load(f)
+        current = ManifestSnapshot.load(os.path.join(self.state_dir, "last-sync.json"))
+        return self.clean_policy.decide(variant, lane.out_dir, last_build, current)
+
+    def clean_output(self, lane: BuildLane, variant: str) -> bool:
+        """Clean the lane's build output as decided by the clean policy"""
+        decision = self._decide_clean(lane, variant)
+        self.summary["clean"][variant] = decision.to_dict()
+        logger.info(f"{Colors.CYAN}Clean decision for {variant}:{Colors.NC} {decision.mode} ({decision.reason})")
+
+        if decision.mode == "full":
+            logger.info(f"{Colors.YELLOW}Running clean build...{Colors.NC}")
+            cmd = BuildPlanner.make_command("clean", lane.jobs)
+        elif decision.mode == "installclean":
+            logger.info(f"{Colors.YELLOW}Running incremental build...{Colors.NC}")
+            cmd = BuildPlanner.make_command("installclean", lane.jobs)
+        elif decision.mode == "targeted":
+            for path in decision.paths:
+                full_path = os.path.join(self.rom_path, path)
+                logger.info(f"{Colors.YELLOW}Removing {path}{Colors.NC}")
+                if not self.options.dry_run and os.path.isdir(full_path):
+                    shutil.rmtree(full_path)
+            return True
+        else:
+            return True
+
+        if self.run_in_shell(lane, cmd, step=f"clean-{variant}") != 0:
+            logger.error(f"{Colors.RED}Failed to clean the build output{Colors.NC}")
+            return False
         return True
 
+    def write_trace(self) -> Optional[str]:
+        """Write the run's phases, sync and ninja spans and host counters as a Chrome trace"""
+        self.sampler.stop()
+        trace = RunTrace(self.start_time)
+        trace.add_phases(self.timer.phases)
+        repo_spans = [span for path in self.repo_event_logs for span in read_repo_event_log(path)]
+        if repo_spans:
+            trace.add_spans("repo sync", repo_spans)
+        for name, spans in self.trace_spans:
+            trace.add_spans(name, spans)
+        trace.add_counters(self.sampler.samples)
+        path = os.path.join(self.log_dir, "trace.json")
+        try:
+            os.makedirs(self.log_dir, exist_ok=True)
+            trace.write(path, {"rom": self.options.rom, "device": self.options.device, "started": self.start_time})
+        except OSError as e:
+            logger.warning(f"{Colors.YELLOW}Warning: could not write trace {path}: {e}{Colors.NC}")
+            return None
+        return path
+
+    def write_build_report(self, failed: List[str]) -> Optional[str]:
+        """Write the phase timings and run summary to the release directory"""
+        self.timer.stop()
+        trace = self.write_trace()
+        if trace:
+            self.summary["trace"] = trace
+        finished = time.time()
+        report = {
+            "rom": self.options.rom,
+            "device": self.options.device,
+            "variants": self._build_variants(),
+            "fastboot": self.options.build_fastboot,
+            "date": self.options.date_string,
+            "started": self.start_time,
+            "finished": finished,
+            "wall_s": round(finished - self.start_time, 3),
+            "result": "failed" if failed else "success",
+            "failed_steps": failed,
+            "dry_run": self.options.dry_run,
+            "log_dir": self.log_dir,
+            "phases": self.timer.phases
+        }
+        report.update(self.summary)
+        # Revisions the build used, for relating later regressions to project changes
+        snapshot = ManifestSnapshot.load(os.path.join(self.state_dir, "last-sync.json"))
+        if snapshot is not None:
+            report["manifest"] = os.path.join(self.release_dir, f"manifest-{self.options.date_string}.json")
+            snapshot.save(report["manifest"])
+        path: Optional[str] = os.path.join(self.release_dir, f"build-{self.options.date_string}.json")
+        try:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=1)
+        except OSError as e:
+            logger.warning(f"{Colors.YELLOW}Warning: could not write build report {path}: {e}{Colors.NC}")
+            path = None
+
+        if not self.options.dry_run:
+            try:
+                self.history.record(report, self.resources or HostResources.detect(self.rom_path), path)
+            except sqlite3.Error as e:
+                logger.warning(f"{Colors.YELLOW}Warning: could not record the run in {self.history.path}: {e}{Colors.NC}")
+        return path
+
+    def _log_phases(self) -> None:
+        for phase in self.timer.phases:
+            target = phase["variant"] or (phase.get("lane") if phase.get("lane") != "main" else None)
+            label = phase["name"] + (f" ({target}{', fastboot' if phase['fastboot'] else ''})" if target else "")
+            cpu = f"{phase['cpu_s']:.0f}s" if phase["cpu_s"] is not None else "?"
+            jobs = f", -j{phase['jobs']}" if phase.get("jobs") and phase["name"] in ("build", "clean") else ""
+            status = "" if phase["ok"] else f" {Colors.RED}failed{Colors.NC}"
+            logger.info(f"{Colors.CYAN}  {label:<28}{Colors.NC} {phase['wall_s']:9.1f}s wall, {cpu} CPU, "
+                        f"{phase['peak_rss_mb']} MiB peak{jobs}{status}")
+
+    def _log_summary(self) -> None:
+        logger.info(f"{Colors.BLUE}=== Run summary ==={Colors.NC}")
+        self._log_phases()
+        if "schedule" in self.summary:
+            logger.info(f"{Colors.CYAN}Schedule:{Colors.NC} {self.summary['schedule']}")
+        if "jobs" in self.summary:
+            values = ", ".join(f"{variant} -j{jobs}" for variant, jobs in self.summary["jobs"]["values"].items())
+            logger.info(f"{Colors.CYAN}Build jobs:{Colors.NC} {values} ({self.summary['jobs']['model']})")
+        for variant, decision in self.summary["clean"].items():
+            logger.info(f"{Colors.CYAN}Clean ({variant}):{Colors.NC} {decision['mode']} - {decision['reason']}")
+        if "estimated_build_s" in self.summary and "build_wall_s" in self.summary:
+            logger.info(f"{Colors.CYAN}Build steps:{Colors.NC} took {format_duration(self.summary['build_wall_s'] / 60)}, "
+                        f"estimated {format_duration(self.summary['estimated_build_s'] / 60)}")
+        interventions = self.summary.get("watchdog", [])
+        if interventions:
+            pauses = [item for item in interventions if item["action"] == "pause"]
+            logger.info(f"{Colors.CYAN}Memory watchdog:{Colors.NC} {len(pauses)} pauses "
+                        f"({', '.join(sorted(set(item['process'] for item in pauses)))}), "
+                        f"lowest available memory {min(item['available_gb'] for item in interventions):.1f} GiB")
+        for step, progress in self.summary.get("progress", {}).items():
+            logger.info(f"{Colors.CYAN}Actions ({step}):{Colors.NC} {progress['actions']} in {progress['stages']} ninja runs, "
+                        f"{progress['actions_per_s']:.1f}/s")
+        for step, path in self.summary.get("ninja", {}).items():
+            logger.info(f"{Colors.CYAN}Ninja report ({step}):{Colors.NC} {path}")
+        if "trace" in self.summary:
+            logger.info(f"{Colors.CYAN}Trace (open in ui.perfetto.dev):{Colors.NC} {self.summary['trace']}")
+        for step, report in self.summary["ccache"].items():
+            logger.info(f"{Colors.CYAN}ccache ({step}):{Colors.NC} {report['hit_rate']:.1%} hit rate, "
+                        f"{report['hits']} hits / {report['misses']} misses, ~{report['bytes_saved'] / 1024 ** 3:.1f} GiB saved")
+
+    def _build_variants(self) -> List[str]:
+        if self.options.rom == "axion" and self.options.variant == "both":
+            return ["vanilla", "gms"]
+        return [self.options.variant]
+
+    def schedule_lanes(self) -> List[BuildLane]:
+        """Split the variants into build jobs that fit this host"""
+        self.resources = HostResources.detect(self.rom_path)
+        scheduler = BuildScheduler(self.resources, self.rom_path)
+        lanes = scheduler.schedule(self._build_variants(), self.options.concurrent)
+        self.summary["jobs"] = {
+            "values": {variant: lane.jobs for lane in lanes for variant in lane.variants},
+            "model": scheduler.calculator.describe(len(lanes))
+        }
+        if len(lanes) > 1:
+            description = " || ".join(f"{lane.name} ({lane.out_dir}/, -j{lane.jobs})" for lane in lanes)
+            self.summary["schedule"] = f"concurrent: {description} - {scheduler.reason}"
+        else:
+            self.summary["schedule"] = f"sequential - {scheduler.reason}"
+        return lanes
+
+    def make_plan(self) -> BuildPlanner:
+        return BuildPlanner(
+            self.options.rom,
+            self.options.device,
+            self._build_variants(),
+            self.options.build_fastboot,
+            self.options.clean_build,
+            {variant: lane.jobs for lane in self.lanes for variant in lane.variants},
+            self._estimate_step
+        )
+
+    def _lane_for(self, variant: str) -> BuildLane:
+        return next(lane for lane in self.lanes if variant in lane.variants)
+
+    def _estimate_phase(self, name: str, variant: Optional[str] = None, fastboot: bool = False,
+                        clean_mode: Optional[str] = None) -> Optional[Tuple[float, int]]:
+        """Minutes and sample count from the build history"""
+        cpus = self.resources.cpus if self.resources else (os.cpu_count() or 4)
+        try:
+            estimate = self.history.estimate(self.options.rom, self.options.device, name, variant, fastboot, clean_mode, cpus)
+        except sqlite3.Error as e:
+            logger.warning(f"{Colors.YELLOW}Warning: could not read build history: {e}{Colors.NC}")
+            return None
+        return (estimate[0] / 60, estimate[1]) if estimate else None
+
+    def _estimate_step(self, step: PlanStep) -> Optional[Tuple[float, int]]:
+        clean_mode = None
+        if step.kind in ("clean", "build"):
+            # Build time depends mostly on how much of out/ survived
+            clean_mode = self._decide_clean(self._lane_for(step.variant), step.variant).mode
+        name = "copy" if step.kind == "publish" else step.kind
+        return self._estimate_phase(name, step.variant, step.fastboot, clean_mode)
+
+    def _setup_phases(self) -> List[str]:
+        """Phases that run before the build steps, as recorded in the history"""
+        if self.options.skip_sync:
+            return ["manifest-fetch", "sync"]
+        phases = {"all": ["mirror-update", "repo-init", "manifest-fetch", "sync-fetch", "sync-checkout"],
+                  "fetch": ["mirror-update", "repo-init", "manifest-fetch", "sync-fetch"],
+                  "checkout": ["sync-checkout"]}[self.options.sync_phase]
+        if self.options.full_sync:
+            phases.insert(0, "rmtree")
+        return phases
+
+    def _remaining_minutes(self) -> float:
+        """Estimated time until all lanes finish their pending steps"""
+        with self.state_lock:
+            pending = list(self.pending.values())
+        per_lane: Dict[str, float] = {}
+        for lane_name, cost in pending:
+            per_lane[lane_name] = per_lane.get(lane_name, 0.0) + cost
+        return max(per_lane.values(), default=0.0)
+
+    def _log_eta(self) -> None:
+        remaining = self._remaining_minutes()
+        finish = datetime.fromtimestamp(time.time() + remaining * 60).strftime("%H:%M")
+        logger.info(f"{Colors.CYAN}ETA: ~{format_duration(remaining)} remaining (around {finish}){Colors.NC}")
+
+    def print_estimate(self) -> None:
+        """Predict the duration of the planned matrix from the build history"""
+        self.lanes = self.schedule_lanes()
+        steps = self.make_plan().plan()
+        logger.info(f"{Colors.BLUE}=== Estimate: {self.rom_info.name} for {self.options.device} ({', '.join(self._build_variants())}"
+                    f"{', fastboot' if self.options.build_fastboot else ''}) on {self.history.host} ==={Colors.NC}")
+
+        setup = 0.0
+        for name in self._setup_phases() + ["envsetup"]:
+            estimate = self._estimate_phase(name)
+            if estimate:
+                setup += estimate[0]
+            source = f"median of {estimate[1]}" if estimate else "no history"
+            logger.info(f"  {name:<28} ~{format_duration(estimate[0]) if estimate else '?':<8} ({source})")
+
+        lane_totals = []
+        for lane in self.lanes:
+            lane_steps = [step for step in steps if step.variant in lane.variants]
+            for step in lane_steps:
+                source = f"median of {step.samples}" if step.samples else "default"
+                logger.info(f"  {step.key:<28} ~{format_duration(step.cost):<8} ({source})")
+            lane_totals.append(sum(step.cost for step in lane_steps))
+
+        total = setup + max(lane_totals, default=0.0)
+        finish = datetime.fromtimestamp(time.time() + total * 60).strftime("%a %H:%M")
+        logger.info(f"{Colors.CYAN}Schedule:{Colors.NC} {self.summary['schedule']}")
+        logger.info(f"{Colors.CYAN}Estimated total:{Colors.NC} {format_duration(total)}, finishing around {finish} if started now")
+        logger.info(f"{Colors.CYAN}History:{Colors.NC} {self.history.runs(self.options.rom, self.options.device)} successful runs on this host "
+                    f"in {self.history.path}")
+
+    def print_plan(self) -> None:
+        """Print the step DAG and its estimated cost without executing anything"""
+        self.lanes = self.schedule_lanes()
+        planner = self.make_plan()
+        steps = planner.plan()
+        logger.info(f"{Colors.BLUE}=== Build plan: {self.rom_info.name} for {self.options.device} ({', '.join(self._build_variants())}"
+                    f"{', fastboot' if self.options.build_fastboot else ''}) ==={Colors.NC}")
+        for index, step in enumerate(steps, 1):
+            deps = f" <- {', '.join(step.deps)}" if step.deps else ""
+            merged = f" (merged x{step.merged + 1})" if step.merged else ""
+            command = f" [{step.command}]" if step.command else ""
+            history = " (history)" if step.samples else ""
+            logger.info(f"{index:3d}. {step.key:<28} ~{format_duration(step.cost)}{history}{merged}{command}{Colors.CYAN}{deps}{Colors.NC}")
+        total = sum(step.cost for step in steps)
+        if any(step.samples for step in steps):
+            # The independent-pass baseline only exists in default costs
+            logger.info(f"{Colors.CYAN}Estimated total:{Colors.NC} {format_duration(total)} (from build history)")
+        else:
+            naive = planner.naive_cost()
+            logger.info(f"{Colors.CYAN}Estimated total:{Colors.NC} {format_duration(total)} "
+                        f"(independent passes: {format_duration(naive)}, saved {format_duration(naive - total)})")
+        logger.info(f"{Colors.CYAN}Schedule:{Colors.NC} {self.summary['schedule']}")
+
+    def _run_step(self, lane: BuildLane, step: PlanStep) -> bool:
+        """Execute one plan step in the lane's build shell, timing each phase"""
+        if lane.shell is None and not self.options.dry_run and self._start_build_shell(lane) != 0:
+            return False
+        if lane.configured_variant != step.variant:
+            with self.timer.measure("configure", step.variant, lane=lane.name,
+                                    shell=lambda: self._shell_pid(lane)) as phase:
+                phase["ok"] = self._configure_device(lane, step.variant)
+            if not phase["ok"]:
+                return False
+        elif not self._configure_device(lane, step.variant):
+            return False
+        if step.kind == "configure":
+            return True
+
+        name = "copy" if step.kind == "publish" else step.kind
+        with self.timer.measure(name, step.variant, step.fastboot, lane=lane.name, jobs=lane.jobs,
+                                shell=None if step.kind == "publish" else lambda: self._shell_pid(lane),
+                                children=step.kind != "publish") as phase:
+            phase["ok"] = self._run_step_kind(lane, step)
+            if step.kind in ("clean", "build"):
+                phase["clean_mode"] = self.summary["clean"].get(step.variant, {}).get("mode")
+        return phase["ok"]
+
+    def _run_step_kind(self, lane: BuildLane, step: PlanStep) -> bool:
+        if step.kind == "clean":
+            return self.clean_output(lane, step.variant)
+        if step.kind == "build":
+            if not self.build_rom(lane, step.variant, False):
+                return False
+            if not self.options.dry_run:
+                self._record_last_build(lane, step.variant)
+            return True
+        if step.kind == "package":
+            return self.package_fastboot(lane, step.variant)
+        if step.kind == "publish":
+            # Variants share release file names such as boot.img
+            with self.state_lock:
+                if self.options.dry_run:
+                    self._simulate_artifacts(step.variant, step.fastboot)
+                    return True
+                return self._copy_artifacts(step.variant, step.fastboot, self._product_out(lane))
+        raise ValueError(f"unknown plan step kind '{step.kind}'")
+
+    def _shell_pids(self) -> List[int]:
+        return [lane.shell.process.pid for lane in self.lanes
+                if lane.shell is not None and lane.shell.process is not None]
+
+    def execute_plan(self, steps: List[PlanStep]) -> List[str]:
+        """Run the plan under the memory watchdog. Returns failed keys."""
+        if self.options.dry_run or not os.path.isfile("/proc/meminfo"):
+            return self._execute_lanes(steps)
+        watchdog = MemoryWatchdog(self._shell_pids)
+        watchdog.start()
+        try:
+            return self._execute_lanes(steps)
+        finally:
+            watchdog.stop()
+            self.summary["watchdog"] = watchdog.interventions
+
+    def _execute_lanes(self, steps: List[PlanStep]) -> List[str]:
+        """Run each lane's steps, concurrently when there are several lanes. Returns failed keys."""
+        self.pending = {step.key: (self._lane_for(step.variant).name, step.cost) for step in steps}
+        if len(self.lanes) == 1:
+            return self._execute_lane(self.lanes[0], steps)
+
+        results: Dict[str, List[str]] = {}
+        threads = []
+        for lane in self.lanes:
+            lane_steps = [step for step in steps if step.variant in lane.variants]
+            thread = threading.Thread(
+                target=lambda lane=lane, lane_steps=lane_steps: results.__setitem__(lane.name, self._execute_lane(lane, lane_steps)),
+                name=f"build-{lane.name}",
+                daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        # A lane that raised never stored its result, so count all of its steps as failed
+        return [step.key for lane in self.lanes for step in steps
+                if step.variant in lane.variants and (lane.name not in results or step.key in results[lane.name])]
+
+    def _execute_lane(self, lane: BuildLane, steps: List[PlanStep]) -> List[str]:
+        """Run steps in order, skipping steps whose dependencies failed. Returns failed keys."""
+        done: Set[str] = set()
+        failed: List[str] = []
+        for step in steps:
+            missing = [dep for dep in step.deps if dep not in done]
+            if missing:
+                logger.warning(f"{Colors.YELLOW}Skipping {step.key}: {', '.join(missing)} did not complete{Colors.NC}")
+                failed.append(step.key)
+                with self.state_lock:
+                    self.pending.pop(step.key, None)
+                continue
+            logger.info(f"{Colors.BLUE}=== {step.describe()} ==={Colors.NC}")
+            if step.kind == "build":
+                self._log_eta()
+            if self._run_step(lane, step):
+                done.add(step.key)
+            else:
+                failed.append(step.key)
+            with self.state_lock:
+                self.pending.pop(step.key, None)
+        return failed
+
     def run(self) -> int:
         """Main execution flow"""
         # Start tracking time
         self.start_time = time.time()
+        self.sampler.start()
         
         # Setup environment
         if not self.setup_environment():
+            self.write_build_report(["setup"])
             return 1
+
+        # A fetch-only run leaves the checkout for a later invocation
+        if not self.options.skip_sync and self.options.sync_phase == "fetch":
+            self._log_phases()
+            self.write_build_report([])
+            self.show_elapsed_time()
+            return 0
         
-        # Note about limitation
-        logger.info(f"{Colors.YELLOW}Note: This Python script can only simulate the ROM build process{Colors.NC}")
-        logger.info(f"{Colors.YELLOW}because it cannot source the Android build environment directly.{Colors.NC}")
-        logger.info(f"{Colors.YELLOW}For actual builds, use rom-builder.sh{Colors.NC}")
+        if self.options.dry_run:
+            logger.info(f"{Colors.YELLOW}Dry run: build commands are logged but not executed{Colors.NC}")
         
-        # Build ROM based on variant
-        if self.options.rom == "axion" and self.options.variant == "both":
-            # Build vanilla without fastboot
-            logger.info(f"{Colors.BLUE}=== Building vanilla variant ==={Colors.NC}")
-            self.build_rom("vanilla", False)
-            
-            # If fastboot is requested, also build vanilla fastboot
-            if self.options.build_fastboot:
-                logger.info(f"{Colors.BLUE}=== Building vanilla variant with fastboot ==={Colors.NC}")
-                self.build_rom("vanilla", True)
-            
-            # Build GMS without fastboot
-            logger.info(f"{Colors.BLUE}=== Building GMS variant ==={Colors.NC}")
-            self.build_rom("gms", False)
-            
-            # If fastboot is requested, also build GMS fastboot
-            if self.options.build_fastboot:
-                logger.info(f"{Colors.BLUE}=== Building GMS variant with fastboot ==={Colors.NC}")
-                self.build_rom("gms", True)
-        else:
-            # Build single variant without fastboot
-            logger.info(f"{Colors.BLUE}=== Building {self.options.variant} variant ==={Colors.NC}")
-            self.build_rom(self.options.variant, False)
-            
-            # If fastboot is requested, build it with fastboot
-            if self.options.build_fastboot:
-                logger.info(f"{Colors.BLUE}=== Building {self.options.variant} variant with fastboot ==={Colors.NC}")
-                self.build_rom(self.options.variant, True)
+        # Build the planned rom x device x variant x fastboot matrix
+        self.lanes = self.schedule_lanes()
+        logger.info(f"{Colors.CYAN}Schedule:{Colors.NC} {self.summary['schedule']}")
+        self.setup_ccache()
+        steps = self.make_plan().plan()
+        self.summary["estimated_build_s"] = round(max(
+            (sum(step.cost for step in steps if step.variant in lane.variants) for lane in self.lanes), default=0.0) * 60)
+        build_started = time.time()
+        try:
+            failed = self.execute_plan(steps)
+        finally:
+            self.close_build_shell()
+        self.summary["build_wall_s"] = round(time.time() - build_started)
         
-        logger.info(f"{Colors.BLUE}=== All builds complete ==={Colors.NC}")
+        if failed:
+            logger.error(f"{Colors.RED}=== Failed steps: {', '.join(failed)} ==={Colors.NC}")
+        else:
+            logger.info(f"{Colors.BLUE}=== All builds complete ==={Colors.NC}")
         logger.info(f"{Colors.GREEN}ROM files are available in: {self.release_dir}{Colors.NC}")
+        report = self.write_build_report(failed)
+        self._log_summary()
+        if report:
+            logger.info(f"{Colors.CYAN}Build report:{Colors.NC} {report}")
         
         # Show elapsed time
         self.show_elapsed_time()
         
-        return 0
+        return 1 if failed else 0
+
+
+def compare_main(argv: List[str]) -> int:
+    """Compare two recorded builds: rom-builder.py compare [OLD NEW]"""
+    parser = argparse.ArgumentParser(prog="rom-builder.py compare", description="Compare the timings of two recorded builds")
+    parser.add_argument("old", nargs="?", help="Older build: history run id or build report JSON (default: second latest run)")
+    parser.add_argument("new", nargs="?", help="Newer build: history run id or build report JSON (default: latest run)")
+    parser.add_argument("-r", "--rom", default="axion", help="ROM of the runs to pick from history")
+    parser.add_argument("-d", "--device", default="pipa", help="Device of the runs to pick from history")
+    parser.add_argument("-v", "--variant", default=None, help="Only compare phases and ninja logs of this variant")
+    parser.add_argument("--json", dest="json_path", metavar="FILE", help="Also write the comparison as JSON")
+    args = parser.parse_args(argv)
+
+    history = BuildHistory(os.path.join(os.path.expanduser("~"), ".cache", "rom-builder", "history.db"))
+    if args.new is None:
+        # Runs from before reports were archived per run may share a file
+        paths = list(dict.fromkeys(path for _, path in history.reports(args.rom, args.device)))[:2][::-1]
+        if len(paths) < 2 or args.old is not None:
+            logger.error(f"{Colors.RED}Error: give two builds, or record at least two successful {args.rom}/{args.device} runs{Colors.NC}")
+            return 1
+    else:
+        paths = []
+        for build in (args.old, args.new):
+            path = history.report_path(int(build)) if build.isdigit() else build
+            if path is None:
+                logger.error(f"{Colors.RED}Error: no recorded run {build} in {history.path}{Colors.NC}")
+                return 1
+            paths.append(path)
+        if os.path.realpath(paths[0]) == os.path.realpath(paths[1]):
+            logger.error(f"{Colors.RED}Error: both builds resolve to {paths[0]}: the same run, or runs of one day "
+                         f"recorded before reports were kept per run{Colors.NC}")
+            return 1
+
+    try:
+        old, new = (BuildComparison.load_report(path) for path in paths)
+    except (OSError, ValueError) as e:
+        logger.error(f"{Colors.RED}Error: could not read build report: {e}{Colors.NC}")
+        return 1
+    if old["started"] > new["started"]:
+        old, new = new, old
 
+    # Runs before the newer build, the older one included, show how much each value normally varies
+    baseline = []
+    seen = {new["path"]}
+    for _, path in history.reports(new["rom"], new["device"], before=new["started"]):
+        if path in seen:
+            continue
+        seen.add(path)
+        try:
+            baseline.append(BuildComparison.load_report(path))
+        except (OSError, ValueError):
+            continue
+
+    result = BuildComparison(old, new, baseline, args.variant).compare()
+    BuildComparison.log(result)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(result, f, indent=1)
+        logger.info(f"{Colors.CYAN}Comparison written to {args.json_path}{Colors.NC}")
+    return 0
 
 def main():
     """Main function to parse arguments and run the builder"""
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        return compare_main(sys.argv[2:])
     parser = argparse.ArgumentParser(description="ROM Builder")
     
     parser.add_argument("-r", "--rom", default="axion", help="Specify ROM: axion or lmodroid")
     parser.add_argument("-d", "--device", default="pipa", help="Specify target device: pipa or raven")
     parser.add_argument("-v", "--variant", default="vanilla", help="Variant for Axion: vanilla, gms, or both")
     parser.add_argument("-s", "--skip-sync", action="store_true", help="Skip repository sync step")
-    parser.add_argument("-c", "--clean", dest="clean_build", action="store_true", default=True, help="Force clean build (default)")
+    parser.add_argument("--full-sync", action="store_true", help="Delete the source tree and sync from scratch instead of refreshing it")
+    parser.add_argument("--mirror", dest="mirror_dir", nargs="?", const=os.path.expanduser("~/.cache/rom-builder/mirror"), default=None, metavar="DIR", help="Share git objects between ROM trees through a local mirror (default: ~/.cache/rom-builder/mirror)")
+    parser.add_argument("--sync-phase", choices=["all", "fetch", "checkout"], default="all", help="Run only the network fetch, only the local checkout, or both (default)")
+    parser.add_argument("--sync-profile", default="default", metavar="FILE", help="JSON file with clone depth/partial-clone rules per project path, 'default' for the built-in profile or 'none'")
+    parser.add_argument("--slim-rules", default="default", metavar="FILE", help="JSON rules for generated remove-project entries, 'default' for the built-in rules or 'none'")
+    parser.add_argument("-c", "--clean", dest="clean_build", action="store_const", const=True, default=None, help="Force a full clean build (default: decide from what changed)")
+    parser.add_argument("--no-clean", dest="clean_build", action="store_const", const=False, help="Never clean the build output")
     parser.add_argument("-f", "--fastboot", dest="build_fastboot", action="store_true", help="Build fastboot flashable package")
+    parser.add_argument("--ccache-dir", default=os.path.expanduser("~/.ccache"), metavar="DIR", help="Compiler cache directory (default: ~/.ccache)")
+    parser.add_argument("--ccache-size", default="50G", metavar="SIZE", help="Maximum compiler cache size (default: 50G)")
+    parser.add_argument("--no-ccache", action="store_true", help="Build without a compiler cache")
+    parser.add_argument("--no-concurrent", dest="concurrent", action="store_false", help="Build variants one after another even when the host could build them in parallel")
+    parser.add_argument("--dry-run", action="store_true", help="Log the build commands instead of running them")
+    parser.add_argument("--verbose", action="store_true", help="Show the raw build output instead of a progress line")
+    parser.add_argument("--plan", dest="plan_only", action="store_true", help="Print the build step DAG and its estimated cost, then exit")
+    parser.add_argument("--estimate", dest="estimate_only", action="store_true", help="Predict the duration of the planned builds from past runs, then exit")
     
     args = parser.parse_args()
     
@@ -420,6 +4131,12 @@ def main():
     if args.variant not in ["vanilla", "gms", "both"]:
         logger.error(f"{Colors.RED}Error: Invalid variant '{args.variant}'. Valid options are: vanilla, gms, both{Colors.NC}")
         return 1
+
+    try:
+        parse_size(args.ccache_size)
+    except ValueError:
+        logger.error(f"{Colors.RED}Error: Invalid ccache size '{args.ccache_size}'. Use a size such as 50G or 500M{Colors.NC}")
+        return 1
     
     # Create options object from arguments
     options = BuildOptions(
@@ -427,12 +4144,30 @@ def main():
         device=args.device,
         variant=args.variant,
         skip_sync=args.skip_sync,
+        full_sync=args.full_sync,
+        sync_phase=args.sync_phase,
+        sync_profile=args.sync_profile,
+        slim_rules=args.slim_rules,
+        mirror_dir=os.path.abspath(os.path.expanduser(args.mirror_dir)) if args.mirror_dir else None,
         clean_build=args.clean_build,
-        build_fastboot=args.build_fastboot
+        build_fastboot=args.build_fastboot,
+        concurrent=args.concurrent,
+        ccache_dir=None if args.no_ccache else os.path.abspath(os.path.expanduser(args.ccache_dir)),
+        ccache_size=args.ccache_size,
+        dry_run=args.dry_run,
+        verbose=args.verbose,
+        plan_only=args.plan_only,
+        estimate_only=args.estimate_only
     )
     
     # Create and run the builder
     builder = RomBuilder(options)
+    if options.plan_only:
+        builder.print_plan()
+        return 0
+    if options.estimate_only:
+        builder.print_estimate()
+        return 0
     return builder.run()
 
 
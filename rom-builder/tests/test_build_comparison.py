@@ -0,0 +1,91 @@
+"""Tests for BuildComparison, the build-to-build regression report"""
+import importlib.util
+import json
+import os
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rom-builder.py")
+spec = importlib.util.spec_from_file_location("rom_builder", SCRIPT)
+rom_builder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rom_builder)
+
+
+def phase(name, wall_s, variant=None, ok=True):
+    return {"name": name, "variant": variant, "fastboot": False, "ok": ok, "wall_s": wall_s}
+
+
+def report(sync_s=600.0, build_s=3600.0, clean="none", **extra):
+    return dict({
+        "rom": "axion", "device": "pipa", "wall_s": sync_s + build_s, "result": "success",
+        "phases": [phase("sync-fetch", sync_s), phase("build", build_s, "vanilla")],
+        "clean": {"vanilla": {"mode": clean, "reason": "", "paths": []}},
+    }, **extra)
+
+
+class BuildComparisonTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "w") as f:
+            json.dump(data, f)
+        return path
+
+    def phase_names(self, old, new, baseline=()):
+        result = rom_builder.BuildComparison(old, new, baseline).compare()
+        return [delta["name"] for delta in result["phases"]]
+
+    def test_small_differences_are_ignored(self):
+        # 20s is below the absolute minimum, 200s is below 10% of the build
+        self.assertEqual(self.phase_names(report(sync_s=600), report(sync_s=620, build_s=3800)), [])
+
+    def test_slower_phase_is_reported(self):
+        result = rom_builder.BuildComparison(report(), report(build_s=5400)).compare()
+        self.assertEqual([(d["name"], d["delta_s"]) for d in result["phases"]], [("build (vanilla)", 1800.0)])
+
+    def test_failed_phases_are_not_compared(self):
+        new = report(build_s=5400)
+        new["phases"][1]["ok"] = False
+        self.assertEqual(self.phase_names(report(), new), [])
+
+    def test_noisy_phase_within_baseline_spread(self):
+        baseline = [report(sync_s=seconds) for seconds in (300, 900, 500, 1100, 700)]
+        self.assertEqual(self.phase_names(report(sync_s=600), report(sync_s=1000), baseline), [])
+        self.assertEqual(self.phase_names(report(sync_s=600), report(sync_s=4000), baseline), ["sync-fetch"])
+
+    def test_clean_mode_and_device_differences_are_warned_about(self):
+        result = rom_builder.BuildComparison(report(), report(clean="full", device="raven")).compare()
+        self.assertIn("different device: pipa vs raven", result["warnings"])
+        self.assertIn("vanilla: none build vs full build", result["warnings"])
+
+    def test_slowdown_is_matched_to_changed_project(self):
+        snapshot = {"frameworks/base": {"name": "p/fb", "revision": "a", "remote": "o", "groups": ""},
+                    "art": {"name": "p/art", "revision": "a", "remote": "o", "groups": ""}}
+        old_manifest = self.write("old-manifest.json", snapshot)
+        snapshot["frameworks/base"] = dict(snapshot["frameworks/base"], revision="b")
+        new_manifest = self.write("new-manifest.json", snapshot)
+
+        def ninja(name, framework_ms, art_ms):
+            analysis = {
+                "wall_ms": framework_ms + art_ms, "actions": 2, "critical_path": {"actions_ms": framework_ms},
+                "slowest": [], "modules": [],
+                "projects": [{"project": "frameworks/base", "ms": framework_ms}, {"project": "art", "ms": art_ms}],
+            }
+            return self.write(name, {"out_dir": "out", "logs": {"out/.ninja_log": analysis}})
+
+        old = report(manifest=old_manifest, ninja={"build-vanilla": ninja("old-ninja.json", 600000, 300000)})
+        new = report(manifest=new_manifest, ninja={"build-vanilla": ninja("new-ninja.json", 900000, 302000)})
+        result = rom_builder.BuildComparison(old, new).compare()
+        self.assertEqual(result["manifest"]["moved"], ["frameworks/base"])
+        self.assertEqual(result["causes"], [{"project": "frameworks/base", "delta_s": 300.0}])
+        projects = result["steps"]["build-vanilla"]["projects"]
+        self.assertEqual([(d["name"], d["changed"]) for d in projects], [("frameworks/base", True)])
+
+
+if __name__ == "__main__":
+    unittest.main()
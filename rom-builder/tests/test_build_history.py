@@ -0,0 +1,90 @@
+"""Tests for the SQLite build history and its duration estimates"""
+import importlib.util
+import os
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rom-builder.py")
+spec = importlib.util.spec_from_file_location("rom_builder", SCRIPT)
+rom_builder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rom_builder)
+
+
+def resources(cpus):
+    return rom_builder.HostResources(cpus=cpus, memory_total_gb=64, memory_available_gb=60, disk_free_gb=500)
+
+
+def report(started, build_s, result="success", sync_s=600.0, clean_mode="none"):
+    return {
+        "started": started, "finished": started + build_s + sync_s, "wall_s": build_s + sync_s,
+        "result": result, "rom": "axion", "device": "pipa", "variants": ["vanilla"], "fastboot": False,
+        "phases": [
+            {"name": "sync-fetch", "variant": None, "fastboot": False, "ok": result == "success",
+             "start": started, "wall_s": sync_s, "cpu_s": 10.0, "peak_rss_mb": 100},
+            {"name": "build", "variant": "vanilla", "fastboot": False, "lane": "main", "jobs": 16,
+             "clean_mode": clean_mode, "ok": result == "success", "start": started + sync_s,
+             "wall_s": build_s, "cpu_s": build_s * 16, "peak_rss_mb": 30000},
+        ],
+    }
+
+
+class BuildHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "history.db")
+        self.history = rom_builder.BuildHistory(self.path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def on_host(self, host):
+        history = rom_builder.BuildHistory(self.path)
+        history.host = host
+        return history
+
+    def test_no_history(self):
+        self.assertIsNone(self.history.estimate("axion", "pipa", "build", "vanilla"))
+        self.assertEqual(self.history.runs("axion", "pipa"), 0)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_median_of_successful_phases(self):
+        for index, build_s in enumerate([3000, 5000, 4000]):
+            self.history.record(report(1000 * index, build_s), resources(16), None)
+        self.history.record(report(5000, 100, result="failure"), resources(16), None)
+        self.assertEqual(self.history.estimate("axion", "pipa", "build", "vanilla"), (4000, 3))
+        self.assertEqual(self.history.estimate("axion", "pipa", "sync-fetch"), (600, 3))
+        self.assertEqual(self.history.runs("axion", "pipa"), 3)
+
+    def test_only_latest_samples_count(self):
+        samples = rom_builder.Config.HISTORY_SAMPLES
+        for index in range(samples + 3):
+            self.history.record(report(1000 * index, 1000 + index), resources(16), None)
+        median, count = self.history.estimate("axion", "pipa", "build", "vanilla")
+        self.assertEqual(count, samples)
+        self.assertGreater(median, 1000 + 3)
+
+    def test_matching_clean_mode_is_preferred(self):
+        self.history.record(report(0, 9000, clean_mode="full"), resources(16), None)
+        self.history.record(report(1000, 1000, clean_mode="none"), resources(16), None)
+        self.assertEqual(self.history.estimate("axion", "pipa", "build", "vanilla", clean_mode="full"), (9000, 1))
+        self.assertEqual(self.history.estimate("axion", "pipa", "build", "vanilla", clean_mode="installclean"), (5000, 2))
+
+    def test_other_hosts_are_scaled_by_cpus(self):
+        self.on_host("big").record(report(0, 2000), resources(32), None)
+        here = self.on_host("small")
+        self.assertEqual(here.estimate("axion", "pipa", "build", "vanilla", cpus=16), (4000, 1))
+        # Not CPU bound, taken as is
+        self.assertEqual(here.estimate("axion", "pipa", "sync-fetch", cpus=16), (600, 1))
+        here.record(report(1000, 3000), resources(16), None)
+        self.assertEqual(here.estimate("axion", "pipa", "build", "vanilla", cpus=16), (3000, 1))
+
+    def test_reports_are_archived_per_run(self):
+        first = self.history.record(report(0, 1000), resources(16), None)
+        second = self.history.record(report(1000, 2000), resources(16), None)
+        self.assertNotEqual(self.history.report_path(first), self.history.report_path(second))
+        self.assertEqual([run_id for run_id, _ in self.history.reports("axion", "pipa")], [second, first])
+        self.assertEqual([run_id for run_id, _ in self.history.reports("axion", "pipa", before=1000)], [first])
+
+
+if __name__ == "__main__":
+    unittest.main()
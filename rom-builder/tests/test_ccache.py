@@ -0,0 +1,44 @@
+"""Tests for CcacheManager.trim in rom-builder.py"""
+import importlib.util
+import os
+import unittest
+from collections import namedtuple
+from unittest import mock
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rom-builder.py")
+spec = importlib.util.spec_from_file_location("rom_builder", SCRIPT)
+rom_builder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rom_builder)
+
+GiB = 1024 ** 3
+Usage = namedtuple("Usage", "total used free")
+
+
+class CcacheTrimTest(unittest.TestCase):
+    def trim(self, cache_gb, free_gb, min_free_gb):
+        ccache = rom_builder.CcacheManager("/tmp/ccache", "50G", "/nonexistent")
+        calls = []
+        ccache._run = lambda args, extra_env=None: calls.append((args, extra_env)) or ""
+        ccache.stats = lambda: {"cache_size_kibibyte": cache_gb * GiB // 1024}
+        with mock.patch.object(rom_builder.shutil, "disk_usage", return_value=Usage(0, 0, free_gb * GiB)):
+            freed = ccache.trim(min_free_gb)
+        return freed, calls
+
+    def test_enough_free_space_leaves_cache_alone(self):
+        freed, calls = self.trim(cache_gb=20, free_gb=100, min_free_gb=60)
+        self.assertIsNone(freed)
+        self.assertEqual(calls, [])
+
+    def test_trims_by_the_deficit(self):
+        _, calls = self.trim(cache_gb=20, free_gb=50, min_free_gb=60)
+        self.assertEqual(calls, [(["--cleanup"], {"CCACHE_MAXSIZE": f"{10 * GiB // 1024}K"})])
+
+    def test_deficit_larger_than_cache_keeps_a_floor(self):
+        _, calls = self.trim(cache_gb=20, free_gb=10, min_free_gb=60)
+        limit = calls[0][1]["CCACHE_MAXSIZE"]
+        self.assertNotEqual(limit, "0K")
+        self.assertEqual(limit, f"{rom_builder.Config.CCACHE_MIN_TRIM_SIZE_GB * GiB // 1024}K")
+
+
+if __name__ == "__main__":
+    unittest.main()
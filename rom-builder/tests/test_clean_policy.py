@@ -0,0 +1,81 @@
+"""Tests for the change-driven CleanPolicy in rom-builder.py"""
+import importlib.util
+import os
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rom-builder.py")
+spec = importlib.util.spec_from_file_location("rom_builder", SCRIPT)
+rom_builder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rom_builder)
+
+BASE = {
+    "build/make": "a1",
+    "frameworks/base": "b1",
+    "kernel/xiaomi/sm8250": "c1",
+    "device/xiaomi/pipa": "d1",
+    "prebuilts/clang/host/linux-x86": "e1",
+}
+
+
+def snapshot(moved=None):
+    revisions = dict(BASE, **(moved or {}))
+    return {path: {"name": f"p/{path}", "revision": revision, "remote": "o", "groups": ""}
+            for path, revision in revisions.items()}
+
+
+class CleanPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp.name, "out"))
+        self.policy = rom_builder.CleanPolicy(self.tmp.name, "pipa")
+        self.last = {"device": "pipa", "variant": "vanilla", "snapshot": snapshot()}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def decide(self, current, variant="vanilla", last_build=None, out_dir="out"):
+        last_build = self.last if last_build is None else last_build
+        current = rom_builder.ManifestSnapshot(current) if current is not None else None
+        return self.policy.decide(variant, out_dir, last_build, current)
+
+    def test_no_output_needs_no_clean(self):
+        self.assertEqual(self.decide(snapshot(), out_dir="out-gms").mode, "none")
+
+    def test_unchanged_sources_need_no_clean(self):
+        self.assertEqual(self.decide(snapshot()).mode, "none")
+
+    def test_unknown_previous_build_is_a_full_clean(self):
+        self.assertEqual(self.policy.decide("vanilla", "out", None, None).mode, "full")
+
+    def test_toolchain_change_is_a_full_clean(self):
+        decision = self.decide(snapshot({"prebuilts/clang/host/linux-x86": "e2", "kernel/xiaomi/sm8250": "c2"}))
+        self.assertEqual(decision.mode, "full")
+        self.assertIn("prebuilts/clang/host/linux-x86", decision.reason)
+
+    def test_kernel_change_removes_kernel_objects_only(self):
+        decision = self.decide(snapshot({"kernel/xiaomi/sm8250": "c2"}))
+        self.assertEqual(decision.mode, "targeted")
+        self.assertEqual(decision.paths, ["out/target/product/pipa/obj/KERNEL_OBJ"])
+
+    def test_device_tree_change_is_an_installclean(self):
+        self.assertEqual(self.decide(snapshot({"device/xiaomi/pipa": "d2"})).mode, "installclean")
+
+    def test_variant_switch_is_an_installclean(self):
+        decision = self.decide(snapshot(), variant="gms")
+        self.assertEqual(decision.mode, "installclean")
+        self.assertIn("vanilla -> gms", decision.reason)
+
+    def test_unknown_sources_are_an_installclean(self):
+        self.assertEqual(self.decide(None).mode, "installclean")
+
+    def test_merge_keeps_the_more_thorough_clean(self):
+        targeted = rom_builder.CleanDecision("targeted", "a", ["x"])
+        merged = targeted.merge(rom_builder.CleanDecision("targeted", "b", ["y"]))
+        self.assertEqual((merged.mode, merged.paths), ("targeted", ["x", "y"]))
+        self.assertEqual(merged.merge(rom_builder.CleanDecision("installclean", "c")).mode, "installclean")
+        self.assertEqual(rom_builder.CleanDecision("full", "d").merge(targeted).mode, "full")
+
+
+if __name__ == "__main__":
+    unittest.main()
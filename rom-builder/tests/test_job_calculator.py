@@ -0,0 +1,41 @@
+"""Tests for the memory- and core-aware -j selection in rom-builder.py"""
+import importlib.util
+import os
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rom-builder.py")
+spec = importlib.util.spec_from_file_location("rom_builder", SCRIPT)
+rom_builder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rom_builder)
+
+
+def calculator(cpus, total, available, swap=0.0):
+    return rom_builder.JobCalculator(rom_builder.HostResources(
+        cpus=cpus, memory_total_gb=total, memory_available_gb=available, disk_free_gb=500, swap_free_gb=swap))
+
+
+class JobCalculatorTest(unittest.TestCase):
+    def test_budget_keeps_host_reserve(self):
+        self.assertEqual(calculator(32, 64, 60).budget_gb(), 64 - rom_builder.Config.HOST_RESERVED_MEMORY_GB)
+
+    def test_budget_counts_part_of_free_swap(self):
+        self.assertEqual(calculator(16, 32, 30, swap=16).budget_gb(), 24 + 16 * rom_builder.Config.SWAP_USABLE_FRACTION)
+
+    def test_cpu_bound_host(self):
+        self.assertEqual(calculator(32, 64, 60).jobs(), 32)
+
+    def test_memory_bound_host(self):
+        # (24 - 3) GiB / 1.5 GiB per job
+        self.assertEqual(calculator(16, 32, 30).jobs(), 14)
+
+    def test_concurrent_builds_split_budget_and_cpus(self):
+        # (56 - 2 * 3) GiB / 1.5 GiB per job, split in two, capped at 32 / 2 CPUs
+        self.assertEqual(calculator(32, 64, 60).jobs(2), 16)
+
+    def test_builds_whose_analysis_does_not_fit(self):
+        self.assertEqual(calculator(8, 16, 15).jobs(), 0)
+        self.assertEqual(calculator(32, 64, 60).jobs(3), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
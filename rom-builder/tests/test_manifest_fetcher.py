@@ -0,0 +1,100 @@
+"""Tests for ManifestFetcher against a local HTTP server"""
+import http.server
+import importlib.util
+import os
+import tempfile
+import threading
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rom-builder.py")
+spec = importlib.util.spec_from_file_location("rom_builder", SCRIPT)
+rom_builder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rom_builder)
+
+
+class ManifestHandler(http.server.BaseHTTPRequestHandler):
+    body = b"<manifest/>"
+    etag = '"v1"'
+    last_modified = "Wed, 14 Oct 2026 10:00:00 GMT"
+    requests = []
+
+    def do_GET(self):
+        type(self).requests.append(dict(self.headers))
+        if self.path == "/etag.xml" and self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        if self.path == "/modified.xml" and self.headers.get("If-Modified-Since") == self.last_modified:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if self.path == "/etag.xml":
+            self.send_header("ETag", self.etag)
+        else:
+            self.send_header("Last-Modified", self.last_modified)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ManifestFetcherTest(unittest.TestCase):
+    def setUp(self):
+        ManifestHandler.requests = []
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), ManifestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+        self.cache = tempfile.TemporaryDirectory()
+        self.fetcher = rom_builder.ManifestFetcher(self.cache.name, timeout=5)
+
+    def tearDown(self):
+        self.stop_server()
+        self.cache.cleanup()
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def test_etag_revalidation(self):
+        content, digest = self.fetcher.fetch(f"{self.base}/etag.xml")
+        self.assertEqual(content, ManifestHandler.body)
+        again, again_digest = self.fetcher.fetch(f"{self.base}/etag.xml")
+        self.assertEqual((again, again_digest), (content, digest))
+        self.assertEqual(ManifestHandler.requests[-1].get("If-None-Match"), ManifestHandler.etag)
+
+    def test_last_modified_revalidation(self):
+        self.fetcher.fetch(f"{self.base}/modified.xml")
+        content, _ = self.fetcher.fetch(f"{self.base}/modified.xml")
+        self.assertEqual(content, ManifestHandler.body)
+        self.assertEqual(ManifestHandler.requests[-1].get("If-Modified-Since"), ManifestHandler.last_modified)
+
+    def test_cached_copy_when_server_is_gone(self):
+        url = f"{self.base}/etag.xml"
+        content, digest = self.fetcher.fetch(url)
+        self.stop_server()
+        self.assertEqual(self.fetcher.fetch(url), (content, digest))
+
+    def test_corrupt_cache_is_refetched(self):
+        url = f"{self.base}/etag.xml"
+        self.fetcher.fetch(url)
+        _, meta_path = self.fetcher._paths(url)
+        with open(meta_path, "w") as f:
+            f.write('{"etag": ')
+        content, _ = self.fetcher.fetch(url)
+        self.assertEqual(content, ManifestHandler.body)
+        self.assertIsNone(ManifestHandler.requests[-1].get("If-None-Match"))
+
+    def test_error_without_cache(self):
+        url = f"{self.base}/etag.xml"
+        self.stop_server()
+        with self.assertRaises(OSError):
+            self.fetcher.fetch(url)
+
+
+if __name__ == "__main__":
+    unittest.main()
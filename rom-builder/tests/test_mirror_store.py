@@ -0,0 +1,47 @@
+"""Tests for linking existing projects to the shared mirror"""
+import importlib.util
+import os
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rom-builder.py")
+spec = importlib.util.spec_from_file_location("rom_builder", SCRIPT)
+rom_builder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rom_builder)
+
+
+class MirrorStoreLinkTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mirror_path = os.path.join(self.tmp.name, "mirror")
+        self.rom_path = os.path.join(self.tmp.name, "ax")
+        for name in ("platform/build", "platform/frameworks/base"):
+            os.makedirs(os.path.join(self.mirror_path, f"{name}.git", "objects"))
+        for name in ("platform/build", "platform/frameworks/base", "device/xiaomi/pipa"):
+            os.makedirs(os.path.join(self.rom_path, ".repo", "project-objects", f"{name}.git", "objects"))
+        self.mirror = rom_builder.MirrorStore(self.mirror_path, run_command=None)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def alternates(self, name):
+        path = os.path.join(self.rom_path, ".repo", "project-objects", f"{name}.git", "objects", "info", "alternates")
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return f.read().split()
+
+    def test_links_projects_present_in_mirror(self):
+        self.assertEqual(self.mirror.link(self.rom_path), 2)
+        self.assertEqual(self.alternates("platform/frameworks/base"),
+                         [os.path.join(self.mirror_path, "platform/frameworks/base.git", "objects")])
+        self.assertIsNone(self.alternates("device/xiaomi/pipa"))
+
+    def test_linking_again_changes_nothing(self):
+        self.mirror.link(self.rom_path)
+        self.assertEqual(self.mirror.link(self.rom_path), 0)
+        self.assertEqual(len(self.alternates("platform/build")), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
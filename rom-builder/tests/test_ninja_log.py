@@ -0,0 +1,52 @@
+"""Tests for the .ninja_log analysis in rom-builder.py"""
+import importlib.util
+import os
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rom-builder.py")
+spec = importlib.util.spec_from_file_location("rom_builder", SCRIPT)
+rom_builder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rom_builder)
+
+
+class NinjaLogAnalyzerTest(unittest.TestCase):
+    def analyze(self, lines):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, ".ninja_log")
+            with open(path, "w") as f:
+                f.write("# ninja log v5\n")
+                f.writelines("\t".join(str(field) for field in line) + "\n" for line in lines)
+            return rom_builder.NinjaLogAnalyzer().analyze(path)
+
+    def test_zero_length_action_ends_critical_path(self):
+        report = self.analyze([
+            (0, 0, 0, "out/a.stamp", "aa"),
+            (0, 5000, 0, "out/b.o", "bb"),
+        ])
+        self.assertEqual(report["actions"], 2)
+        self.assertEqual(report["critical_path"]["actions_ms"], 5000)
+
+    def test_critical_path_follows_earlier_actions(self):
+        report = self.analyze([
+            (0, 500, 0, "out/c.o", "cc"),
+            (0, 2000, 0, "out/a.o", "aa"),
+            (2000, 6000, 0, "out/b.o", "bb"),
+        ])
+        steps = [step["output"] for step in report["critical_path"]["steps"]]
+        self.assertEqual(steps, ["out/a.o", "out/b.o"])
+        self.assertEqual(report["wall_ms"], 6000)
+
+    def test_only_last_ninja_run_counts(self):
+        report = self.analyze([
+            (0, 9000, 0, "out/old.o", "aa"),
+            (0, 1000, 0, "out/new.o", "bb"),
+            (0, 1000, 0, "out/new.d", "bb"),
+        ])
+        self.assertEqual(report["ninja_runs"], 2)
+        self.assertEqual(report["actions"], 1)
+        self.assertEqual(report["slowest"][0]["output"], "out/new.o")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+"""Tests for NinjaProgress, the ninja status line follower in rom-builder.py"""
+import importlib.util
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rom-builder.py")
+spec = importlib.util.spec_from_file_location("rom_builder", SCRIPT)
+rom_builder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rom_builder)
+
+
+class NinjaProgressTest(unittest.TestCase):
+    def feed(self, statuses):
+        with tempfile.TemporaryDirectory() as tmp:
+            progress = rom_builder.NinjaProgress("build", os.path.join(tmp, "events.jsonl"), bar=False)
+            with mock.patch.object(rom_builder.time, "time", side_effect=range(1000, 2000)):
+                for done, total in statuses:
+                    progress.feed(f"[ {done * 100 // total}% {done}/{total}] CXX out/{done}.o")
+            return progress
+
+    def test_shrinking_total_stays_in_stage(self):
+        progress = self.feed([(100, 1000), (200, 1000), (300, 990), (400, 985), (985, 985)])
+        self.assertEqual(progress.stage, 1)
+        self.assertEqual(progress.actions, 985)
+        self.assertEqual(progress.total, 985)
+
+    def test_eta_uses_updated_total(self):
+        progress = self.feed([(100, 1000), (200, 1000), (300, 600)])
+        self.assertGreater(progress.rate(), 0)
+        self.assertAlmostEqual(progress.eta(), (600 - 300) / progress.rate())
+
+    def test_count_going_backwards_starts_stage(self):
+        progress = self.feed([(10, 50), (50, 50), (1, 2000), (500, 2000)])
+        self.assertEqual(progress.stage, 2)
+        self.assertEqual(progress.actions, 550)
+        self.assertEqual(progress.done, 500)
+
+    def test_errors_are_printed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            progress = rom_builder.NinjaProgress("build", os.path.join(tmp, "events.jsonl"), bar=False)
+            with mock.patch.object(rom_builder.sys, "stdout") as stdout:
+                progress.feed("FAILED: out/a.o")
+                progress.feed("just output")
+            stdout.write.assert_called_once_with("FAILED: out/a.o\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+"""Tests for parsing failed projects out of repo sync output"""
+import importlib.util
+import os
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rom-builder.py")
+spec = importlib.util.spec_from_file_location("rom_builder", SCRIPT)
+rom_builder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rom_builder)
+
+
+class ParseFailedProjectsTest(unittest.TestCase):
+    def test_failing_repos_list(self):
+        output = """Fetching: 99% (1020/1030)
+error: Unable to fully sync the tree
+Failing repos (network):
+device/xiaomi/pipa
+vendor/xiaomi/pipa/
+Try re-running with "-j1 --fail-fast" to exit at the first error.
+"""
+        self.assertEqual(rom_builder.parse_failed_projects(output), ["device/xiaomi/pipa", "vendor/xiaomi/pipa"])
+
+    def test_error_lines(self):
+        output = """error: Cannot fetch LineageOS/android_kernel_xiaomi_sm8250 from https://github.com/LineageOS/android_kernel_xiaomi_sm8250
+error: Cannot checkout platform/frameworks/base
+error: packages/apps/Settings/: platform/packages/apps/Settings checkout 1234 
+error.GitError: external/chromium-webview: git command failed
+"""
+        self.assertEqual(rom_builder.parse_failed_projects(output), [
+            "LineageOS/android_kernel_xiaomi_sm8250",
+            "platform/frameworks/base",
+            "packages/apps/Settings",
+            "external/chromium-webview",
+        ])
+
+    def test_projects_are_reported_once(self):
+        output = """error: Cannot fetch device/xiaomi/pipa from https://example.com
+Failing repos:
+device/xiaomi/pipa
+"""
+        self.assertEqual(rom_builder.parse_failed_projects(output), ["device/xiaomi/pipa"])
+
+    def test_generic_failure_names_no_project(self):
+        self.assertEqual(rom_builder.parse_failed_projects("error: Unable to fully sync the tree.\nfatal: network down\n"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+"""Tests for the shallow clone local manifest written by SyncProfile"""
+import importlib.util
+import os
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rom-builder.py")
+spec = importlib.util.spec_from_file_location("rom_builder", SCRIPT)
+rom_builder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rom_builder)
+
+MANIFEST = """<manifest>
+  <remote name="aosp" fetch=".."/>
+  <remote name="device" fetch="https://example.com"/>
+  <default remote="aosp" revision="main"/>
+  <project path="prebuilts/clang/host/linux-x86" name="platform/prebuilts/clang" revision="old"/>
+  <project path="prebuilts/go/linux-x86" name="platform/prebuilts/go"/>
+  <project path="frameworks/base" name="platform/frameworks/base"/>
+  <extend-project name="platform/prebuilts/clang" revision="pinned" remote="device"/>
+</manifest>
+"""
+
+
+class SyncProfileTest(unittest.TestCase):
+    def write(self, rules):
+        with tempfile.TemporaryDirectory() as tmp:
+            manifest_path = os.path.join(tmp, "default.xml")
+            with open(manifest_path, "w") as f:
+                f.write(MANIFEST)
+            snapshot = rom_builder.ManifestSnapshot.from_file(manifest_path)
+            out = os.path.join(tmp, "shallow.xml")
+            count = rom_builder.SyncProfile(rules).write_local_manifest(snapshot, out)
+            root = ET.parse(out).getroot() if count else None
+        return count, root
+
+    def test_extend_project_revision_wins(self):
+        count, root = self.write([{"pattern": "prebuilts/*", "mode": "shallow"}, {"pattern": "*", "mode": "full"}])
+        self.assertEqual(count, 2)
+        projects = {node.get("path"): node for node in root.iter("project")}
+        clang = projects["prebuilts/clang/host/linux-x86"]
+        self.assertEqual(clang.get("revision"), "pinned")
+        self.assertEqual(clang.get("remote"), "device")
+        self.assertEqual(clang.get("clone-depth"), "1")
+        self.assertEqual(projects["prebuilts/go/linux-x86"].get("revision"), "main")
+        self.assertEqual(sorted(node.get("name") for node in root.iter("remove-project")),
+                         ["platform/prebuilts/clang", "platform/prebuilts/go"])
+
+    def test_nothing_shallow_writes_nothing(self):
+        count, root = self.write([{"pattern": "*", "mode": "full"}])
+        self.assertEqual(count, 0)
+        self.assertIsNone(root)
+
+
+if __name__ == "__main__":
+    unittest.main()